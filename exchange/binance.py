@@ -2,6 +2,19 @@ from exchange.pexchange import ccxt, ccxt_async, httpx
 from devtools import debug
 from exchange.model import MarketOrder, OrderBase, LimitOrder, ChangeSLOrder
 import exchange.error as error
+from exchange.utility.breaker import guarded
+from exchange.utility.account_state import cached_balance, cached_open_orders, cached_positions, get_account_state
+from exchange.utility.singleflight import coalesced, invalidate_account
+from exchange.utility import settings
+from exchange.utility.ticker import cached_price
+from exchange.utility.orderbook import plan_market_order
+from exchange.utility.prefetch import prefetch, submit
+from exchange.utility.metrics import record_latency
+from exchange.utility.fills import fill_waiter, filled_amount
+from exchange.utility.batch import cancel_orders
+from exchange.utility.filters import get_quantizer, validate_order
+from exchange.utility.leverage import leverage_cache
+from exchange.utility import order_ws
 import time
 
 
@@ -17,13 +30,19 @@ class Binance:
         self.client.load_markets()
         self.position_mode = "one-way"
         self.order_info: OrderBase = None
+        self.entry_orders: list[tuple[dict, float]] | None = None
+        self.entry_filled: float | None = None
     def create_order_with_retry(self, symbol, tp_side, tp_amount, tp_price):
         max_retries = 5
         retry_delay = 0.2
+        validate_order(self.client, symbol, 'limit', tp_side, tp_amount, tp_price, {'reduceOnly': True})
 
         for attempt in range(max_retries):
             try:
-                tp_order = self.client.create_order(
+                tp_order = guarded(
+                    self.client,
+                    "order",
+                    self.create_order,
                     symbol=symbol,
                     type='limit',
                     side=tp_side,
@@ -31,8 +50,11 @@ class Binance:
                     price=tp_price,
                     params={'reduceOnly': True}
                 )
+                invalidate_account(self.client)
                 return tp_order  # 성공 시 주문 정보 반환
             except Exception as e:
+                if isinstance(e, error.CircuitOpenError):
+                    raise
                 if attempt < max_retries - 1:  # 마지막 시도가 아닌 경우
                     print(f"주문 생성 실패 (시도 {attempt + 1}/{max_retries}): {str(e)}")
                     time.sleep(retry_delay)  # 다음 시도 전 0.2초 대기
@@ -42,7 +64,9 @@ class Binance:
         return None
     
     def get_position(self, symbol):
-        positions = self.client.fetch_positions([symbol])
+        positions = cached_positions(self.client, symbol)
+        if positions is None:
+            positions = coalesced(self.client, "account", self.client.fetch_positions, [symbol])
         for position in positions:
             if position['symbol'] == symbol:
                 return position
@@ -53,14 +77,22 @@ class Binance:
         return order_type in stop_types or 'STOP' in order_type    
 
     def get_stop_orders(self, symbol):
-        open_orders = self.client.fetch_open_orders(symbol)
+        open_orders = cached_open_orders(self.client, symbol)
+        if open_orders is None:
+            open_orders = coalesced(self.client, "account", self.client.fetch_open_orders, symbol)
         return [order for order in open_orders if self.is_stop_order(order)]
 
     def cancel_order(self, order_id, symbol):
         return self.client.cancel_order(order_id, symbol)
 
+    def cancel_orders(self, order_ids, symbol):
+        # DELETE /fapi/v1/batchOrders, 요청당 최대 10건. 취소된 주문 목록을 돌려준다
+        result = cancel_orders(self.client, order_ids, symbol, 10)
+        invalidate_account(self.client)
+        return result["cancelled"]
+
     def create_stop_order(self, symbol, side, amount, price):
-        return self.client.create_order(
+        return self.create_order(
             symbol=symbol,
             type='STOP_MARKET',
             side=side,
@@ -76,26 +108,32 @@ class Binance:
         try:
             print("Changing SL order")
             symbol = order_info.unified_symbol
+            started = time.perf_counter()
+            # 유저 스트림이 살아있으면 포지션/스톱 주문은 로컬 상태에서 바로 읽는다
+            path = "local" if get_account_state(self.client).live else "rest"
             position = self.get_position(symbol)
-            position_amt = float(position['info'].get('positionAmt', 0))
+            position_amt = float(position['info'].get('positionAmt', 0)) if position else 0
             print(f"Position: {position}")
             if not position or position_amt == 0:
                 print(f"No open position for {symbol}")
                 return None
 
-            
             stop_orders = self.get_stop_orders(symbol)
             print(f"Stop orders: {stop_orders}")
-            for order in stop_orders:
-                self.cancel_order(order['id'], symbol)
-                print(f"Cancelled existing stop order: {order['id']}")
-                
+            # 바이낸스 선물 주문 수정(PUT /fapi/v1/order)은 LIMIT 주문만 지원해서 스톱은 수정할 수 없다
+            # 기존 스톱은 한 번에 취소하고, 새 스톱 생성과 동시에 보낸다
+            cancel_future = (
+                submit(self.cancel_orders, [order['id'] for order in stop_orders], symbol)
+                if stop_orders
+                else None
+            )
+
             side = 'sell' if position_amt > 0 else 'buy'
             entry_price = float(position['entryPrice'])
             if side == 'sell':  # 롱 포지션
-                new_stop_price = round(entry_price * 0.999,4) 
+                new_stop_price = get_quantizer(self.client, symbol).round_price(entry_price * 0.999)
             else:  # 숏 포지션
-                new_stop_price = round(entry_price * 1.001,4)  
+                new_stop_price = get_quantizer(self.client, symbol).round_price(entry_price * 1.001)
 
             try:
                 new_stop_order = self.create_stop_order(
@@ -124,19 +162,97 @@ class Binance:
                 except Exception as market_order_error:
                     print(f"Failed to close position with market order: {str(market_order_error)}")
                     raise
+            finally:
+                if cancel_future is not None:
+                    try:
+                        print(f"Cancelled existing stop orders: {[order['id'] for order in cancel_future.result()]}")
+                    except Exception as cancel_error:
+                        print(f"Error cancelling stop orders: {str(cancel_error)}")
+                record_latency(f"change_sl.BINANCE.{path}", time.perf_counter() - started)
         
         except Exception as e:
             print(f"Error in change_sl_order: {str(e)}")
             raise
     
     
+    def tp_leg(self, symbol, tp_side, tp_amount, tp_price):
+        return {
+            "symbol": symbol,
+            "type": "limit",
+            "side": tp_side,
+            "amount": abs(tp_amount),
+            "price": tp_price,
+            "params": {"reduceOnly": True},
+        }
+
+    def sl_leg(self, symbol, sl_side, amount, sl_price):
+        return {
+            "symbol": symbol,
+            "type": "stop_market",
+            "side": sl_side,
+            "amount": abs(amount),
+            "price": None,
+            "params": {"stopPrice": sl_price, "reduceOnly": True},
+        }
+
+    def create_bracket_orders(self, symbol, legs):
+        # batchOrders는 요청당 최대 5건. 응답은 leg별 성공/실패라서 실패한 leg만 다시 보낸다
+        max_retries = 5
+        retry_delay = 0.2
+        results = [None] * len(legs)
+        # 필터에 걸리는 leg는 보내지 않고 실패로 남긴다. 나머지(특히 SL)는 그대로 건다
+        rejected = []
+        for j, leg in enumerate(legs):
+            try:
+                validate_order(self.client, leg["symbol"], leg["type"], leg["side"], leg["amount"], leg["price"], leg["params"])
+            except (error.AmountError, error.PriceError) as e:
+                print(f"브래킷 leg 필터 오류: {leg['type']} {str(e)}")
+                rejected.append((j, str(e)))
+        pending = [j for j in range(len(legs)) if j not in dict(rejected)]
+        started = time.perf_counter()
+        failed = []
+        for attempt in range(max_retries):
+            if not pending:
+                break
+            failed = []
+            for i in range(0, len(pending), 5):
+                chunk = pending[i : i + 5]
+                try:
+                    orders = order_ws.create_orders(self.client, [legs[j] for j in chunk])
+                except error.CircuitOpenError:
+                    raise
+                except Exception as e:
+                    print(f"브래킷 주문 요청 실패 (시도 {attempt + 1}/{max_retries}): {str(e)}")
+                    failed += [(j, str(e)) for j in chunk]
+                    continue
+                for j, order in zip(chunk, orders):
+                    if order["id"] is None:
+                        print(f"브래킷 leg 실패 (시도 {attempt + 1}/{max_retries}): {legs[j]['type']} {order['info']}")
+                        failed.append((j, order["info"].get("msg")))
+                    else:
+                        results[j] = order
+            invalidate_account(self.client)
+            pending = [j for j, _ in failed]
+            if pending and attempt < max_retries - 1:
+                time.sleep(retry_delay)
+        failed = rejected + failed
+        if not failed:
+            record_latency("bracket.BINANCE", time.perf_counter() - started)
+            return results
+        print(f"브래킷 주문 실패: {failed}")
+        raise Exception(f"브래킷 주문 실패: {[message for _, message in failed]}")
+
     def create_sl_order_with_retry(self, symbol, sl_side, entry_amount, sl_price, params):
         max_retries = 5
         retry_delay = 0.2
         print('SL 주문 생성 retry 로직. sl_side : ', sl_side)
+        validate_order(self.client, symbol, 'stop_market', sl_side, entry_amount, None, {'stopPrice': sl_price, 'reduceOnly': True})
         for attempt in range(max_retries):
             try:
-                sl_order = self.client.create_order(
+                sl_order = guarded(
+                    self.client,
+                    "order",
+                    self.create_order,
                     symbol=symbol,
                     type='stop_market',
                     side=sl_side,
@@ -147,8 +263,11 @@ class Binance:
                         'reduceOnly': True,
                     }
                 )
+                invalidate_account(self.client)
                 return sl_order  # 성공 시 주문 정보 반환
             except Exception as e:
+                if isinstance(e, error.CircuitOpenError):
+                    raise
                 if attempt < max_retries - 1:  # 마지막 시도가 아닌 경우
                     print(f"SL 주문 생성 실패 (시도 {attempt + 1}/{max_retries}): {str(e)}")
                     time.sleep(retry_delay)  # 다음 시도 전 0.2초 대기
@@ -184,10 +303,13 @@ class Binance:
             self.client.options["defaultType"] = "spot"
 
     def get_ticker(self, symbol: str):
-        return self.client.fetch_ticker(symbol)
+        return coalesced(self.client, "market", self.client.fetch_ticker, symbol, probe_symbol=symbol)
 
     def get_price(self, symbol: str):
-        return self.get_ticker(symbol)["last"]
+        price = cached_price(self.client, symbol)
+        if price is None:
+            price = self.get_ticker(symbol)["last"]
+        return price
 
     def get_futures_position(self, symbol=None, all=False):
         if symbol is None and all:
@@ -201,7 +323,7 @@ class Binance:
 
         positions = None
         if self.order_info.is_coinm:
-            positions = self.client.fetch_balance()["info"]["positions"]
+            positions = coalesced(self.client, "account", self.client.fetch_balance)["info"]["positions"]
             positions = [
                 position
                 for position in positions
@@ -209,7 +331,9 @@ class Binance:
                 and position["symbol"] == self.client.market(symbol).get("id")
             ]
         else:
-            positions = self.client.fetch_positions(symbols=[symbol])
+            positions = cached_positions(self.client, symbol)
+            if positions is None:
+                positions = coalesced(self.client, "account", self.client.fetch_positions, symbols=[symbol])
 
         long_contracts = None
         short_contracts = None
@@ -252,12 +376,18 @@ class Binance:
             self.order_info.is_spot
             and (self.order_info.is_buy or self.order_info.is_sell)
         ):
-            free_balance = (
-                self.client.fetch_free_balance()
-                if not self.order_info.is_total
-                else self.client.fetch_total_balance()
+            free_balance_by_base = cached_balance(
+                self.client, base, self.order_info.is_total
             )
-            free_balance_by_base = free_balance.get(base)
+            if free_balance_by_base is None:
+                free_balance = coalesced(
+                    self.client,
+                    "account",
+                    self.client.fetch_free_balance
+                    if not self.order_info.is_total
+                    else self.client.fetch_total_balance,
+                )
+                free_balance_by_base = free_balance.get(base)
 
         if free_balance_by_base is None or free_balance_by_base == 0:
             raise error.FreeAmountNoneError()
@@ -275,18 +405,25 @@ class Binance:
         elif order_info.percent is not None:
             if order_info.is_entry or (order_info.is_spot and order_info.is_buy):
                 if order_info.is_coinm:
-                    free_base = self.get_balance(order_info.base)
                     if order_info.is_contract:
-                        current_price = self.get_price(order_info.unified_symbol)
+                        data = prefetch(
+                            balance=(self.get_balance, order_info.base),
+                            price=(self.get_price, order_info.unified_symbol),
+                        )
+                        free_base, current_price = data["balance"], data["price"]
                         result = (
                             free_base * order_info.percent / 100 * current_price
                         ) // order_info.contract_size
                     else:
+                        free_base = self.get_balance(order_info.base)
                         result = free_base * order_info.percent / 100
                 else:
-                    free_quote = self.get_balance(order_info.quote)
+                    data = prefetch(
+                        balance=(self.get_balance, order_info.quote),
+                        price=(self.get_price, order_info.unified_symbol),
+                    )
+                    free_quote, current_price = data["balance"], data["price"]
                     cash = free_quote * (order_info.percent - 0.5) / 100
-                    current_price = self.get_price(order_info.unified_symbol)
                     if order_info.is_contract:
                         result = (cash / current_price) // order_info.contract_size
                     else:
@@ -311,9 +448,14 @@ class Binance:
 
         return result
 
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        # ORDER_WS를 켜면 주문 웹소켓(WebSocket API)으로 보낸다. 연결이 없으면 REST
+        return order_ws.create_order(self.client, symbol, type, side, amount, price, params)
+
     def set_leverage(self, leverage, symbol):
         if self.order_info.is_futures:
-            self.client.set_leverage(leverage, symbol)
+            # 바이낸스 레버리지는 심볼 단위(롱/숏 공통)
+            leverage_cache.ensure(self.client, symbol, leverage, lambda: self.client.set_leverage(leverage, symbol))
 
     def market_order(self, order_info: MarketOrder):
         from exchange.pexchange import retry
@@ -322,7 +464,7 @@ class Binance:
         params = {}
         try:
             return retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -343,7 +485,7 @@ class Binance:
         params = {}
         try:
             return retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -399,11 +541,7 @@ class Binance:
         use_tp3 = order_info.use_tp3
         use_tp4 = order_info.use_tp4
         use_sl = order_info.use_sl
-        round_info = 2
-        if "SOL" in symbol:
-            round_info = 0
-        elif "BTC" in symbol:
-            round_info = 3
+        quantizer = get_quantizer(self.client, symbol)
         if use_tp1:
             tp1_price = order_info.tp1_price
             tp1_qty_percent = order_info.tp1_qty_percent
@@ -458,17 +596,22 @@ class Binance:
                 elif order_info.is_close:
                     positionSide = "LONG"
             params = {"positionSide": positionSide}
+        # 로컬 호가 기준 예상 슬리피지가 크면 수량을 줄이거나 나눈다
+        slices = plan_market_order(self.client, symbol, order_info.side, abs(entry_amount))
+        entry_amount = sum(slices)
+        # 수량 계산과 슬리피지 검사를 통과한 뒤에만 레버리지를 바꾼다
         if order_info.leverage is not None:
             self.set_leverage(order_info.leverage, symbol)
 
         try:
             print('order 호출 2')
+            started = time.perf_counter()
             result = retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
-                abs(entry_amount),
+                slices[0],
                 None,
                 params,
                 order_info=order_info,
@@ -476,74 +619,70 @@ class Binance:
                 delay=0.1,
                 instance=self,
             )
+            entry_orders = [result]
+            for amount in slices[1:]:
+                # 나머지 조각은 호가가 다시 채워질 시간을 두고 보낸다
+                time.sleep(settings.SLIPPAGE_SPLIT_INTERVAL)
+                entry_orders.append(retry(
+                    self.create_order,
+                    symbol,
+                    order_info.type.lower(),
+                    order_info.side,
+                    amount,
+                    None,
+                    params,
+                    order_info=order_info,
+                    max_attempts=10,
+                    delay=0.1,
+                    instance=self,
+                ))
+            # 헷지처럼 전체 진입 수량이 필요한 호출자가 모든 조각의 체결을 합산할 수 있게 남긴다
+            # 여기서 체결을 이미 확인했으면 entry_filled에 합계를 남겨서 호출자가 다시 기다리지 않는다
+            self.entry_orders = list(zip(entry_orders, slices))
+            self.entry_filled = None
             print(result)
-            time.sleep(1)
-            print('order 호출 3')
+            # 체결 이벤트가 오는 즉시 실제 체결 수량으로 TP/SL을 건다
+            entry_amount = sum(
+                filled_amount(fill_waiter.wait(self.client, order, symbol), amount)
+                for order, amount in zip(entry_orders, slices)
+            )
+            self.entry_filled = entry_amount
+            print('order 호출 3', entry_amount)
+            if entry_amount == 0:
+                print("체결 수량이 없어 TP/SL을 걸지 않습니다")
+                return result
             # 진입 주문이 성공적으로 실행된 후 기존 SL 주문 취소
             cancelled_sl_orders = self.cancel_sl_order(symbol)
             print(f"Cancelled SL orders: {cancelled_sl_orders}")
-            tp1_qty = 0.0
-            tp2_qty = 0.0
-            tp3_qty = 0.0
-            tp4_qty = 0.0
-            tp_quantities = [0.0, 0.0, 0.0, 0.0]
-            used_amount = 0.0
-        
-            
             tp_percentages = [order_info.tp1_qty_percent, order_info.tp2_qty_percent, order_info.tp3_qty_percent, order_info.tp4_qty_percent]
             use_tp_flags = [use_tp1, use_tp2, use_tp3, use_tp4]
             print(f"TP percentages: {tp_percentages}")
             print(f"Use TP flags: {use_tp_flags}")
-            for i, (qty_percent, use_tp) in enumerate(zip(tp_percentages, use_tp_flags)):
-                if qty_percent is not None and use_tp:
-                    tp_qty = round(abs(entry_amount) * (qty_percent / 100), round_info)
-                    used_amount += tp_qty
-                    tp_quantities[i] = tp_qty
-                    print(f"TP{i+1} quantity: {tp_qty}")
-            
-            remaining_qty = abs(entry_amount) - used_amount
-            if remaining_qty > 0:
-                for i in range(3, -1, -1):
-                    if use_tp_flags[i]:
-                        tp_quantities[i] += remaining_qty
-                        print(f"Added remaining {remaining_qty} to TP{i+1}")
-                        break
-        
-            try:
-                print(f"Final TP quantities: {tp_quantities}")
-                # TP 주문 생성 (reduce-only)
-                tp_count = 0
-
-                for use_tp, tp_price, tp_qty in zip(use_tp_flags, tp_data, tp_quantities):
-                    print(f"Processing TP: use_tp={use_tp}, tp_price={tp_price}, tp_qty={tp_qty}")
-                    tp_price = tp_price[1] if isinstance(tp_price, tuple) else tp_price
-                    if use_tp and tp_price and tp_qty > 0:
-                        tp_side = "buy" if order_info.side == "sell" else "sell"
-                        positionSide = "SHORT" if order_info.side == "sell" else "LONG"
-                        tp_params = {
-                            "reduceOnly": True,
-                            "positionSide": positionSide
-                        }
-                        print(f"Creating TP order: side={tp_side}, qty={tp_qty}, price={tp_price}, params={tp_params}")
-                        tp_order = self.create_order_with_retry(symbol, tp_side, tp_qty, tp_price)
-                        tp_count += 1
-                        print(f"TP {tp_count} order created: {tp_order}")
-                    else:
-                        print(f"Skipping TP order: use_tp={use_tp}, tp_price={tp_price}, tp_qty={tp_qty}")
-            except Exception as e:
-                print(f"Error creating TP orders: {e}")
-                raise error.OrderError(e, self.order_info)
+            # 심볼의 수량 단위로 나눠서 TP 수량 합계가 체결 수량과 정확히 같다. 남는 수량은 마지막 TP에 더한다
+            tp_quantities = quantizer.split(
+                abs(entry_amount),
+                [qty_percent if use_tp and tp_price else None for use_tp, tp_price, qty_percent in tp_data],
+            )
+            tp_prices = quantizer.round_prices(tp_prices)
+            print(f"Final TP quantities: {tp_quantities}")
+            # TP(reduce-only 지정가)와 SL(stop market)을 batchOrders 한 번으로 넣는다
+            bracket_side = "buy" if order_info.side == "sell" else "sell"
+            legs = []
+            for use_tp, tp_price, tp_qty in zip(use_tp_flags, tp_prices, tp_quantities):
+                if use_tp and tp_price and tp_qty > 0:
+                    legs.append(self.tp_leg(symbol, bracket_side, tp_qty, tp_price))
+                else:
+                    print(f"Skipping TP order: use_tp={use_tp}, tp_price={tp_price}, tp_qty={tp_qty}")
+            if sl_price:
+                legs.append(self.sl_leg(symbol, bracket_side, abs(entry_amount), sl_price))
             try:
-                # SL 주문 생성 (reduce-only)
-                print('SL 주문 생성')
-                if sl_price:
-                    sl_side = "sell" if order_info.side == "buy" else "buy"
-                    sl_params = {
-                        "reduceOnly": True,
-                        "positionSide": params.get("positionSide", None)
-                    }
-                    sl_order = self.create_sl_order_with_retry(symbol, sl_side, abs(entry_amount), sl_price, {'stopPrice': sl_price, 'reduceOnly': True})
+                if legs:
+                    bracket_orders = self.create_bracket_orders(symbol, legs)
+                    print(f"Bracket orders created: {[order['id'] for order in bracket_orders]}")
+                    # 진입 요청부터 TP/SL이 모두 걸릴 때까지 (거래소별 비교용)
+                    record_latency("protected.BINANCE", time.perf_counter() - started)
             except Exception as e:
+                print(f"Error creating bracket orders: {e}")
                 raise error.OrderError(e, self.order_info)
 
 
@@ -572,7 +711,7 @@ class Binance:
         
         try:
             result = retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -606,13 +745,14 @@ class Binance:
             cancelled_orders = []
             if not stop_orders:
                 return cancelled_orders
-            for order in stop_orders:
-                try:
-                    self.cancel_order(order['id'], symbol)
-                    cancelled_orders.append(order['id'])
-                    print(f"Cancelled stop order: {order['id']}")
-                except Exception as cancel_error:
-                    print(f"Error cancelling stop order {order['id']}: {str(cancel_error)}")
+            # allOpenOrders는 TP 지정가까지 지우므로 스톱 주문만 골라 일괄 취소
+            started = time.perf_counter()
+            result = cancel_orders(self.client, [order['id'] for order in stop_orders], symbol, 10)
+            invalidate_account(self.client)
+            cancelled_orders = [order['id'] for order in result["cancelled"]]
+            print(f"Cancelled stop orders: {cancelled_orders} ({(time.perf_counter() - started) * 1000:.0f}ms)")
+            for order_id, cancel_error in result["failed"].items():
+                print(f"Error cancelling stop order {order_id}: {cancel_error}")
             
             if cancelled_orders:
                 print(f"Successfully cancelled {len(cancelled_orders)} stop order(s) for {symbol}")
@@ -698,7 +838,7 @@ class Binance:
 
         try:
             return retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -713,14 +853,6 @@ class Binance:
         except Exception as e:
             raise error.OrderError(e, self.order_info)
 
-    def get_listen_key(self):
-        url = "https://fapi.binance.com/fapi/v1/listenKey"
-
-        listenkey = httpx.post(
-            url, headers={"X-MBX-APIKEY": self.client.apiKey}
-        ).json()["listenKey"]
-        return listenkey
-
     def get_trades(self):
         is_futures = self.order_info.is_futures
         if is_futures:
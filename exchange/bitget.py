@@ -1,9 +1,20 @@
 from pprint import pprint
 from exchange.pexchange import ccxt
 from exchange.database import db
-from exchange.model import MarketOrder
+from exchange.model import MarketOrder, ChangeSLOrder
 import exchange.error as error
+from exchange.utility.account_state import cached_balance, cached_positions
+from exchange.utility.breaker import guarded
+from exchange.utility.singleflight import coalesced, invalidate_account
+from exchange.utility.metrics import record_latency
+from exchange.utility.ticker import cached_price
+from exchange.utility.prefetch import prefetch, submit
+from exchange.utility.leverage import leverage_cache, normalize_margin_mode
+from exchange.utility.batch import cancel_orders
+from exchange.utility.filters import get_quantizer, validate_order
+from exchange.utility.fills import fill_waiter, filled_amount
 from devtools import debug
+import time
 
 
 class Bitget:
@@ -45,13 +56,18 @@ class Bitget:
             self.client.options["defaultType"] = "spot"
 
     def get_ticker(self, symbol: str):
-        return self.client.fetch_ticker(symbol)
+        return coalesced(self.client, "market", self.client.fetch_ticker, symbol, probe_symbol=symbol)
 
     def get_price(self, symbol: str):
-        return self.get_ticker(symbol)["last"]
+        price = cached_price(self.client, symbol)
+        if price is None:
+            price = self.get_ticker(symbol)["last"]
+        return price
 
     def get_futures_position(self, symbol):
-        positions = self.client.fetch_positions([symbol])
+        positions = cached_positions(self.client, symbol)
+        if positions is None:
+            positions = coalesced(self.client, "account", self.client.fetch_positions, [symbol])
         long_contracts = None
         short_contracts = None
 
@@ -88,12 +104,19 @@ class Bitget:
             self.order_info.is_spot
             and (self.order_info.is_buy or self.order_info.is_sell)
         ):
-            free_balance = (
-                self.client.fetch_free_balance({"coin": base})
-                if not self.order_info.is_total
-                else self.client.fetch_total_balance({"coin": base})
+            free_balance_by_base = cached_balance(
+                self.client, base, self.order_info.is_total
             )
-            free_balance_by_base = free_balance.get(base)
+            if free_balance_by_base is None:
+                free_balance = coalesced(
+                    self.client,
+                    "account",
+                    self.client.fetch_free_balance
+                    if not self.order_info.is_total
+                    else self.client.fetch_total_balance,
+                    {"coin": base},
+                )
+                free_balance_by_base = free_balance.get(base)
         if free_balance_by_base is None or free_balance_by_base == 0:
             raise error.FreeAmountNoneError()
         return free_balance_by_base
@@ -106,10 +129,12 @@ class Bitget:
 
         elif order_info.percent is not None:
             if order_info.is_entry or (order_info.is_spot and order_info.is_buy):
-                free_quote = self.get_balance(order_info.quote)
-                cash = free_quote * (order_info.percent - 1) / 100
-                current_price = self.get_price(order_info.unified_symbol)
-                result = cash / current_price
+                data = prefetch(
+                    balance=(self.get_balance, order_info.quote),
+                    price=(self.get_price, order_info.unified_symbol),
+                )
+                cash = data["balance"] * (order_info.percent - 1) / 100
+                result = cash / data["price"]
             elif self.order_info.is_close:
                 free_amount = self.get_futures_position(order_info.unified_symbol)
                 result = free_amount * order_info.percent / 100
@@ -137,12 +162,21 @@ class Bitget:
             # 'holdSide': 'long' or 'short',
         }
 
-        account = self.client.privateMixGetAccountAccount(
-            {"symbol": market["id"], "marginCoin": market["settleId"]}
-        )
-        if account["data"]["marginMode"] == "fixed":
+        # 마진 모드는 처음 한 번만 조회하고 이후에는 포지션 이벤트로 갱신된 값을 쓴다
+        margin_mode = leverage_cache.margin_mode(self.client, symbol)
+        if margin_mode is None:
+            account = self.client.privateMixGetAccountAccount(
+                {"symbol": market["id"], "marginCoin": market["settleId"]}
+            )
+            margin_mode = account["data"]["marginMode"]
+            leverage_cache.set_margin_mode(self.client, symbol, margin_mode)
+        side = None
+        if normalize_margin_mode(margin_mode) == "isolated":
+            side = hold_side
             request |= {"holdSide": hold_side}
-        return self.client.privateMixPostAccountSetLeverage(request)
+        leverage_cache.ensure(
+            self.client, symbol, leverage, lambda: self.client.privateMixPostAccountSetLeverage(request), side=side
+        )
 
     def market_order(self, order_info: MarketOrder):
         from exchange.pexchange import retry
@@ -179,6 +213,167 @@ class Bitget:
         order_info.amount = sell_amount
         return self.market_order(order_info)
 
+    def get_position(self, symbol):
+        positions = cached_positions(self.client, symbol)
+        if positions is None:
+            positions = coalesced(self.client, "account", self.client.fetch_positions, [symbol])
+        for position in positions:
+            if position["symbol"] == symbol and position["contracts"]:
+                return position
+        return None
+
+    def get_stop_orders(self, symbol):
+        # TP/SL 플랜 주문(profit_loss) 중 손절만. 주문별 SL은 loss_plan, 포지션 SL은 pos_loss
+        orders = coalesced(
+            self.client, "account", self.client.fetch_open_orders, symbol, None, None, {"planType": "profit_loss"}
+        )
+        return [order for order in orders if order["info"].get("planType") in ("loss_plan", "pos_loss")]
+
+    def amend_stop_order(self, order, symbol, stop_price, amount=None):
+        # POST /api/v2/mix/order/modify-tpsl-order. 포지션 SL(pos_loss)은 수량 없이 보낸다
+        market = self.client.market(symbol)
+        product_type, _ = self.client.handle_product_type_and_params(market, {})
+        stop_price = self.client.price_to_precision(symbol, stop_price)
+        request = {
+            "orderId": order["id"],
+            "symbol": market["id"],
+            "productType": product_type,
+            "marginCoin": market["settleId"],
+            "triggerPrice": stop_price,
+            "triggerType": order["info"].get("triggerType") or "mark_price",
+            "executePrice": "0",
+            "size": "",
+        }
+        if order["info"].get("planType") == "loss_plan":
+            request["size"] = self.client.amount_to_precision(symbol, amount if amount is not None else order["amount"])
+        response = guarded(self.client, "order", self.client.privateMixPostV2MixOrderModifyTpslOrder, request)
+        invalidate_account(self.client)
+        return {"id": order["id"], "symbol": symbol, "stopPrice": float(stop_price), "info": response}
+
+    def create_stop_order(self, symbol, position_side, amount, price):
+        # place-tpsl-order 포지션 SL(pos_loss). ccxt는 side로 보유 방향(롱=buy)을 받는다
+        order = guarded(
+            self.client,
+            "order",
+            self.client.create_order,
+            symbol,
+            "market",
+            "buy" if position_side == "long" else "sell",
+            abs(amount),
+            None,
+            {"stopLossPrice": price},
+        )
+        invalidate_account(self.client)
+        return order
+
+    def cancel_stop_orders(self, orders, symbol):
+        # cancel-plan-order는 planType별로 보낸다. 취소된 주문 목록을 돌려준다
+        cancelled = []
+        for plan_type in {order["info"].get("planType") for order in orders}:
+            order_ids = [order["id"] for order in orders if order["info"].get("planType") == plan_type]
+            result = cancel_orders(self.client, order_ids, symbol, 50, {"stop": True, "planType": plan_type})
+            cancelled += result["cancelled"]
+        invalidate_account(self.client)
+        return cancelled
+
+    def change_sl_order(self, order_info: ChangeSLOrder):
+        # 손절을 진입가로 옮긴다. 기존 SL 하나는 modify-tpsl-order로 그 자리에서 옮기고 남는 SL만 취소
+        cancel_futures = []
+        started = time.perf_counter()
+        try:
+            symbol = order_info.unified_symbol
+            position = self.get_position(symbol)
+            if not position:
+                print(f"No open position for {symbol}")
+                return None
+
+            stop_orders = self.get_stop_orders(symbol)
+            new_stop_price = get_quantizer(self.client, symbol).round_price(position["entryPrice"])
+            if len(stop_orders) > 1:
+                cancel_futures.append(submit(self.cancel_stop_orders, stop_orders[1:], symbol))
+            if stop_orders:
+                try:
+                    new_stop_order = self.amend_stop_order(stop_orders[0], symbol, new_stop_price, position["contracts"])
+                    print(f"Amended stop order to entry price: {new_stop_price}")
+                    return new_stop_order
+                except error.CircuitOpenError:
+                    raise
+                except Exception as amend_error:
+                    print(f"스톱 주문 수정 실패, 취소 후 재생성: {str(amend_error)}")
+                    cancel_futures.append(submit(self.cancel_stop_orders, stop_orders[:1], symbol))
+
+            new_stop_order = self.create_stop_order(symbol, position["side"], position["contracts"], new_stop_price)
+            print(f"Created new stop order at entry price: {new_stop_price}")
+            return new_stop_order
+
+        except Exception as e:
+            print(f"Error in change_sl_order: {str(e)}")
+            raise
+        finally:
+            for cancel_future in cancel_futures:
+                try:
+                    print(f"Cancelled existing stop orders: {[order['id'] for order in cancel_future.result()]}")
+                except Exception as cancel_error:
+                    print(f"Error cancelling stop orders: {str(cancel_error)}")
+            record_latency("change_sl.BITGET.rest", time.perf_counter() - started)
+
+    def create_bracket_orders(self, symbol, legs):
+        # batch-place-order는 요청당 최대 50건. 응답은 성공/실패 목록이라 clientOid로 leg와 짝짓고 실패한 leg만 다시 보낸다
+        max_retries = 5
+        retry_delay = 0.2
+        results = [None] * len(legs)
+        rejected = []
+        for j, leg in enumerate(legs):
+            try:
+                validate_order(self.client, leg["symbol"], leg["type"], leg["side"], leg["amount"], leg["price"], leg["params"])
+            except (error.AmountError, error.PriceError) as e:
+                print(f"브래킷 leg 필터 오류: {leg['type']} {str(e)}")
+                rejected.append((j, str(e)))
+        pending = [j for j in range(len(legs)) if j not in dict(rejected)]
+        started = time.perf_counter()
+        failed = []
+        for attempt in range(max_retries):
+            if not pending:
+                break
+            failed = []
+            for i in range(0, len(pending), 50):
+                chunk = pending[i : i + 50]
+                client_ids = {self.client.uuid22(): j for j in chunk}
+                try:
+                    orders = guarded(
+                        self.client,
+                        "order",
+                        self.client.create_orders,
+                        [legs[j] | {"params": legs[j]["params"] | {"clientOrderId": cid}} for cid, j in client_ids.items()],
+                    )
+                except error.CircuitOpenError:
+                    raise
+                except Exception as e:
+                    print(f"브래킷 주문 요청 실패 (시도 {attempt + 1}/{max_retries}): {str(e)}")
+                    failed += [(j, str(e)) for j in chunk]
+                    continue
+                for order in orders:
+                    j = client_ids.pop(order["clientOrderId"], None)
+                    if j is None:
+                        continue
+                    if not order["id"]:
+                        print(f"브래킷 leg 실패 (시도 {attempt + 1}/{max_retries}): {legs[j]['type']} {order['info']}")
+                        failed.append((j, order["info"].get("errorMsg")))
+                    else:
+                        results[j] = order
+                # 응답에 없는 leg도 실패로 보고 다시 보낸다
+                failed += [(j, "응답 없음") for j in client_ids.values()]
+            invalidate_account(self.client)
+            pending = [j for j, _ in failed]
+            if pending and attempt < max_retries - 1:
+                time.sleep(retry_delay)
+        failed = rejected + failed
+        if not failed:
+            record_latency("bracket.BITGET", time.perf_counter() - started)
+            return results
+        print(f"브래킷 주문 실패: {failed}")
+        raise Exception(f"브래킷 주문 실패: {[message for _, message in failed]}")
+
     def market_entry(self, order_info: MarketOrder):
         from exchange.pexchange import retry
 
@@ -191,23 +386,71 @@ class Bitget:
             params = {"side": new_side}
         elif self.position_mode == "hedge":
             params = {}
+        tp_data = [
+            (order_info.use_tp1, order_info.tp1_price, order_info.tp1_qty_percent),
+            (order_info.use_tp2, order_info.tp2_price, order_info.tp2_qty_percent),
+            (order_info.use_tp3, order_info.tp3_price, order_info.tp3_qty_percent),
+            (order_info.use_tp4, order_info.tp4_price, order_info.tp4_qty_percent),
+        ]
+        tp_percents = [tp_qty_percent if use_tp and tp_price else None for use_tp, tp_price, tp_qty_percent in tp_data]
+        sl_price = order_info.sl_price if order_info.use_sl else None
+        exit_side = "sell" if order_info.side == "buy" else "buy"
+
+        # SL은 진입 주문의 presetStopLossPrice로 같이 보낸다. 체결과 동시에 거래소가 손절 플랜 주문을 건다
+        rejected = []
+        attach = {}
+        if order_info.is_futures and sl_price:
+            try:
+                validate_order(self.client, symbol, "market", exit_side, abs(entry_amount), None, {"stopLossPrice": sl_price, "reduceOnly": True})
+                attach["stopLoss"] = {"triggerPrice": sl_price}
+            except (error.AmountError, error.PriceError) as e:
+                print(f"SL 필터 오류: {str(e)}")
+                rejected.append(str(e))
+        # 수량 계산과 주문 검증을 통과한 뒤에만 레버리지를 바꾼다
         if order_info.leverage is not None:
             self.set_leverage(order_info.leverage, symbol)
         try:
-            return retry(
+            started = time.perf_counter()
+            result = retry(
                 self.client.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
                 abs(entry_amount),
                 None,
-                params,
+                params | attach,
                 order_info=order_info,
                 max_attempts=5,
                 delay=0.1,
                 instance=self,
             )
 
+            # TP 분할은 체결 수량 기준 reduce-only 지정가로 batch-place-order 한 번에 보낸다
+            legs = []
+            if order_info.is_futures and any(tp_percents):
+                filled = filled_amount(fill_waiter.wait(self.client, result, symbol), abs(entry_amount))
+                quantizer = get_quantizer(self.client, symbol)
+                tp_amounts = quantizer.split(filled, tp_percents)
+                legs = [
+                    {
+                        "symbol": symbol,
+                        "type": "limit",
+                        "side": exit_side,
+                        "amount": tp_amount,
+                        "price": quantizer.round_price(tp_price),
+                        "params": {"reduceOnly": True},
+                    }
+                    for (_, tp_price, _), tp_amount in zip(tp_data, tp_amounts)
+                    if tp_amount > 0
+                ]
+                if legs:
+                    self.create_bracket_orders(symbol, legs)
+            if attach or legs:
+                record_latency("protected.BITGET", time.perf_counter() - started)
+            if rejected:
+                raise Exception(f"보호 주문 실패: {rejected}")
+            return result
+
         except Exception as e:
             raise error.OrderError(e, order_info)
 
@@ -3,6 +3,18 @@ from exchange.pexchange import ccxt
 from exchange.model import MarketOrder, OrderBase, LimitOrder, ChangeSLOrder
 import time
 import exchange.error as error
+from exchange.utility.account_state import cached_balance, cached_open_orders, cached_positions, get_account_state
+from exchange.utility.breaker import guarded
+from exchange.utility.singleflight import coalesced, invalidate_account
+from exchange.utility.metrics import record_latency
+from exchange.utility import settings
+from exchange.utility.ticker import cached_price
+from exchange.utility.orderbook import plan_market_order
+from exchange.utility.fills import fill_waiter, filled_amount
+from exchange.utility.prefetch import prefetch, submit
+from exchange.utility.batch import cancel_orders, gather
+from exchange.utility.filters import get_quantizer, validate_order
+from exchange.utility.leverage import leverage_cache
 from devtools import debug
 import time
 
@@ -17,6 +29,8 @@ class Bybit:
         )
         self.client.load_markets()
         self.order_info: MarketOrder = None
+        self.entry_orders: list[tuple[dict, float]] | None = None
+        self.entry_filled: float | None = None
         self.position_mode = "one-way"
 
     def load_time_difference(self):
@@ -48,13 +62,18 @@ class Bybit:
             self.client.options["defaultType"] = "spot"
 
     def get_ticker(self, symbol: str):
-        return self.client.fetch_ticker(symbol)
+        return coalesced(self.client, "market", self.client.fetch_ticker, symbol, probe_symbol=symbol)
 
     def get_price(self, symbol: str):
-        return self.get_ticker(symbol)["last"]
+        price = cached_price(self.client, symbol)
+        if price is None:
+            price = self.get_ticker(symbol)["last"]
+        return price
 
     def get_futures_position(self, symbol):
-        positions = self.client.fetch_positions(symbols=[symbol])
+        positions = cached_positions(self.client, symbol)
+        if positions is None:
+            positions = coalesced(self.client, "account", self.client.fetch_positions, symbols=[symbol])
         long_contracts = None
         short_contracts = None
         if positions:
@@ -77,18 +96,125 @@ class Bybit:
         else:
             raise error.PositionNoneError()
 
+    def get_position(self, symbol):
+        positions = cached_positions(self.client, symbol)
+        if positions is None:
+            positions = coalesced(self.client, "account", self.client.fetch_positions, [symbol])
+        for position in positions:
+            if position["symbol"] == symbol and position["contracts"]:
+                return position
+        return None
+
+    def is_stop_order(self, order):
+        # 조건부 주문 중 익절(TakeProfit/PartialTakeProfit)을 제외한 것
+        stop_order_type = (order["info"].get("stopOrderType") or "").lower()
+        return bool(order.get("stopPrice") or order.get("triggerPrice")) and "takeprofit" not in stop_order_type
+
+    def get_stop_orders(self, symbol):
+        open_orders = cached_open_orders(self.client, symbol)
+        if open_orders is None:
+            open_orders = coalesced(
+                self.client, "account", self.client.fetch_open_orders, symbol, None, None, {"stop": True}
+            )
+        return [order for order in open_orders if self.is_stop_order(order)]
+
+    def amend_order(self, order, symbol, price=None, stop_price=None, amount=None):
+        # POST /v5/order/amend. 지정가는 price, 조건부 주문은 triggerPrice를 그 자리에서 바꾼다
+        params = {"triggerPrice": stop_price} if stop_price is not None else {}
+        result = guarded(
+            self.client,
+            "order",
+            self.client.edit_order,
+            order["id"],
+            symbol,
+            order["type"] or "market",
+            order["side"],
+            amount,
+            price,
+            params,
+        )
+        invalidate_account(self.client)
+        return result
+
+    def cancel_orders(self, order_ids, symbol):
+        # POST /v5/order/cancel-batch, 요청당 최대 10건. 취소된 주문 목록을 돌려준다
+        result = cancel_orders(self.client, order_ids, symbol, 10)
+        invalidate_account(self.client)
+        return result["cancelled"]
+
+    def change_sl_order(self, order_info: ChangeSLOrder):
+        cancel_futures = []
+        started = time.perf_counter()
+        path = "local" if get_account_state(self.client).live else "rest"
+        try:
+            symbol = order_info.unified_symbol
+            position = self.get_position(symbol)
+            if not position:
+                print(f"No open position for {symbol}")
+                return None
+
+            stop_orders = self.get_stop_orders(symbol)
+            side = "sell" if position["side"] == "long" else "buy"
+            new_stop_price = position["entryPrice"]
+
+            # 기존 스톱 하나는 amend로 그 자리에서 옮기고, 남는 스톱만 한 번에 취소한다
+            if len(stop_orders) > 1:
+                cancel_futures.append(
+                    submit(self.cancel_orders, [order["id"] for order in stop_orders[1:]], symbol)
+                )
+            if stop_orders:
+                try:
+                    new_stop_order = self.amend_order(
+                        stop_orders[0], symbol, stop_price=new_stop_price, amount=position["contracts"]
+                    )
+                    print(f"Amended stop order to entry price: {new_stop_price}")
+                    return new_stop_order
+                except error.CircuitOpenError:
+                    raise
+                except Exception as amend_error:
+                    print(f"스톱 주문 수정 실패, 취소 후 재생성: {str(amend_error)}")
+                    cancel_futures.append(submit(self.cancel_orders, [stop_orders[0]["id"]], symbol))
+
+            new_stop_order = self.client.create_order(
+                symbol,
+                "market",
+                side,
+                position["contracts"],
+                None,
+                {"stopLossPrice": new_stop_price, "reduceOnly": True},
+            )
+            invalidate_account(self.client)
+            print(f"Created new stop order at entry price: {new_stop_price}")
+            return new_stop_order
+        except Exception as e:
+            print(f"Error in change_sl_order: {str(e)}")
+            raise
+        finally:
+            for cancel_future in cancel_futures:
+                try:
+                    print(f"Cancelled existing stop orders: {[order['id'] for order in cancel_future.result()]}")
+                except Exception as cancel_error:
+                    print(f"Error cancelling stop orders: {str(cancel_error)}")
+            record_latency(f"change_sl.BYBIT.{path}", time.perf_counter() - started)
+
     def get_balance(self, base: str):
         free_balance_by_base = None
         if self.order_info.is_entry or (
             self.order_info.is_spot
             and (self.order_info.is_buy or self.order_info.is_sell)
         ):
-            free_balance = (
-                self.client.fetch_free_balance()
-                if not self.order_info.is_total
-                else self.client.fetch_total_balance()
+            free_balance_by_base = cached_balance(
+                self.client, base, self.order_info.is_total
             )
-            free_balance_by_base = free_balance.get(base)
+            if free_balance_by_base is None:
+                free_balance = coalesced(
+                    self.client,
+                    "account",
+                    self.client.fetch_free_balance
+                    if not self.order_info.is_total
+                    else self.client.fetch_total_balance,
+                )
+                free_balance_by_base = free_balance.get(base)
 
         if free_balance_by_base is None or free_balance_by_base == 0:
             raise error.FreeAmountNoneError()
@@ -105,10 +231,12 @@ class Bybit:
                 result = order_info.amount
         elif order_info.percent is not None:
             if order_info.is_entry or (order_info.is_spot and order_info.is_buy):
-                free_quote = self.get_balance(order_info.quote)
-                cash = free_quote * (order_info.percent - 0.5) / 100
-                current_price = self.get_price(order_info.unified_symbol)
-                result = cash / current_price
+                data = prefetch(
+                    balance=(self.get_balance, order_info.quote),
+                    price=(self.get_price, order_info.unified_symbol),
+                )
+                cash = data["balance"] * (order_info.percent - 0.5) / 100
+                result = cash / data["price"]
             elif self.order_info.is_close:
                 if order_info.is_contract:
                     free_amount = self.get_futures_position(order_info.unified_symbol)
@@ -128,31 +256,29 @@ class Bybit:
         return result
 
     def set_leverage(self, leverage: float, symbol: str):
-        try:
-            self.client.set_leverage(leverage, symbol)
-        except Exception as e:
-            error = str(e)
-            if "leverage not modified" in error:
-                pass
-            else:
-                raise Exception(e)
-
-    def get_order_amount(self, order_id: str, order_info: MarketOrder):
-        order_amount = None
-        for i in range(8):
+        def set_leverage():
             try:
-                if order_info.is_futures:
-                    order_result = self.client.fetch_order(
-                        order_id, order_info.unified_symbol
-                    )
-                else:
-                    order_result = self.client.fetch_order(order_id)
-                order_amount = order_result["amount"]
-                break
+                self.client.set_leverage(leverage, symbol)
             except Exception as e:
-                print("...", e)
-                time.sleep(0.5)
-        return order_amount
+                error = str(e)
+                if "leverage not modified" in error:
+                    pass
+                else:
+                    raise Exception(e)
+
+        # buyLeverage/sellLeverage를 같이 설정하므로 롱/숏 공통
+        leverage_cache.ensure(self.client, symbol, leverage, set_leverage)
+
+    def get_order_amount(self, order_id: str, order_info: MarketOrder):
+        # 유저 스트림 체결 이벤트를 기다리고, 없으면 REST로 조회
+        order_result = fill_waiter.wait(
+            self.client,
+            {"id": order_id},
+            order_info.unified_symbol if order_info.is_futures else None,
+        )
+        if order_result is None:
+            return None
+        return order_result["amount"]
 
     def market_order(self, order_info: MarketOrder):
         from exchange.pexchange import retry
@@ -192,6 +318,71 @@ class Bybit:
         order_info.amount = sell_amount
         return self.market_order(order_info)
 
+    def send_orders(self, legs):
+        # create-batch는 inverse를 지원하지 않아서 inverse는 leg별로 동시에 보낸다
+        if not self.client.market(legs[0]["symbol"])["inverse"]:
+            return guarded(self.client, "order", self.client.create_orders, legs)
+
+        def send(leg):
+            return guarded(
+                self.client, "order", self.client.create_order,
+                leg["symbol"], leg["type"], leg["side"], leg["amount"], leg["price"], leg["params"],
+            )
+
+        orders = []
+        for leg, order, e in gather(send, legs):
+            if isinstance(e, error.CircuitOpenError):
+                raise e
+            orders.append(order if e is None else {"id": None, "info": {"msg": str(e)}})
+        return orders
+
+    def create_bracket_orders(self, symbol, legs):
+        # create-batch는 요청당 최대 10건. 응답은 leg별 성공/실패라서 실패한 leg만 다시 보낸다
+        max_retries = 5
+        retry_delay = 0.2
+        results = [None] * len(legs)
+        rejected = []
+        for j, leg in enumerate(legs):
+            try:
+                validate_order(self.client, leg["symbol"], leg["type"], leg["side"], leg["amount"], leg["price"], leg["params"])
+            except (error.AmountError, error.PriceError) as e:
+                print(f"브래킷 leg 필터 오류: {leg['type']} {str(e)}")
+                rejected.append((j, str(e)))
+        pending = [j for j in range(len(legs)) if j not in dict(rejected)]
+        started = time.perf_counter()
+        failed = []
+        for attempt in range(max_retries):
+            if not pending:
+                break
+            failed = []
+            for i in range(0, len(pending), 10):
+                chunk = pending[i : i + 10]
+                try:
+                    orders = self.send_orders([legs[j] for j in chunk])
+                except error.CircuitOpenError:
+                    raise
+                except Exception as e:
+                    print(f"브래킷 주문 요청 실패 (시도 {attempt + 1}/{max_retries}): {str(e)}")
+                    failed += [(j, str(e)) for j in chunk]
+                    continue
+                for j, order in zip(chunk, orders):
+                    # 실패한 leg는 orderId가 빈 문자열로 온다
+                    if not order["id"]:
+                        print(f"브래킷 leg 실패 (시도 {attempt + 1}/{max_retries}): {legs[j]['type']} {order['info']}")
+                        failed.append((j, order["info"].get("msg")))
+                    else:
+                        results[j] = order
+            invalidate_account(self.client)
+            pending = [j for j, _ in failed]
+            if pending and attempt < max_retries - 1:
+                time.sleep(retry_delay)
+        failed = rejected + failed
+        if not failed:
+            record_latency("bracket.BYBIT", time.perf_counter() - started)
+            return results
+        print(f"브래킷 주문 실패: {failed}")
+        raise Exception(f"브래킷 주문 실패: {[message for _, message in failed]}")
+
     def market_entry(self, order_info: MarketOrder):
         from exchange.pexchange import retry
 
@@ -219,24 +410,118 @@ class Bybit:
                     position_idx = 1
                     params = {"reduceOnly": True, "position_idx": position_idx}
 
+        # 로컬 호가 기준 예상 슬리피지가 크면 수량을 줄이거나 나눈다
+        slices = plan_market_order(self.client, symbol, order_info.side, abs(entry_amount))
+        tp_data = [
+            (order_info.use_tp1, order_info.tp1_price, order_info.tp1_qty_percent),
+            (order_info.use_tp2, order_info.tp2_price, order_info.tp2_qty_percent),
+            (order_info.use_tp3, order_info.tp3_price, order_info.tp3_qty_percent),
+            (order_info.use_tp4, order_info.tp4_price, order_info.tp4_qty_percent),
+        ]
+        tp_percents = [tp_qty_percent if use_tp and tp_price else None for use_tp, tp_price, tp_qty_percent in tp_data]
+        tp_prices = [tp_price for _, tp_price, _ in tp_data]
+        sl_price = order_info.sl_price if order_info.use_sl else None
+        exit_side = "sell" if order_info.side == "buy" else "buy"
+        quantizer = get_quantizer(self.client, symbol)
+
+        # SL과 (전체 수량 TP 하나면) TP를 Partial 모드 TP/SL로 진입 주문에 같이 보낸다.
+        # Partial 모드는 주문 수량만큼 걸려서 진입을 나눠 보내도 조각마다 맞는 수량이 걸린다
+        rejected = []
+        attach = {}
+        tp_legs = [
+            (tp_amount, tp_price)
+            for tp_amount, tp_price in zip(quantizer.split(sum(slices), tp_percents), tp_prices)
+            if tp_amount > 0
+        ]
+        if sl_price:
+            try:
+                validate_order(self.client, symbol, "market", exit_side, sum(slices), None, {"stopLossPrice": sl_price, "reduceOnly": True})
+                attach |= {"stopLoss": sl_price}
+            except (error.AmountError, error.PriceError) as e:
+                print(f"SL 필터 오류: {str(e)}")
+                rejected.append(str(e))
+        if len(tp_legs) == 1 and tp_legs[0][0] >= quantizer.truncate(sum(slices)):
+            tp_amount, tp_price = tp_legs.pop()
+            try:
+                validate_order(self.client, symbol, "limit", exit_side, tp_amount, tp_price, {"reduceOnly": True})
+                attach |= {"takeProfit": {"triggerPrice": tp_price, "price": tp_price}}
+            except (error.AmountError, error.PriceError) as e:
+                print(f"TP 필터 오류: {str(e)}")
+                rejected.append(str(e))
+        if attach:
+            attach["tpslMode"] = "Partial"
+
+        # 수량 계산과 슬리피지 검사를 통과한 뒤에만 레버리지를 바꾼다
         if order_info.leverage is not None:
             self.set_leverage(order_info.leverage, symbol)
+        # 포지션 모드 에러로 재시도하면 retry가 이 dict의 position_idx만 고친다 (attach는 유지)
+        entry_params = params | attach
         try:
+            started = time.perf_counter()
             result = retry(
                 self.client.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
-                abs(entry_amount),
+                slices[0],
                 None,
-                params,
+                entry_params,
                 order_info=order_info,
                 max_attempts=5,
                 delay=0.1,
                 instance=self,
             )
+            entry_orders = [result]
+            for amount in slices[1:]:
+                # 나머지 조각은 호가가 다시 채워질 시간을 두고 보낸다
+                time.sleep(settings.SLIPPAGE_SPLIT_INTERVAL)
+                entry_orders.append(retry(
+                    self.client.create_order,
+                    symbol,
+                    order_info.type.lower(),
+                    order_info.side,
+                    amount,
+                    None,
+                    entry_params,
+                    order_info=order_info,
+                    max_attempts=5,
+                    delay=0.1,
+                    instance=self,
+                ))
+            # 헷지처럼 전체 진입 수량이 필요한 호출자가 모든 조각의 체결을 합산할 수 있게 남긴다
+            # 여기서 체결을 이미 확인했으면 entry_filled에 합계를 남겨서 호출자가 다시 기다리지 않는다
+            self.entry_orders = list(zip(entry_orders, slices))
+            self.entry_filled = None
             # order_amount = self.get_order_amount(result["id"], order_info)
             # result["amount"] = order_amount
+
+            # 나머지 TP 분할은 체결 수량 기준 reduce-only 지정가로 한 번에 보낸다
+            if tp_legs:
+                filled = sum(
+                    filled_amount(fill_waiter.wait(self.client, order, symbol), amount)
+                    for order, amount in zip(entry_orders, slices)
+                )
+                self.entry_filled = filled
+                tp_amounts = quantizer.split(filled, tp_percents)
+                legs = [
+                    {
+                        "symbol": symbol,
+                        "type": "limit",
+                        "side": exit_side,
+                        "amount": tp_amount,
+                        "price": tp_price,
+                        # 성공한 진입 주문에 실제로 쓴 position_idx
+                        "params": {"reduceOnly": True, "position_idx": entry_params["position_idx"]},
+                    }
+                    for tp_amount, tp_price in zip(tp_amounts, tp_prices)
+                    if tp_amount > 0
+                ]
+                if legs:
+                    self.create_bracket_orders(symbol, legs)
+            if attach or tp_legs:
+                record_latency("protected.BYBIT", time.perf_counter() - started)
+            if rejected:
+                raise Exception(f"보호 주문 실패: {rejected}")
             return result
         except Exception as e:
             raise error.OrderError(e, order_info)
@@ -1,4 +1,5 @@
 import sqlite3
+import threading
 import traceback
 import os
 from pathlib import Path
@@ -16,28 +17,34 @@ class Database:
         cls = type(self)
         if not hasattr(cls, "_init"):
             self.database_url = database_url
-            self.con = sqlite3.connect(self.database_url)
+            # 커넥션 하나를 여러 스레드(keep-warm, 주문 스레드)에서 같이 쓰므로 lock으로 한 번에 하나씩 실행
+            self.con = sqlite3.connect(self.database_url, check_same_thread=False)
             self.cursor = self.con.cursor()
+            self.lock = threading.Lock()
             cls._init = True
 
     def close(self):
         self.con.close()
 
     def excute(self, query: str, value: dict | tuple):
-        self.cursor.execute(query, value)
-        self.con.commit()
+        with self.lock:
+            self.cursor.execute(query, value)
+            self.con.commit()
 
     def excute_many(self, query: str, values: list[dict | tuple]):
-        self.cursor.executemany(query, values)
-        self.con.commit()
+        with self.lock:
+            self.cursor.executemany(query, values)
+            self.con.commit()
 
     def fetch_one(self, query: str, value: dict | tuple):
-        self.cursor.execute(query, value)
-        return self.cursor.fetchone()
+        with self.lock:
+            self.cursor.execute(query, value)
+            return self.cursor.fetchone()
 
     def fetch_all(self, query: str, value: dict | tuple):
-        self.cursor.execute(query, value)
-        return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute(query, value)
+            return self.cursor.fetchall()
 
     def set_auth(self, exchange, access_token, access_token_token_expired):
         query = """
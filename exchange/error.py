@@ -31,6 +31,35 @@ class MinAmountError(AmountError):
         super().__init__(msg, *args, **kwargs)
 
 
+class SlippageError(AmountError):
+    def __init__(self, slippage, max_slippage, *args, **kwargs):
+        msg = f"예상 슬리피지 {slippage:.3f}%가 허용치 {max_slippage}%를 넘어 주문할 수 있는 수량이 없습니다"
+        super().__init__(msg, *args, **kwargs)
+
+
+class MaxAmountError(AmountError):
+    def __init__(self, amount, max_amount, *args, **kwargs):
+        msg = f"주문 수량 {amount}이 최대 거래 수량 {max_amount}을 넘었습니다!"
+        super().__init__(msg, *args, **kwargs)
+
+
+class MinNotionalError(AmountError):
+    def __init__(self, cost, min_cost, *args, **kwargs):
+        msg = f"주문 금액 {cost:.4f}이 최소 주문 금액 {min_cost}보다 작습니다!"
+        super().__init__(msg, *args, **kwargs)
+
+
+class PriceError(Exception):
+    def __init__(self, msg="", *args, **kwargs):
+        super().__init__(f"[가격 오류]\n{msg}", *args, **kwargs)
+
+
+class PriceRangeError(PriceError):
+    def __init__(self, price, min_price, max_price, *args, **kwargs):
+        msg = f"주문 가격 {price}이 허용 범위({min_price} ~ {max_price})를 벗어났습니다!"
+        super().__init__(msg, *args, **kwargs)
+
+
 class PositionError(Exception):
     def __init__(self, msg="", *args, **kwargs):
         super().__init__(f"[포지션 오류]\n{msg}", *args, **kwargs)
@@ -85,3 +114,9 @@ class OrderError(Exception):
                 side = "매도"
 
         super().__init__(f"[{side} 주문 오류]\n{msg}", *args, **kwargs)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name="", *args, **kwargs):
+        msg = f"[서킷 브레이커]\n{name} 거래소 장애가 감지되어 요청을 차단했습니다"
+        super().__init__(msg, *args, **kwargs)
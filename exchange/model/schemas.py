@@ -121,6 +121,27 @@ class Settings(BaseSettings):
     KIS4_SECRET: str | None = None
     DB_ID: str = "poa@admin.com"
     DB_PASSWORD: str = "poabot!@#$"
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    BREAKER_RESET_TIMEOUT: float = 30.0
+    READ_CACHE_TTL: float = 0.0
+    LEVERAGE_CACHE_TTL: float = 60.0
+    USER_STREAM: bool = True
+    BINANCE_STREAM_MARKETS: list[Literal["spot", "swap", "delivery"]] = ["swap"]
+    TICKER_STREAM: bool = True
+    TICKER_MAX_AGE: float = 5.0
+    TICKER_SYMBOLS: list[str] = []
+    DEPTH_SYMBOLS: list[str] = []
+    MAX_SLIPPAGE: float | None = None
+    SLIPPAGE_ACTION: Literal["cap", "split"] = "cap"
+    SLIPPAGE_MAX_SLICES: int = 5
+    SLIPPAGE_SPLIT_INTERVAL: float = 0.5
+    FILL_TIMEOUT: float = 2.0
+    ORDER_WS: bool = False
+    ORDER_WS_TIMEOUT: float = 3.0
+    KEEP_WARM_INTERVAL: float | None = 30.0
+    DNS_CACHE_TTL: float | None = 300.0
+    FEE_SYMBOLS: list[str] = []
+    FEE_REFRESH_INTERVAL: float = 6 * 60 * 60
 
     class Config:
         env_file = env_path  # ".env"
@@ -4,6 +4,18 @@ from devtools import debug
 
 from exchange.model import MarketOrder, OrderBase, LimitOrder, ChangeSLOrder
 import exchange.error as error
+from exchange.utility.account_state import cached_balance, cached_open_orders, cached_positions, get_account_state
+from exchange.utility.breaker import guarded
+from exchange.utility.singleflight import coalesced, invalidate_account
+from exchange.utility.metrics import record_latency
+from exchange.utility.ticker import cached_price
+from exchange.utility.prefetch import prefetch, submit
+from exchange.utility.batch import cancel_orders
+from exchange.utility.filters import get_quantizer, validate_order
+from exchange.utility.leverage import leverage_cache
+from exchange.utility.fees import fee_cache
+from exchange.utility.fills import fill_waiter, filled_amount
+from exchange.utility import order_ws
 from decimal import Decimal
 import time
 
@@ -57,10 +69,13 @@ class Okx:
             return f"{base}/{quote}"
 
     def get_ticker(self, symbol: str):
-        return self.client.fetch_ticker(symbol)
+        return coalesced(self.client, "market", self.client.fetch_ticker, symbol, probe_symbol=symbol)
 
     def get_price(self, symbol: str):
-        return self.get_ticker(symbol)["last"]
+        price = cached_price(self.client, symbol)
+        if price is None:
+            price = self.get_ticker(symbol)["last"]
+        return price
 
     def get_balance(self, base: str):
         free_balance_by_base = None
@@ -68,12 +83,18 @@ class Okx:
             self.order_info.is_spot
             and (self.order_info.is_buy or self.order_info.is_sell)
         ):
-            free_balance = (
-                self.client.fetch_free_balance()
-                if not self.order_info.is_total
-                else self.client.fetch_total_balance()
+            free_balance_by_base = cached_balance(
+                self.client, base, self.order_info.is_total
             )
-            free_balance_by_base = free_balance.get(base)
+            if free_balance_by_base is None:
+                free_balance = coalesced(
+                    self.client,
+                    "account",
+                    self.client.fetch_free_balance
+                    if not self.order_info.is_total
+                    else self.client.fetch_total_balance,
+                )
+                free_balance_by_base = free_balance.get(base)
 
         if free_balance_by_base is None or free_balance_by_base == 0:
             raise error.FreeAmountNoneError()
@@ -89,7 +110,9 @@ class Okx:
             ]
             return positions
 
-        positions = self.client.fetch_positions([symbol])
+        positions = cached_positions(self.client, symbol)
+        if positions is None:
+            positions = coalesced(self.client, "account", self.client.fetch_positions, [symbol])
         long_contracts = None
         short_contracts = None
         if positions:
@@ -138,9 +161,12 @@ class Okx:
                     else:
                         result = free_base * order_info.percent / 100
                 else:
-                    free_quote = self.get_balance(order_info.quote)
+                    data = prefetch(
+                        balance=(self.get_balance, order_info.quote),
+                        price=(self.get_price, order_info.unified_symbol),
+                    )
+                    free_quote, current_price = data["balance"], data["price"]
                     cash = free_quote * (order_info.percent - 0.5) / 100
-                    current_price = self.get_price(order_info.unified_symbol)
                     if order_info.is_contract:
                         result = (cash / current_price) // order_info.contract_size
                     else:
@@ -176,7 +202,7 @@ class Okx:
 
         try:
             return retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -192,19 +218,43 @@ class Okx:
             raise error.OrderError(e, self.order_info)
 
     def get_position(self, symbol):
-        positions = self.client.fetch_positions([symbol])
+        positions = cached_positions(self.client, symbol)
+        if positions is None:
+            positions = coalesced(self.client, "account", self.client.fetch_positions, [symbol])
         for position in positions:
             if position['symbol'] == symbol:
                 return position
         return None
 
     def get_stop_orders(self, symbol):
-        open_orders = self.client.fetch_open_orders(symbol)
+        open_orders = cached_open_orders(self.client, symbol)
+        if open_orders is None:
+            open_orders = coalesced(self.client, "account", self.client.fetch_open_orders, symbol)
         return [order for order in open_orders if order['type'].lower() == 'stop']
 
     def cancel_order(self, order_id, symbol):
         return self.client.cancel_order(order_id, symbol)
 
+    def amend_stop_order(self, order, symbol, stop_price, amount=None):
+        # POST /api/v5/trade/amend-algos. trigger 주문은 newTriggerPx, TP/SL(conditional/oco)은 newSlTriggerPx
+        request = {"instId": self.client.market(symbol)["id"], "algoId": order["id"]}
+        stop_price = self.client.price_to_precision(symbol, stop_price)
+        if order["info"].get("ordType", "trigger") == "trigger":
+            request |= {"newTriggerPx": stop_price, "newOrdPx": "-1"}
+        else:
+            request |= {"newSlTriggerPx": stop_price, "newSlOrdPx": "-1"}
+        if amount is not None:
+            request["newSz"] = self.client.amount_to_precision(symbol, amount)
+        response = guarded(self.client, "order", self.client.privatePostTradeAmendAlgos, request)
+        invalidate_account(self.client)
+        return {"id": order["id"], "symbol": symbol, "stopPrice": float(stop_price), "info": response}
+
+    def cancel_stop_orders(self, order_ids, symbol):
+        # cancel-algos는 요청당 최대 10건. 취소된 주문 목록을 돌려준다
+        result = cancel_orders(self.client, order_ids, symbol, 10, {"trigger": True})
+        invalidate_account(self.client)
+        return result["cancelled"]
+
     def create_stop_order(self, symbol, side, amount, price):
         return self.client.create_order(
             symbol=symbol,
@@ -216,26 +266,43 @@ class Okx:
         )
 
     def change_sl_order(self, order_info: ChangeSLOrder):
+        cancel_futures = []
+        started = time.perf_counter()
+        path = "local" if get_account_state(self.client).live else "rest"
         try:
-            symbol = self.order_info.unified_symbol
+            symbol = order_info.unified_symbol
+            # 유저 스트림이 살아있으면 포지션/스톱 주문은 로컬 상태에서 바로 읽는다
             position = self.get_position(symbol)
-            if not position or position['amount'] == 0:
+            if not position or not position['contracts']:
                 print(f"No open position for {symbol}")
                 return None
             
             stop_orders = self.get_stop_orders(symbol)
-            
-            for order in stop_orders:
-                self.cancel_order(order['id'], symbol)
-                print(f"Cancelled existing stop order: {order['id']}")
-                
-            side = 'sell' if position['amount'] > 0 else 'buy'
+            side = 'sell' if position['side'] == 'long' else 'buy'
             new_stop_price = position['entryPrice']
-            
+
+            # 기존 스톱 하나는 amend-algos로 그 자리에서 옮기고, 남는 스톱만 한 번에 취소한다
+            if len(stop_orders) > 1:
+                cancel_futures.append(
+                    submit(self.cancel_stop_orders, [order['id'] for order in stop_orders[1:]], symbol)
+                )
+            if stop_orders:
+                try:
+                    new_stop_order = self.amend_stop_order(
+                        stop_orders[0], symbol, new_stop_price, position['contracts']
+                    )
+                    print(f"Amended stop order to entry price: {new_stop_price}")
+                    return new_stop_order
+                except error.CircuitOpenError:
+                    raise
+                except Exception as amend_error:
+                    print(f"스톱 주문 수정 실패, 취소 후 재생성: {str(amend_error)}")
+                    cancel_futures.append(submit(self.cancel_stop_orders, [stop_orders[0]['id']], symbol))
+
             new_stop_order = self.create_stop_order(
                 symbol,
                 side,
-                position['amount'],
+                position['contracts'],
                 new_stop_price
             )
             
@@ -245,11 +312,19 @@ class Okx:
         except Exception as e:
             print(f"Error in change_sl_order: {str(e)}")
             raise
+        finally:
+            for cancel_future in cancel_futures:
+                try:
+                    print(f"Cancelled existing stop orders: {[order['id'] for order in cancel_future.result()]}")
+                except Exception as cancel_error:
+                    print(f"Error cancelling stop orders: {str(cancel_error)}")
+            record_latency(f"change_sl.OKX.{path}", time.perf_counter() - started)
     
     
     def create_sl_order_with_retry(self, symbol, sl_side, entry_amount, sl_price, params):
         max_retries = 5
         retry_delay = 0.2
+        validate_order(self.client, symbol, 'stop_market', sl_side, entry_amount, None, {'stopPrice': sl_price, 'reduceOnly': True})
 
         for attempt in range(max_retries):
             try:
@@ -275,6 +350,90 @@ class Okx:
 
         return None 
 
+    def has_attached_algo(self, symbol, order_id) -> bool | None:
+        # 접수된 주문에 attachAlgoOrds(SL/TP)가 붙었는지. 조회에 실패하면 None
+        try:
+            order = guarded(self.client, "account", self.client.fetch_order, order_id, symbol, probe_symbol=symbol)
+        except Exception as e:
+            print(f"첨부 SL/TP 확인 실패: {str(e)}")
+            return None
+        info = order.get("info", {})
+        return bool(info.get("attachAlgoOrds") or info.get("slTriggerPx") or info.get("tpTriggerPx"))
+
+    def place_detached_protection(self, symbol, exit_side, amount, sl_price=None, tp=None) -> list[str]:
+        # 첨부(attachAlgoOrds)가 빠진 진입에 SL/TP를 따로 건다. 실패한 것만 돌려준다
+        rejected = []
+        if sl_price:
+            try:
+                self.create_sl_order_with_retry(symbol, exit_side, amount, sl_price, {})
+            except Exception as e:
+                rejected.append(f"SL: {str(e)}")
+        if tp is not None:
+            tp_amount, tp_price = tp
+            try:
+                self.create_bracket_orders(
+                    symbol,
+                    [
+                        {
+                            "symbol": symbol,
+                            "type": "limit",
+                            "side": exit_side,
+                            "amount": min(tp_amount, amount),
+                            "price": tp_price,
+                            "params": {"reduceOnly": True},
+                        }
+                    ],
+                )
+            except Exception as e:
+                rejected.append(f"TP: {str(e)}")
+        return rejected
+
+    def create_bracket_orders(self, symbol, legs):
+        # batch-orders는 요청당 최대 20건. 응답은 leg별 성공/실패라서 실패한 leg만 다시 보낸다
+        max_retries = 5
+        retry_delay = 0.2
+        results = [None] * len(legs)
+        rejected = []
+        for j, leg in enumerate(legs):
+            try:
+                validate_order(self.client, leg["symbol"], leg["type"], leg["side"], leg["amount"], leg["price"], leg["params"])
+            except (error.AmountError, error.PriceError) as e:
+                print(f"브래킷 leg 필터 오류: {leg['type']} {str(e)}")
+                rejected.append((j, str(e)))
+        pending = [j for j in range(len(legs)) if j not in dict(rejected)]
+        started = time.perf_counter()
+        failed = []
+        for attempt in range(max_retries):
+            if not pending:
+                break
+            failed = []
+            for i in range(0, len(pending), 20):
+                chunk = pending[i : i + 20]
+                try:
+                    orders = order_ws.create_orders(self.client, [legs[j] for j in chunk])
+                except error.CircuitOpenError:
+                    raise
+                except Exception as e:
+                    print(f"브래킷 주문 요청 실패 (시도 {attempt + 1}/{max_retries}): {str(e)}")
+                    failed += [(j, str(e)) for j in chunk]
+                    continue
+                for j, order in zip(chunk, orders):
+                    if order["id"] is None:
+                        print(f"브래킷 leg 실패 (시도 {attempt + 1}/{max_retries}): {legs[j]['type']} {order['info']}")
+                        failed.append((j, order["info"].get("sMsg") or order["info"].get("msg")))
+                    else:
+                        results[j] = order
+            invalidate_account(self.client)
+            pending = [j for j, _ in failed]
+            if pending and attempt < max_retries - 1:
+                time.sleep(retry_delay)
+        failed = rejected + failed
+        if not failed:
+            record_latency("bracket.OKX", time.perf_counter() - started)
+            return results
+        print(f"브래킷 주문 실패: {failed}")
+        raise Exception(f"브래킷 주문 실패: {[message for _, message in failed]}")
+
     def limit_entry(self, order_info: LimitOrder):
         from exchange.pexchange import retry
         symbol = order_info.unified_symbol
@@ -289,7 +448,7 @@ class Okx:
         
         try:
             result = retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -311,10 +470,10 @@ class Okx:
     ):
         # 수량기반
         buy_amount = self.get_amount(order_info)
-        fee = self.client.fetch_trading_fee(self.order_info.unified_symbol)
+        taker = fee_cache.taker(self.client, self.order_info.unified_symbol)
         order_info.amount = buy_amount
         result = self.market_order(order_info)
-        order_info.amount = buy_amount * (1 - fee["taker"])
+        order_info.amount = buy_amount * (1 - taker)
         return result
 
     def market_sell(
@@ -325,13 +484,12 @@ class Okx:
         symbol = (
             order_info.unified_symbol
         )  # self.parse_symbol(order_info.base, order_info.quote)
-        fee = self.client.fetch_trading_fee(symbol)
         sell_amount = self.get_amount(order_info)
 
         if order_info.percent is not None:
             order_info.amount = sell_amount
         else:
-            order_info.amount = sell_amount * (1 - fee["taker"])
+            order_info.amount = sell_amount * (1 - fee_cache.taker(self.client, symbol))
 
         return self.market_order(order_info)
 
@@ -358,38 +516,50 @@ class Okx:
 
         return params
 
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        # ORDER_WS를 켜면 웹소켓 order 요청으로 보낸다. 연결이 없거나 algo 주문이면 REST
+        return order_ws.create_order(self.client, symbol, type, side, amount, price, params)
+
     def set_leverage(self, leverage, symbol):
-        if self.order_info.is_futures:
-            if self.order_info.is_futures and self.order_info.is_entry:
-                if self.order_info.is_buy:
-                    pos_side = "long"
-                elif self.order_info.is_sell:
-                    pos_side = "short"
-            try:
-                if (
-                    self.order_info.margin_mode is None
-                    or self.order_info.margin_mode == "isolated"
-                ):
-                    if self.position_mode == "hedge":
-                        self.client.set_leverage(
-                            leverage,
-                            symbol,
-                            params={"mgnMode": "isolated", "posSide": pos_side},
-                        )
-                    elif self.position_mode == "one-way":
-                        self.client.set_leverage(
-                            leverage,
-                            symbol,
-                            params={"mgnMode": "isolated", "posSide": "net"},
-                        )
-                else:
-                    self.client.set_leverage(
-                        leverage,
-                        symbol,
-                        params={"mgnMode": self.order_info.margin_mode},
-                    )
-            except Exception as e:
-                pass
+        if not self.order_info.is_futures:
+            return
+        pos_side = None
+        if self.order_info.is_entry:
+            if self.order_info.is_buy:
+                pos_side = "long"
+            elif self.order_info.is_sell:
+                pos_side = "short"
+        # 격리 + 헤지 모드만 방향별 레버리지, 나머지는 심볼 단위
+        if (
+            self.order_info.margin_mode is None
+            or self.order_info.margin_mode == "isolated"
+        ):
+            margin_mode = "isolated"
+            if self.position_mode == "hedge":
+                if pos_side is None:
+                    return
+                params = {"mgnMode": "isolated", "posSide": pos_side}
+            elif self.position_mode == "one-way":
+                pos_side = None
+                params = {"mgnMode": "isolated", "posSide": "net"}
+            else:
+                return
+        else:
+            margin_mode = self.order_info.margin_mode
+            pos_side = None
+            params = {"mgnMode": margin_mode}
+        try:
+            leverage_cache.ensure(
+                self.client,
+                symbol,
+                leverage,
+                lambda: self.client.set_leverage(leverage, symbol, params=params),
+                side=pos_side,
+                margin_mode=margin_mode,
+            )
+        except Exception as e:
+            # 레버리지 설정 실패로 진입을 막지는 않는다
+            print(f"OKX {symbol} 레버리지 설정 실패 ({params}): {str(e)}")
 
     def market_entry(
         self,
@@ -436,10 +606,6 @@ class Okx:
             raise error.MinAmountError()
 
         params = {}
-        if order_info.leverage is None:
-            self.set_leverage(1, symbol)
-        else:
-            self.set_leverage(order_info.leverage, symbol)
         if order_info.margin_mode is None:
             params |= {"tdMode": "isolated"}
         else:
@@ -459,11 +625,52 @@ class Okx:
                 elif order_info.is_close:
                     pos_side = "long"
             params |= {"posSide": pos_side}
+        # 수량 계산을 통과한 뒤에만 레버리지를 바꾼다
+        self.set_leverage(1 if order_info.leverage is None else order_info.leverage, symbol)
 
         try:
-            # 메인 주문 생성
+            # TP 수량은 계약 수량 단위로 나눠 합계가 진입 수량과 같다
+            quantizer = get_quantizer(self.client, symbol)
+            tp_amounts = quantizer.split(
+                abs(entry_amount),
+                [tp_qty_percent if use_tp and tp_price else None for use_tp, tp_price, tp_qty_percent in tp_data],
+            )
+            exit_side = "sell" if order_info.side == "buy" else "buy"
+            tp_legs = [
+                (tp_amount, tp_price)
+                for (use_tp, tp_price, tp_qty_percent), tp_amount in zip(tp_data, tp_amounts)
+                if use_tp and tp_price and tp_amount > 0
+            ]
+
+            # SL과 (전체 수량 TP 하나면) TP를 attachAlgoOrds로 진입 주문에 같이 보낸다.
+            # 체결과 동시에 거래소가 걸어주므로 체결 후 보호 주문이 없는 구간이 없다
+            rejected = []
+            attach = {}
+            attached_sl = attached_tp = None
+            if sl_price:
+                try:
+                    validate_order(self.client, symbol, "market", exit_side, abs(entry_amount), None, {"stopLossPrice": sl_price, "reduceOnly": True})
+                    attached_sl = sl_price
+                    attach |= {"slTriggerPx": self.client.price_to_precision(symbol, sl_price), "slOrdPx": "-1"}
+                except (error.AmountError, error.PriceError) as e:
+                    print(f"SL 필터 오류: {str(e)}")
+                    rejected.append(str(e))
+            if len(tp_legs) == 1 and tp_legs[0][0] >= quantizer.truncate(abs(entry_amount)):
+                tp_amount, tp_price = tp_legs.pop()
+                try:
+                    validate_order(self.client, symbol, "limit", exit_side, tp_amount, tp_price, {"reduceOnly": True})
+                    attached_tp = (tp_amount, tp_price)
+                    attach |= {"tpOrdKind": "limit", "tpOrdPx": self.client.price_to_precision(symbol, tp_price)}
+                except (error.AmountError, error.PriceError) as e:
+                    print(f"TP 필터 오류: {str(e)}")
+                    rejected.append(str(e))
+            if attach:
+                params |= {"attachAlgoOrds": [attach]}
+
+            # 메인 주문 생성. 포지션 모드 에러로 재시도하면 retry가 params의 posSide/tdMode만 고친다 (attach는 유지)
+            started = time.perf_counter()
             result = retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -475,51 +682,37 @@ class Okx:
                 delay=0.1,
                 instance=self,
             )
+            # 접수된 주문에 SL/TP가 실제로 붙었는지 나머지 TP를 보내는 동안 확인한다
+            attached_future = submit(self.has_attached_algo, symbol, result["id"]) if attach else None
 
-            # TP 주문 생성 (reduce-only)
-            for use_tp, tp_price, tp_qty_percent in tp_data:
-                if use_tp and tp_price and tp_qty_percent:
-                    tp_side = "sell" if order_info.side == "buy" else "buy"
-                    tp_amount = abs(entry_amount) * (tp_qty_percent / 100)
-                    tp_params = {
-                        "reduceOnly": True,
-                        #"tdMode": params["tdMode"]
-                    }
-                    retry(
-                        self.client.create_order,
+            # 나머지 TP 분할은 reduce-only 지정가로 한 번에 보낸다. 실패해도 아래 SL/TP 첨부 확인은 한다
+            if tp_legs:
+                try:
+                    self.create_bracket_orders(
                         symbol,
-                        "limit",
-                        tp_side,
-                        tp_amount,
-                        tp_price,
-                        tp_params,
-                        order_info=order_info,
-                        max_attempts=10,
-                        delay=0.1,
-                        instance=self,
+                        [
+                            {
+                                "symbol": symbol,
+                                "type": "limit",
+                                "side": exit_side,
+                                "amount": tp_amount,
+                                "price": tp_price,
+                                "params": {"reduceOnly": True},
+                            }
+                            for tp_amount, tp_price in tp_legs
+                        ],
                     )
-
-            # SL 주문 생성 (reduce-only)
-            if sl_price:
-                sl_side = "sell" if order_info.side == "buy" else "buy"
-                sl_params = {
-                    "reduceOnly": True,
-                    "tdMode": params["tdMode"],
-                    "stopLossPrice": sl_price
-                }
-                retry(
-                    self.client.create_order,
-                    symbol,
-                    "market",
-                    sl_side,
-                    abs(entry_amount),
-                    None,
-                    sl_params,
-                    order_info=order_info,
-                    max_attempts=10,
-                    delay=0.1,
-                    instance=self,
-                )
+                except Exception as e:
+                    rejected.append(str(e))
+            if attached_future is not None and attached_future.result() is False:
+                # 거래소가 첨부를 빼고 접수했다. 포지션이 보호 없이 남지 않도록 체결 수량으로 따로 건다
+                print("진입 주문에 SL/TP가 첨부되지 않아 따로 주문합니다")
+                filled = filled_amount(fill_waiter.wait(self.client, result, symbol), abs(entry_amount))
+                rejected += self.place_detached_protection(symbol, exit_side, filled, attached_sl, attached_tp)
+            if attach or tp_legs:
+                record_latency("protected.OKX", time.perf_counter() - started)
+            if rejected:
+                raise Exception(f"보호 주문 실패: {rejected}")
 
             return result
         except Exception as e:
@@ -564,7 +757,7 @@ class Okx:
 
         try:
             return retry(
-                self.client.create_order,
+                self.create_order,
                 symbol,
                 order_info.type.lower(),
                 order_info.side,
@@ -10,6 +10,10 @@ from .bitget import Bitget
 from .okx import Okx
 from .stock import KoreaInvestment
 from exchange.utility import settings, log_message
+from exchange.utility.breaker import get_breaker, make_probe
+from exchange.utility.singleflight import invalidate_account
+from exchange.utility.filters import validate_order
+import exchange.error as error
 from .database import db
 from typing import Literal, Union, Callable, TypeVar
 import pendulum
@@ -87,6 +91,34 @@ def get_bot(
         return get_exchange(exchange_name, kis_number)
 
 
+def get_stream_bots():
+    # 키가 설정된 거래소만 유저 스트림을 연다
+    settings_dict = settings.dict()
+    bots = []
+    for exchange_name in CRYPTO_EXCHANGES:
+        if settings_dict.get(f"{exchange_name}_KEY") and settings_dict.get(
+            f"{exchange_name}_SECRET"
+        ):
+            try:
+                bots.append(get_bot(exchange_name))
+            except Exception as e:
+                logger.error(f"{exchange_name} 봇 생성 실패: {e}")
+    return bots
+
+
+def get_warm_bots():
+    # 커넥션을 유지할 거래소 + 키가 설정된 KIS 계정
+    settings_dict = settings.dict()
+    bots = get_stream_bots()
+    for kis_number in (1, 2, 3, 4):
+        if settings_dict.get(f"KIS{kis_number}_KEY") and settings_dict.get(f"KIS{kis_number}_SECRET"):
+            try:
+                bots.append(get_bot("KRX", kis_number))
+            except Exception as e:
+                logger.error(f"KIS{kis_number} 봇 생성 실패: {e}")
+    return bots
+
+
 def check_key(exchange_name):
     settings_dict = settings.dict()
     if exchange_name in CRYPTO_EXCHANGES:
@@ -122,6 +154,16 @@ def get_today_timestamp(timezone="Asia/Seoul"):
 #OrderType = TypeVar('OrderType', MarketOrder, LimitOrder)
 
 
+def with_position_params(args: tuple, params: dict, keys: tuple) -> tuple:
+    # 포지션 모드 관련 키(keys)만 params로 바꾸고 SL/TP 첨부 등 나머지 파라미터는 유지한다
+    # 호출한 쪽이 넘긴 params를 그대로 고쳐서, 성공한 주문에 실제로 쓴 값을 호출한 쪽에서 다시 읽을 수 있다
+    order_params = args[5] if args[5] is not None else {}
+    for key in keys:
+        order_params.pop(key, None)
+    order_params.update(params)
+    return tuple(order_params if i == 5 else arg for i, arg in enumerate(args))
+
+
 def retry(
     func,
     *args,
@@ -132,15 +174,33 @@ def retry(
 ):
     attempts = 0
     print('오더 호출 4')
+    if instance is not None and func.__name__ == "create_order":
+        # 수량/가격 필터에 걸리는 주문은 보내지 않는다. 재시도해도 같은 이유로 거절되므로 바로 실패
+        validate_order(instance.client, *args, reduce_only=bool(order_info.is_close))
+    breaker = get_breaker(order_info.exchange, "order")
+    probe = (
+        make_probe(instance.client, order_info.unified_symbol)
+        if instance is not None
+        else None
+    )
+    if not breaker.allow(probe):
+        raise error.CircuitOpenError(breaker.name)
 
     while attempts < max_attempts:
         try:
             result = func(*args)  # 함수 실행
+            breaker.record_success()
+            if instance is not None:
+                invalidate_account(instance.client)
             print('오더 호출 5')
             return result
         except Exception as e:
             logger.error(f"에러 발생: {str(e)}")
             attempts += 1
+            breaker.record_failure(e)
+            if breaker.is_open:
+                # 거래소 장애로 판단되면 남은 재시도 없이 바로 실패
+                attempts = max_attempts
             if func.__name__ == "create_order":
                 if order_info.exchange in ("BINANCE"):
                     if "Internal error" in str(e):
@@ -167,8 +227,8 @@ def retry(
                             elif order_info.is_close:
                                 params = {"reduceOnly": True}
 
-                        args = tuple(
-                            params if i == 5 else arg for i, arg in enumerate(args)
+                        args = with_position_params(
+                            args, params, ("positionSide", "reduceOnly")
                         )
 
                     else:
@@ -205,8 +265,8 @@ def retry(
                             elif order_info.is_close:
                                 params = {"reduceOnly": True, "position_idx": 0}
 
-                        args = tuple(
-                            params if i == 5 else arg for i, arg in enumerate(args)
+                        args = with_position_params(
+                            args, params, ("position_idx", "positionIdx", "reduceOnly")
                         )
                     elif "check your server timestamp" in str(e):
                         bybit: Bybit = instance
@@ -258,8 +318,8 @@ def retry(
                             else:
                                 params |= {"tdMode": order_info.margin_mode}
 
-                        args = tuple(
-                            params if i == 5 else arg for i, arg in enumerate(args)
+                        args = with_position_params(
+                            args, params, ("posSide", "tdMode", "reduceOnly")
                         )
                     else:
                         attempts = max_attempts
@@ -273,9 +333,8 @@ def retry(
                                 new_side if i == 2 else arg
                                 for i, arg in enumerate(args)
                             )
-                            args = tuple(
-                                new_params if i == 5 else arg
-                                for i, arg in enumerate(args)
+                            args = with_position_params(
+                                args, new_params, ("side", "reduceOnly")
                             )
                         elif instance.position_mode == "one-way":
                             instance.position_mode = "hedge"
@@ -283,9 +342,8 @@ def retry(
                                 new_params = {}
                             elif order_info.is_close:
                                 new_params = {"reduceOnly": True}
-                            args = tuple(
-                                new_params if i == 5 else arg
-                                for i, arg in enumerate(args)
+                            args = with_position_params(
+                                args, new_params, ("side", "reduceOnly")
                             )
 
                     elif "two-way positions" in str(e):
@@ -297,9 +355,8 @@ def retry(
                                 new_side if i == 2 else arg
                                 for i, arg in enumerate(args)
                             )
-                            args = tuple(
-                                new_params if i == 5 else arg
-                                for i, arg in enumerate(args)
+                            args = with_position_params(
+                                args, new_params, ("side", "reduceOnly")
                             )
                         elif instance.position_mode == "one-way":
                             instance.position_mode = "hedge"
@@ -307,9 +364,8 @@ def retry(
                                 new_params = {}
                             elif order_info.is_close:
                                 new_params = {"reduceOnly": True}
-                            args = tuple(
-                                new_params if i == 5 else arg
-                                for i, arg in enumerate(args)
+                            args = with_position_params(
+                                args, new_params, ("side", "reduceOnly")
                             )
                     else:
                         attempts = max_attempts
@@ -2,6 +2,10 @@ from exchange.pexchange import ccxt, ccxt_async
 from exchange.database import db
 from exchange.model import MarketOrder
 import exchange.error as error
+from exchange.utility.singleflight import coalesced
+from exchange.utility.account_state import cached_balance
+from exchange.utility.fills import fill_waiter, filled_amount
+from exchange.utility.ticker import cached_price
 
 
 class Upbit:
@@ -28,13 +32,19 @@ class Upbit:
     # async def aclose(self):
     #     await self.spot_async.close()
     def get_ticker(self, symbol: str):
-        return self.client.fetch_ticker(symbol)
+        return coalesced(self.client, "market", self.client.fetch_ticker, symbol, probe_symbol=symbol)
 
     def get_price(self, symbol: str):
-        return self.get_ticker(symbol)["last"]
+        price = cached_price(self.client, symbol)
+        if price is None:
+            price = self.get_ticker(symbol)["last"]
+        return price
 
     def get_balance(self, base: str) -> float:
-        free_balance_by_base = (self.client.fetch_free_balance()).get(base)
+        # 유저 스트림(myAsset)이 살아있으면 로컬 잔고를 쓴다
+        free_balance_by_base = cached_balance(self.client, base)
+        if free_balance_by_base is None:
+            free_balance_by_base = coalesced(self.client, "account", self.client.fetch_free_balance).get(base)
         if free_balance_by_base is None or free_balance_by_base == 0:
             raise error.FreeAmountNoneError()
         else:
@@ -46,24 +56,28 @@ class Upbit:
         elif order_info.amount is not None:
             result = order_info.amount
         elif order_info.percent is not None:
-            if self.order_info.side in ("buy"):
-                free_quote = self.get_balance(order_info.quote)
-                cash = free_quote * order_info.percent / 100
-                current_price = self.get_price(order_info.unified_symbol)
-                result = cash / current_price
-            elif self.order_info.side in ("sell"):
-                free_amount = self.get_balance(order_info.base)
-                if free_amount is None:
-                    raise error.FreeAmountNoneError()
-                result = free_amount * order_info.percent / 100
+            free_amount = self.get_balance(order_info.base)
+            if free_amount is None:
+                raise error.FreeAmountNoneError()
+            result = free_amount * order_info.percent / 100
         else:
             raise error.AmountPercentNoneError()
         return result
 
-    def market_order(self, order_info: MarketOrder):
+    def get_cost(self, order_info: MarketOrder) -> float | None:
+        # 시장가 매수에 쓸 KRW 금액. 수량 주문이면 None
+        if order_info.amount is not None:
+            return None
+        if order_info.cost is not None:
+            return order_info.cost
+        if order_info.percent is not None:
+            return self.get_balance(order_info.quote) * order_info.percent / 100
+        return None
+
+    def market_order(self, order_info: MarketOrder, params: dict | None = None):
         from exchange.pexchange import retry
 
-        params = {}
+        params = params or {}
         try:
             return retry(
                 self.client.create_order,
@@ -81,11 +95,12 @@ class Upbit:
             raise error.OrderError(e, order_info)
 
     def market_buy(self, order_info: MarketOrder):
-        from exchange.pexchange import retry
-
-        # 비용주문
-        buy_amount = self.get_amount(order_info)
-        order_info.amount = buy_amount
+        # 비율/금액 주문은 금액 지정 시장가 매수(ord_type=price)로 보내서 가격 조회 없이 요청 한 번으로 끝난다
+        cost = self.get_cost(order_info)
+        if cost is not None:
+            return self.market_order(order_info, {"cost": cost})
+        # 수량 주문은 수량 * 현재가 금액으로 매수
+        order_info.amount = self.get_amount(order_info)
         order_info.price = self.get_price(order_info.unified_symbol)
         return self.market_order(order_info)
 
@@ -97,5 +112,9 @@ class Upbit:
     def get_order(self, order_id: str):
         return self.client.fetch_order(order_id)
 
-    def get_order_amount(self, order_id: str):
-        return self.get_order(order_id)["filled"]
+    def wait_order(self, order: dict, symbol: str | None = None) -> dict | None:
+        # 유저 스트림(myOrder) 체결 이벤트를 기다리고, 없으면 REST로 조회
+        return fill_waiter.wait(self.client, order, symbol)
+
+    def get_order_amount(self, order: dict, symbol: str | None = None):
+        return filled_amount(self.wait_order(order, symbol), order.get("amount") or 0.0)
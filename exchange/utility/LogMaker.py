@@ -82,6 +82,8 @@ def log_order_message(exchange_name, order_result: dict, order_info: MarketOrder
         elif order_info.percent is not None:
             f_name = "비율"
             amount = f"{order_info.percent}%"
+        else:
+            amount = str(order_result.get("cost") or order_info.cost)
 
     else:
         f_name = "수량"
@@ -183,7 +185,7 @@ def log_order_message(exchange_name, order_result: dict, order_info: MarketOrder
         log_message(content, embed)
 
 
-def log_hedge_message(exchange, base, quote, exchange_amount, upbit_amount, hedge):
+def log_hedge_message(exchange, base, quote, exchange_amount, upbit_amount, hedge, skew_ms=None):
     date = parse_time(datetime.utcnow().timestamp())
     hedge_type = "헷지" if hedge == "ON" else "헷지 종료"
     content = f"{hedge_type}: {base} ==> {exchange}:{exchange_amount} UPBIT:{upbit_amount}"
@@ -197,6 +199,8 @@ def log_hedge_message(exchange, base, quote, exchange_amount, upbit_amount, hedg
         value=f"{exchange}:{exchange_amount} UPBIT:{upbit_amount}",
         inline=False,
     )
+    if skew_ms is not None:
+        embed.add_field(name="주문 시차", value=f"{skew_ms}ms", inline=False)
     log_message(content, embed)
 
 
@@ -0,0 +1,560 @@
+import threading
+import time
+from typing import Callable
+
+from loguru import logger
+
+from exchange.utility.leverage import leverage_cache
+from exchange.utility.metrics import register_gauge
+
+OPEN_STATUSES = ("open",)
+
+BINANCE_ORDER_STATUS = {
+    "NEW": "open",
+    "PARTIALLY_FILLED": "open",
+    "FILLED": "closed",
+    "CANCELED": "canceled",
+    "EXPIRED": "canceled",
+    "EXPIRED_IN_MATCH": "canceled",
+    "REJECTED": "rejected",
+}
+
+BYBIT_ORDER_STATUS = {
+    "New": "open",
+    "PartiallyFilled": "open",
+    "Untriggered": "open",
+    "Filled": "closed",
+    "Triggered": "closed",
+    "Cancelled": "canceled",
+    "PartiallyFilledCanceled": "canceled",
+    "Deactivated": "canceled",
+    "Rejected": "rejected",
+}
+
+OKX_ORDER_STATUS = {
+    "live": "open",
+    "partially_filled": "open",
+    "effective": "closed",
+    "filled": "closed",
+    "canceled": "canceled",
+    "mmp_canceled": "canceled",
+    "order_failed": "rejected",
+}
+
+BITGET_ORDER_STATUS = {
+    "new": "open",
+    "init": "open",
+    "live": "open",
+    "not_trigger": "open",
+    "partially_filled": "open",
+    "partial-fill": "open",
+    "filled": "closed",
+    "full-fill": "closed",
+    "executed": "closed",
+    "triggered": "closed",
+    "canceled": "canceled",
+    "cancelled": "canceled",
+    "fail_trigger": "rejected",
+}
+
+UPBIT_ORDER_STATUS = {
+    "wait": "open",
+    "watch": "open",
+    "trade": "open",
+    "done": "closed",
+    "cancel": "canceled",
+}
+
+
+def to_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class AccountState:
+    # 거래소별 잔고/포지션/미체결 주문을 메모리에 유지. 프라이빗 웹소켓 이벤트로 갱신하고
+    # 재연결 시 REST로 다시 동기화한다
+    def __init__(self, exchange_name: str, market_type: str, client):
+        self.exchange_name = exchange_name
+        self.market_type = market_type
+        self.client = client
+        self.balances: dict[str, dict] = {}
+        self.positions: dict[tuple[str, str], dict] = {}
+        self.orders: dict[str, dict] = {}
+        self.live = False
+        self.synced = {"balance": False, "positions": False, "orders": False}
+        self.synced_at: float | None = None
+        self.updated_at: float | None = None
+        self.listeners: list[Callable[[dict], None]] = []
+        self._lock = threading.RLock()
+
+    # ------------------------------------------------------------------ 상태
+    def ready(self, section: str) -> bool:
+        return self.live and self.synced[section]
+
+    def set_live(self, live: bool):
+        with self._lock:
+            self.live = live
+            if not live:
+                # 끊긴 동안의 이벤트는 알 수 없으므로 재연결 후 resync 전까지 사용하지 않는다
+                self.synced = {key: False for key in self.synced}
+
+    def invalidate(self, section: str):
+        with self._lock:
+            self.synced[section] = False
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        self.listeners.append(listener)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "live": self.live,
+                "synced": dict(self.synced),
+                "balances": len(self.balances),
+                "positions": len(self.positions),
+                "orders": len(self.orders),
+                "updated_at": self.updated_at,
+            }
+
+    # ------------------------------------------------------------------ 조회
+    def get_balance(self, asset: str, total=False):
+        with self._lock:
+            balance = self.balances.get(asset)
+            if balance is None:
+                return None
+            return balance["total" if total else "free"]
+
+    def get_balances(self, total=False) -> dict:
+        key = "total" if total else "free"
+        with self._lock:
+            return {asset: balance[key] for asset, balance in self.balances.items()}
+
+    def get_positions(self, symbol: str | None = None) -> list[dict]:
+        with self._lock:
+            return [
+                dict(position)
+                for position in self.positions.values()
+                if symbol is None or position["symbol"] == symbol
+            ]
+
+    def get_open_orders(self, symbol: str | None = None) -> list[dict]:
+        with self._lock:
+            return [
+                dict(order)
+                for order in self.orders.values()
+                if symbol is None or order["symbol"] == symbol
+            ]
+
+    # ------------------------------------------------------------------ 갱신
+    def set_balance(self, asset: str, free: float, total: float):
+        with self._lock:
+            self.balances[asset] = {"free": free, "total": total}
+            self.updated_at = time.time()
+
+    def set_position(
+        self, symbol: str, side: str | None, contracts: float, entry_price, info=None, leverage=None, one_way=False, margin_mode=None
+    ):
+        if leverage is not None or margin_mode is not None:
+            # 단방향 모드는 롱/숏 설정이 같다
+            leverage_cache.update(self.exchange_name, self.client.apiKey, symbol, None if one_way else side, leverage, margin_mode)
+        with self._lock:
+            if one_way or side is None:
+                # 단방향 모드는 롱/숏이 같은 포지션이므로 반대쪽도 지운다
+                self.positions.pop((symbol, "long"), None)
+                self.positions.pop((symbol, "short"), None)
+            if not contracts or side is None:
+                self.positions.pop((symbol, side), None)
+            else:
+                self.positions[(symbol, side)] = {
+                    "symbol": symbol,
+                    "side": side,
+                    "contracts": abs(contracts),
+                    "entryPrice": entry_price,
+                    "leverage": leverage,
+                    "info": info or {},
+                }
+            self.updated_at = time.time()
+
+    def set_order(self, order: dict):
+        with self._lock:
+            if order["status"] in OPEN_STATUSES:
+                self.orders[order["id"]] = order
+            else:
+                self.orders.pop(order["id"], None)
+            self.updated_at = time.time()
+        for listener in self.listeners:
+            try:
+                listener(order)
+            except Exception as e:
+                logger.error(f"주문 이벤트 처리 에러: {e}")
+        for listener in order_listeners:
+            try:
+                listener(self, order)
+            except Exception as e:
+                logger.error(f"주문 이벤트 처리 에러: {e}")
+
+    def symbol(self, market_id: str) -> str:
+        return self.client.safe_symbol(market_id, None, None, self.market_type)
+
+    # ------------------------------------------------------------------ REST 동기화
+    def rest_params(self) -> dict:
+        # 업비트는 마켓 구분이 없고 모르는 파라미터도 그대로 쿼리로 보낸다
+        return {} if self.client.id == "upbit" else {"type": self.market_type}
+
+    def refresh_balance(self):
+        balance = self.client.fetch_balance(self.rest_params())
+        with self._lock:
+            self.balances = {
+                asset: {
+                    "free": to_float(balance["free"].get(asset)),
+                    "total": to_float(balance["total"].get(asset)),
+                }
+                for asset in balance.get("total", {})
+            }
+            self.synced["balance"] = True
+
+    def refresh_positions(self):
+        positions = self.client.fetch_positions(None, {"type": self.market_type})
+        leverage_cache.seed(self.client, positions)
+        with self._lock:
+            self.positions = {}
+            for position in positions:
+                if position.get("contracts") and position.get("side"):
+                    self.positions[(position["symbol"], position["side"])] = {
+                        "symbol": position["symbol"],
+                        "side": position["side"],
+                        "contracts": abs(position["contracts"]),
+                        "entryPrice": position.get("entryPrice"),
+                        "leverage": position.get("leverage"),
+                        "info": position.get("info", {}),
+                    }
+            self.synced["positions"] = True
+
+    def refresh_orders(self):
+        self.client.options["warnOnFetchOpenOrdersWithoutSymbol"] = False
+        orders = self.client.fetch_open_orders(None, None, None, self.rest_params())
+        with self._lock:
+            self.orders = {order["id"]: order for order in orders}
+            self.synced["orders"] = True
+
+    def resync(self):
+        sections = [("balance", self.refresh_balance), ("orders", self.refresh_orders)]
+        if self.market_type != "spot":
+            sections.append(("positions", self.refresh_positions))
+        for section, refresh in sections:
+            try:
+                refresh()
+            except Exception as e:
+                logger.error(f"{self.exchange_name} {section} 동기화 실패: {e}")
+        with self._lock:
+            self.synced_at = time.time()
+
+    # ------------------------------------------------------------------ 이벤트 파싱
+    def apply(self, message: dict):
+        handler = getattr(self, f"apply_{self.client.id}", None)
+        if handler is None:
+            return
+        try:
+            handler(message)
+        except Exception as e:
+            logger.error(f"{self.exchange_name} 계정 이벤트 파싱 에러: {e} {message}")
+
+    def apply_binance(self, message: dict):
+        event = message.get("e")
+        if event == "ACCOUNT_UPDATE":
+            data = message.get("a", {})
+            if data.get("B"):
+                # 선물 이벤트에는 주문가능 잔고가 없으므로 다음 조회 때 REST로 갱신
+                self.invalidate("balance")
+            for position in data.get("P", []):
+                amount = to_float(position.get("pa"))
+                position_side = position.get("ps")
+                if position_side == "LONG":
+                    side = "long"
+                elif position_side == "SHORT":
+                    side = "short"
+                else:
+                    side = "long" if amount > 0 else "short"
+                self.set_position(
+                    self.symbol(position["s"]),
+                    side,
+                    amount,
+                    to_float(position.get("ep")),
+                    {"positionAmt": position.get("pa"), "positionSide": position_side, "symbol": position["s"]},
+                    one_way=position_side == "BOTH",
+                    margin_mode=position.get("mt"),
+                )
+        elif event == "ACCOUNT_CONFIG_UPDATE" and "ac" in message:
+            # 레버리지 변경 이벤트. 바이낸스 레버리지는 심볼 단위
+            config = message["ac"]
+            leverage_cache.update(self.exchange_name, self.client.apiKey, self.symbol(config["s"]), None, config.get("l"))
+        elif event == "outboundAccountPosition":
+            for balance in message.get("B", []):
+                free = to_float(balance.get("f"))
+                self.set_balance(balance["a"], free, free + to_float(balance.get("l")))
+        elif event in ("ORDER_TRADE_UPDATE", "executionReport"):
+            order = message.get("o", message)
+            stop_price = to_float(order.get("sp", order.get("P")), None)
+            self.set_order(
+                {
+                    "id": str(order["i"]),
+                    "clientOrderId": order.get("c"),
+                    "symbol": self.symbol(order["s"]),
+                    "type": order.get("o", "").lower(),
+                    "side": order.get("S", "").lower(),
+                    "amount": to_float(order.get("q")),
+                    "price": to_float(order.get("p"), None),
+                    "stopPrice": stop_price or None,
+                    "filled": to_float(order.get("z")),
+                    "average": to_float(order.get("ap"), None),
+                    "status": BINANCE_ORDER_STATUS.get(order.get("X"), "open"),
+                    "reduceOnly": order.get("R"),
+                    "info": order,
+                }
+            )
+
+    def apply_bybit(self, message: dict):
+        topic = message.get("topic", "")
+        for data in message.get("data", []):
+            if topic.startswith("wallet"):
+                # 통합계좌의 주문가능 잔고는 계정 단위로만 내려오므로 다음 조회 때 REST로 갱신
+                self.invalidate("balance")
+            elif topic.startswith("position"):
+                position_idx = int(data.get("positionIdx", 0))
+                side = {1: "long", 2: "short"}.get(position_idx) or {"Buy": "long", "Sell": "short"}.get(data.get("side"))
+                self.set_position(
+                    self.symbol(data["symbol"]),
+                    side,
+                    to_float(data.get("size")),
+                    to_float(data.get("entryPrice")),
+                    data,
+                    to_float(data.get("leverage"), None),
+                    one_way=position_idx == 0,
+                    margin_mode={0: "cross", 1: "isolated"}.get(data.get("tradeMode")),
+                )
+            elif topic.startswith("order"):
+                self.set_order(
+                    {
+                        "id": data["orderId"],
+                        "clientOrderId": data.get("orderLinkId"),
+                        "symbol": self.symbol(data["symbol"]),
+                        "type": (data.get("stopOrderType") or data.get("orderType", "")).lower(),
+                        "side": data.get("side", "").lower(),
+                        "amount": to_float(data.get("qty")),
+                        "price": to_float(data.get("price"), None),
+                        "stopPrice": to_float(data.get("triggerPrice"), None) or None,
+                        "filled": to_float(data.get("cumExecQty")),
+                        "average": to_float(data.get("avgPrice"), None),
+                        "status": BYBIT_ORDER_STATUS.get(data.get("orderStatus"), "open"),
+                        "reduceOnly": data.get("reduceOnly"),
+                        "info": data,
+                    }
+                )
+
+    def apply_okx(self, message: dict):
+        channel = message.get("arg", {}).get("channel")
+        for data in message.get("data", []):
+            if channel == "account":
+                for detail in data.get("details", []):
+                    self.set_balance(detail["ccy"], to_float(detail.get("availBal")), to_float(detail.get("eq")))
+            elif channel == "positions":
+                amount = to_float(data.get("pos"))
+                pos_side = data.get("posSide", "net")
+                side = pos_side if pos_side in ("long", "short") else ("long" if amount > 0 else "short")
+                self.set_position(
+                    self.symbol(data["instId"]),
+                    side,
+                    amount,
+                    to_float(data.get("avgPx")),
+                    data,
+                    to_float(data.get("lever"), None),
+                    one_way=pos_side == "net",
+                    margin_mode=data.get("mgnMode"),
+                )
+            elif channel == "orders":
+                self.set_order(
+                    {
+                        "id": data["ordId"],
+                        "clientOrderId": data.get("clOrdId"),
+                        "symbol": self.symbol(data["instId"]),
+                        "type": data.get("ordType"),
+                        "side": data.get("side"),
+                        "amount": to_float(data.get("sz")),
+                        "price": to_float(data.get("px"), None),
+                        "stopPrice": None,
+                        "filled": to_float(data.get("accFillSz")),
+                        "average": to_float(data.get("avgPx"), None),
+                        "status": OKX_ORDER_STATUS.get(data.get("state"), "open"),
+                        "reduceOnly": data.get("reduceOnly") == "true",
+                        "info": data,
+                    }
+                )
+            elif channel == "orders-algo":
+                self.set_order(
+                    {
+                        "id": data["algoId"],
+                        "clientOrderId": data.get("algoClOrdId"),
+                        "symbol": self.symbol(data["instId"]),
+                        "type": "stop",
+                        "side": data.get("side"),
+                        "amount": to_float(data.get("sz")),
+                        "price": to_float(data.get("tpTriggerPx"), None) or None,
+                        "stopPrice": to_float(data.get("slTriggerPx") or data.get("triggerPx"), None) or None,
+                        "filled": 0.0,
+                        "average": None,
+                        "status": OKX_ORDER_STATUS.get(data.get("state"), "open"),
+                        "reduceOnly": data.get("reduceOnly") == "true",
+                        "info": data,
+                    }
+                )
+
+    def apply_bitget(self, message: dict):
+        channel = message.get("arg", {}).get("channel")
+        for data in message.get("data", []):
+            if channel == "account":
+                asset = data.get("marginCoin") or data.get("coin")
+                free = to_float(data.get("available"))
+                total = to_float(data.get("equity") or data.get("accountEquity"), free + to_float(data.get("frozen")))
+                self.set_balance(asset, free, total)
+            elif channel == "positions":
+                hold_side = data.get("holdSide")
+                self.set_position(
+                    self.symbol(data["instId"]),
+                    hold_side,
+                    to_float(data.get("total")),
+                    to_float(data.get("openPriceAvg")),
+                    data,
+                    to_float(data.get("leverage"), None),
+                    margin_mode=data.get("marginMode"),
+                )
+            elif channel == "orders":
+                self.set_order(
+                    {
+                        "id": data["orderId"],
+                        "clientOrderId": data.get("clientOid"),
+                        "symbol": self.symbol(data["instId"]),
+                        "type": data.get("orderType"),
+                        "side": data.get("side"),
+                        "amount": to_float(data.get("size")),
+                        "price": to_float(data.get("price"), None),
+                        "stopPrice": None,
+                        "filled": to_float(data.get("accBaseVolume")),
+                        "average": to_float(data.get("priceAvg"), None),
+                        "status": BITGET_ORDER_STATUS.get(data.get("status"), "open"),
+                        "reduceOnly": data.get("reduceOnly") == "yes",
+                        "info": data,
+                    }
+                )
+            elif channel == "orders-algo":
+                self.set_order(
+                    {
+                        "id": data.get("id") or data.get("orderId"),
+                        "clientOrderId": data.get("clientOid"),
+                        "symbol": self.symbol(data["instId"]),
+                        "type": data.get("planType", "stop"),
+                        "side": data.get("side"),
+                        "amount": to_float(data.get("size")),
+                        "price": to_float(data.get("price"), None),
+                        "stopPrice": to_float(data.get("triggerPrice"), None),
+                        "filled": 0.0,
+                        "average": None,
+                        "status": BITGET_ORDER_STATUS.get(data.get("status"), "open"),
+                        "reduceOnly": True,
+                        "info": data,
+                    }
+                )
+
+    def apply_upbit(self, message: dict):
+        event = message.get("type")
+        if event == "myAsset":
+            for asset in message.get("assets", []):
+                free = to_float(asset.get("balance"))
+                self.set_balance(asset["currency"], free, free + to_float(asset.get("locked")))
+        elif event == "myOrder":
+            order_type = message.get("order_type")
+            filled = to_float(message.get("executed_volume"))
+            self.set_order(
+                {
+                    "id": message["uuid"],
+                    "clientOrderId": message.get("identifier"),
+                    "symbol": self.symbol(message["code"]),
+                    # price: 금액 지정 시장가 매수, market: 시장가 매도
+                    "type": "market" if order_type in ("price", "market") else order_type,
+                    "side": {"BID": "buy", "ASK": "sell"}.get(message.get("ask_bid")),
+                    # 금액 지정 매수는 주문 수량이 없다
+                    "amount": to_float(message.get("volume"), filled),
+                    "price": to_float(message.get("price"), None),
+                    "stopPrice": None,
+                    "filled": filled,
+                    "average": to_float(message.get("avg_price"), None),
+                    "cost": to_float(message.get("executed_funds"), None),
+                    "status": UPBIT_ORDER_STATUS.get(message.get("state"), "open"),
+                    "reduceOnly": False,
+                    "info": message,
+                }
+            )
+
+
+# 모든 거래소 상태의 주문 이벤트를 받는 리스너. (state, order)로 호출된다
+order_listeners: list[Callable[[AccountState, dict], None]] = []
+
+_states: dict[tuple[str, str], AccountState] = {}
+_states_lock = threading.Lock()
+
+
+def get_account_state(client, market_type: str | None = None) -> AccountState:
+    market_type = market_type or client.options.get("defaultType", "spot")
+    key = (client.id, market_type)
+    with _states_lock:
+        state = _states.get(key)
+        if state is None:
+            state = AccountState(client.id.upper(), market_type, client)
+            _states[key] = state
+        return state
+
+
+def usable_state(client, section: str) -> AccountState | None:
+    # 스트림이 살아있을 때만 로컬 상태를 사용. 이벤트로 무효화된 섹션은 REST로 한 번 다시 채운다
+    state = get_account_state(client)
+    if not state.live:
+        return None
+    if not state.synced[section]:
+        try:
+            getattr(state, f"refresh_{section}")()
+        except Exception as e:
+            logger.error(f"{state.exchange_name} {section} 동기화 실패: {e}")
+            return None
+    return state if state.ready(section) else None
+
+
+def cached_balance(client, asset: str, total=False) -> float | None:
+    state = usable_state(client, "balance")
+    if state is None:
+        return None
+    return state.get_balance(asset, total) or 0.0
+
+
+def cached_positions(client, symbol: str) -> list[dict] | None:
+    state = usable_state(client, "positions")
+    if state is None:
+        return None
+    return state.get_positions(symbol)
+
+
+def cached_open_orders(client, symbol: str) -> list[dict] | None:
+    state = usable_state(client, "orders")
+    if state is None:
+        return None
+    return state.get_open_orders(symbol)
+
+
+def account_states() -> dict:
+    with _states_lock:
+        states = list(_states.items())
+    return {f"{key[0]}:{key[1]}": state.status() for key, state in states}
+
+
+register_gauge("account_state", account_states)
@@ -0,0 +1,80 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from loguru import logger
+
+from exchange.utility.metrics import record_latency
+
+# prefetch 풀과 따로 쓴다. prefetch 작업(주문 취소 등) 안에서 부르면 prefetch 슬롯을 더 잡고 기다리지 않는다
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gather")
+
+
+def run_inline(func: Callable, items: list) -> list[tuple]:
+    results = []
+    for item in items:
+        try:
+            results.append((item, func(item), None))
+        except Exception as e:
+            results.append((item, None, e))
+    return results
+
+
+def gather(func: Callable, items: list, limit=5) -> list[tuple]:
+    # items 각각에 func(item)을 최대 limit개씩 동시에 실행. (item, 결과, 예외) 목록을 순서대로 돌려준다
+    if threading.current_thread().name.startswith("gather"):
+        # gather 작업 안에서 다시 부르면 같은 풀을 기다리다 막힐 수 있어서 그 자리에서 차례로 실행
+        return run_inline(func, items)
+    semaphore = threading.BoundedSemaphore(limit)
+
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            semaphore.release()
+
+    futures = []
+    for item in items:
+        # limit개가 실행 중이면 풀에 넣기 전에 기다려서 대기 작업이 풀 슬롯을 잡지 않는다
+        semaphore.acquire()
+        try:
+            futures.append((item, executor.submit(run, item)))
+        except Exception:
+            semaphore.release()
+            raise
+    results = []
+    for item, future in futures:
+        try:
+            results.append((item, future.result(), None))
+        except Exception as e:
+            results.append((item, None, e))
+    return results
+
+
+def cancel_orders(client, order_ids: list, symbol: str, batch_size: int, params: dict | None = None) -> dict:
+    # 거래소 일괄 취소 API로 batch_size씩 나눠 동시에 보내고, 일괄 취소가 통째로 실패한 묶음은 개별 취소
+    # 결과: {"cancelled": [주문], "failed": {주문 id: 에러 메시지}}
+    params = params or {}
+    started = time.perf_counter()
+    cancelled, failed = [], {}
+    chunks = [order_ids[i : i + batch_size] for i in range(0, len(order_ids), batch_size)]
+    for chunk, orders, e in gather(lambda chunk: client.cancel_orders(chunk, symbol, params), chunks):
+        if e is None:
+            for order_id, order in zip(chunk, orders):
+                # 개별 실패는 id 없이 에러 내용만 온다
+                if order.get("id") is None:
+                    failed[order_id] = str(order.get("info"))
+                else:
+                    cancelled.append(order)
+            continue
+        logger.warning(f"{client.id.upper()} 일괄 취소 실패, 개별 취소합니다: {e}")
+        for order_id, order, e in gather(lambda order_id: client.cancel_order(order_id, symbol, params), chunk):
+            if e is None:
+                cancelled.append(order)
+            else:
+                failed[order_id] = str(e)
+    record_latency(f"cancel.{client.id.upper()}", time.perf_counter() - started)
+    if failed:
+        logger.warning(f"{client.id.upper()} {symbol} 주문 취소 실패: {failed}")
+    return {"cancelled": cancelled, "failed": failed}
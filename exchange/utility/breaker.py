@@ -0,0 +1,162 @@
+import threading
+import time
+from typing import Callable
+
+import ccxt
+
+import exchange.error as error
+from exchange.utility import settings
+from exchange.utility.metrics import register_gauge
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_outage_error(e: Exception) -> bool:
+    # 네트워크 오류와 5xx(ExchangeNotAvailable/OnMaintenance)만 장애로 본다. 레이트리밋은 제외
+    if isinstance(e, (ccxt.DDoSProtection, ccxt.RateLimitExceeded)):
+        return False
+    return isinstance(e, ccxt.NetworkError)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self.last_error: str | None = None
+        # 프로브 없이 요청 자체를 시험 요청으로 보낸 스레드
+        self._trial: int | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    def allow(self, probe: Callable | None = None) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN or (
+                time.monotonic() - self.opened_at < self.reset_timeout
+            ):
+                # 열려있거나 다른 요청이 이미 프로브 중
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            if probe is None:
+                # 프로브가 없으면 이번 요청 자체를 시험 요청으로 사용
+                self._trial = threading.get_ident()
+                return True
+
+        try:
+            probe()
+        except Exception as e:
+            self.record_failure(e, probe=True)
+            if self.state != CLOSED:
+                self.rejected += 1
+                return False
+            return True
+        self.record_success()
+        return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._trial = None
+
+    def record_failure(self, e: Exception, probe=False):
+        with self._lock:
+            probe = probe or self._trial == threading.get_ident()
+            if probe:
+                self._trial = None
+            if not is_outage_error(e):
+                # 거래소가 응답은 했으므로(4xx 등) 장애는 아니다. 연속 장애 횟수만 끊고 상태는 그대로 둔다
+                # 열린 차단기는 시험 요청의 응답으로만 닫는다
+                if self.state == CLOSED or (self.state == HALF_OPEN and probe):
+                    self.state = CLOSED
+                    self.failures = 0
+                return
+            self.failures += 1
+            self.last_error = str(e)[:200]
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.trips += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, func: Callable, *args, probe: Callable | None = None, **kwargs):
+        if not self.allow(probe):
+            raise error.CircuitOpenError(self.name)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+
+    def status(self) -> dict:
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = max(
+                    0.0, self.reset_timeout - (time.monotonic() - self.opened_at)
+                )
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "retry_in": retry_in,
+                "last_error": self.last_error,
+            }
+
+
+_breakers: dict[tuple[str, str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(exchange_name: str, endpoint: str) -> CircuitBreaker:
+    # endpoint: "order" | "account" | "market"
+    key = (exchange_name.upper(), endpoint)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                f"{key[0]}:{endpoint}",
+                settings.BREAKER_FAILURE_THRESHOLD,
+                settings.BREAKER_RESET_TIMEOUT,
+            )
+            _breakers[key] = breaker
+        return breaker
+
+
+def make_probe(client, symbol: str | None = None) -> Callable:
+    def probe():
+        if client.has.get("fetchTime"):
+            return client.fetch_time()
+        return client.fetch_ticker(symbol)
+
+    return probe
+
+
+def guarded(client, endpoint: str, func: Callable, *args, probe_symbol=None, **kwargs):
+    breaker = get_breaker(client.id, endpoint)
+    return breaker.call(func, *args, probe=make_probe(client, probe_symbol), **kwargs)
+
+
+def breaker_states() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.status() for breaker in breakers}
+
+
+register_gauge("circuit_breakers", breaker_states)
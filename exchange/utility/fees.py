@@ -0,0 +1,99 @@
+import threading
+import time
+
+from loguru import logger
+
+from exchange.utility import settings
+from exchange.utility.batch import gather
+from exchange.utility.metrics import register_gauge
+from exchange.utility.prefetch import submit
+from exchange.utility.singleflight import coalesced
+
+
+class FeeCache:
+    # (거래소, 계정, 심볼)별 수수료. 주문 사이징에서는 캐시만 읽고 FEE_REFRESH_INTERVAL이 지나면 백그라운드에서 갱신한다
+    def __init__(self):
+        self.fees: dict[tuple, tuple[float, dict]] = {}
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "failures": 0}
+        self._refreshing: set[tuple] = set()
+        self._lock = threading.Lock()
+
+    def key(self, client, symbol: str) -> tuple:
+        return (client.id.upper(), client.apiKey, symbol)
+
+    def store(self, client, symbol: str, fee: dict):
+        with self._lock:
+            self.fees[self.key(client, symbol)] = (time.time(), fee)
+
+    def fetch(self, client, symbol: str) -> dict:
+        fee = coalesced(client, "account", client.fetch_trading_fee, symbol)
+        self.store(client, symbol, fee)
+        return fee
+
+    def load(self, client, symbols: list[str]):
+        # 한 번에 조회할 수 있는 거래소는 일괄 조회, 아니면 심볼별로 동시에 조회 (OKX는 일괄 조회 API가 없다)
+        if client.has.get("fetchTradingFees"):
+            fees = coalesced(client, "account", client.fetch_trading_fees)
+            for symbol in symbols or fees.keys():
+                if symbol in fees:
+                    self.store(client, symbol, fees[symbol])
+            return
+        for symbol, fee, e in gather(lambda symbol: self.fetch(client, symbol), symbols):
+            if e is not None:
+                self.stats["failures"] += 1
+                logger.warning(f"{client.id.upper()} {symbol} 수수료 조회 실패: {e}")
+
+    def refresh(self, client, symbol: str):
+        key = self.key(client, symbol)
+        try:
+            self.fetch(client, symbol)
+            self.stats["refreshes"] += 1
+        except Exception as e:
+            # 이전 값을 계속 쓰고 다음 조회 때 다시 갱신한다
+            self.stats["failures"] += 1
+            logger.warning(f"{client.id.upper()} {symbol} 수수료 갱신 실패: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, client, symbol: str) -> dict:
+        key = self.key(client, symbol)
+        entry = self.fees.get(key)
+        if entry is None:
+            # 미리 불러오지 않은 심볼은 처음 한 번만 조회한다
+            self.stats["misses"] += 1
+            return self.fetch(client, symbol)
+        self.stats["hits"] += 1
+        fetched_at, fee = entry
+        if time.time() - fetched_at > settings.FEE_REFRESH_INTERVAL:
+            with self._lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+            if start:
+                submit(self.refresh, client, symbol)
+        return fee
+
+    def taker(self, client, symbol: str) -> float:
+        return self.get(client, symbol)["taker"]
+
+    def status(self) -> dict:
+        return dict(self.stats) | {"symbols": len(self.fees)}
+
+
+fee_cache = FeeCache()
+
+
+def load_configured_fees(get_bot):
+    # FEE_SYMBOLS: ["OKX:BTC/USDT", "OKX:ETH/USDT", ...]
+    symbols: dict[str, list[str]] = {}
+    for item in settings.FEE_SYMBOLS:
+        exchange_name, symbol = item.split(":", 1)
+        symbols.setdefault(exchange_name.upper(), []).append(symbol)
+    for exchange_name, exchange_symbols in symbols.items():
+        try:
+            fee_cache.load(get_bot(exchange_name).client, exchange_symbols)
+        except Exception as e:
+            logger.error(f"{exchange_name} 수수료 불러오기 실패: {e}")
+
+
+register_gauge("fees", fee_cache.status)
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+from exchange.utility import settings
+from exchange.utility.account_state import get_account_state, order_listeners
+from exchange.utility.breaker import guarded
+from exchange.utility.metrics import record_latency, register_gauge
+
+DONE_STATUSES = ("closed", "canceled", "expired", "rejected")
+
+
+def is_done(order: dict, partial=False) -> bool:
+    if order.get("status") in DONE_STATUSES:
+        return True
+    return partial and bool(order.get("filled"))
+
+
+class FillWaiter:
+    # 유저 스트림 주문 이벤트로 체결을 기다린다. 스트림이 없거나 타임아웃이면 REST fetch_order로 확인
+    # 주문 응답보다 이벤트가 먼저 올 수 있어서 최근 주문 이벤트를 보관해둔다
+    def __init__(self, keep=1000):
+        self.keep = keep
+        self.orders: OrderedDict[tuple[str, str], dict] = OrderedDict()
+        self.events: dict[tuple[str, str], threading.Event] = {}
+        self.stats = {"event": 0, "response": 0, "rest": 0, "timeout": 0}
+        self._lock = threading.Lock()
+
+    def on_order(self, state, order: dict):
+        key = (state.exchange_name, str(order["id"]))
+        with self._lock:
+            self.orders[key] = order
+            self.orders.move_to_end(key)
+            while len(self.orders) > self.keep:
+                self.orders.popitem(last=False)
+            event = self.events.get(key)
+        if event is not None:
+            event.set()
+
+    def wait(self, client, order: dict, symbol: str | None = None, timeout: float | None = None, partial=False) -> dict:
+        # order: create_order 결과. 체결 정보(filled, average, status)가 채워진 주문을 돌려준다
+        if is_done(order, partial):
+            self.stats["response"] += 1
+            return order
+        exchange_name = client.id.upper()
+        key = (exchange_name, str(order["id"]))
+        timeout = settings.FILL_TIMEOUT if timeout is None else timeout
+        started = time.perf_counter()
+        deadline = started + timeout
+        event = threading.Event()
+        with self._lock:
+            self.events[key] = event
+        try:
+            if get_account_state(client).live:
+                while True:
+                    seen = self.orders.get(key)
+                    if seen is not None and is_done(seen, partial):
+                        self.stats["event"] += 1
+                        record_latency(f"fill_wait.{exchange_name}", time.perf_counter() - started)
+                        return seen
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0 or not event.wait(remaining):
+                        break
+                    event.clear()
+                self.stats["timeout"] += 1
+                logger.warning(f"{exchange_name} 주문 {order['id']} 체결 이벤트 대기 시간 초과, REST로 확인합니다")
+        finally:
+            with self._lock:
+                self.events.pop(key, None)
+        result = self.poll(client, order["id"], symbol, deadline, partial)
+        record_latency(f"fill_wait.{exchange_name}", time.perf_counter() - started)
+        return result
+
+    def poll(self, client, order_id, symbol: str | None, deadline: float, partial=False, interval=0.2) -> dict | None:
+        # 접수 직후 조회하면 아직 체결 전(filled=0)일 수 있다. 최종 상태가 될 때까지 deadline 안에서 다시 조회
+        # 이벤트 대기로 deadline이 지났으면 한 번만 조회한다
+        result = None
+        while True:
+            result = self.fetch_order(client, order_id, symbol) or result
+            if result is not None and is_done(result, partial):
+                return result
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return result
+            time.sleep(min(interval, remaining))
+
+    def fetch_order(self, client, order_id, symbol: str | None, attempts=3, delay=0.5) -> dict | None:
+        # 주문 직후에는 조회가 안 될 수 있어서 몇 번 다시 시도한다
+        for attempt in range(attempts):
+            try:
+                result = guarded(client, "account", client.fetch_order, order_id, symbol, probe_symbol=symbol)
+                self.stats["rest"] += 1
+                return result
+            except Exception as e:
+                print("...", e)
+                if attempt < attempts - 1:
+                    time.sleep(delay)
+        return None
+
+    def status(self) -> dict:
+        return dict(self.stats) | {"waiting": len(self.events), "recent": len(self.orders)}
+
+
+fill_waiter = FillWaiter()
+order_listeners.append(fill_waiter.on_order)
+register_gauge("fills", fill_waiter.status)
+
+
+def filled_amount(order: dict | None, default: float) -> float:
+    # 체결 수량을 알 수 없거나 아직 최종 상태가 아니면 주문 수량을 쓴다 (시장가는 곧 전부 체결된다)
+    if order is None or order.get("filled") is None or not is_done(order):
+        return default
+    return float(order["filled"])
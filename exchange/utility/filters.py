@@ -0,0 +1,156 @@
+import threading
+from decimal import ROUND_DOWN, ROUND_HALF_UP, Decimal
+
+from ccxt.base.decimal_to_precision import TICK_SIZE
+
+import exchange.error as error
+from exchange.utility.metrics import register_gauge
+from exchange.utility.ticker import cached_price
+
+REDUCE_ONLY_PARAMS = ("reduceOnly", "reduce_only", "closePosition")
+STOP_PRICE_PARAMS = ("stopPrice", "triggerPrice", "stopLossPrice", "takeProfitPrice")
+
+
+def to_step(precision, precision_mode) -> Decimal | None:
+    # DECIMAL_PLACES 모드의 자릿수는 최소 단위로 바꾼다
+    if precision is None:
+        return None
+    if precision_mode == TICK_SIZE:
+        return Decimal(str(precision))
+    return Decimal(1).scaleb(-int(precision))
+
+
+class SymbolFilter:
+    # market["limits"], market["precision"]로 만든 심볼별 주문 필터 (LOT_SIZE, MARKET_LOT_SIZE, MIN_NOTIONAL, PRICE_FILTER)
+    def __init__(self, market: dict, precision_mode):
+        limits = market.get("limits") or {}
+        precision = market.get("precision") or {}
+        amount_limits = limits.get("amount") or {}
+        market_limits = limits.get("market") or {}
+        cost_limits = limits.get("cost") or {}
+        price_limits = limits.get("price") or {}
+        self.symbol = market["symbol"]
+        self.amount_step = to_step(precision.get("amount"), precision_mode)
+        self.price_tick = to_step(precision.get("price"), precision_mode)
+        self.min_amount = amount_limits.get("min")
+        self.max_amount = amount_limits.get("max")
+        self.market_min_amount = market_limits.get("min") or self.min_amount
+        self.market_max_amount = market_limits.get("max") or self.max_amount
+        self.min_cost = cost_limits.get("min")
+        self.max_cost = cost_limits.get("max")
+        self.min_price = price_limits.get("min")
+        self.max_price = price_limits.get("max")
+        # 인버스 계약은 수량이 USD 단위라 명목가 필터를 적용하지 않는다
+        self.inverse = bool(market.get("inverse"))
+        self.contract_size = market.get("contractSize") or 1
+
+    def steps(self, amount, step: Decimal | None = None) -> int:
+        # 수량을 수량 단위(step) 개수로. 단위 아래는 거래소(ccxt)처럼 버린다
+        return int((Decimal(str(amount)) / (step or self.amount_step)).to_integral_value(rounding=ROUND_DOWN))
+
+    def truncate(self, amount) -> float:
+        if not self.amount_step:
+            return float(amount)
+        return float(self.steps(amount) * self.amount_step)
+
+    def truncate_all(self, amounts: list) -> list[float]:
+        return [self.truncate(amount) for amount in amounts]
+
+    def round_price(self, price) -> float:
+        if not self.price_tick:
+            return float(price)
+        ticks = (Decimal(str(price)) / self.price_tick).to_integral_value(rounding=ROUND_HALF_UP)
+        return float(ticks * self.price_tick)
+
+    def round_prices(self, prices: list) -> list:
+        return [None if price is None else self.round_price(price) for price in prices]
+
+    def split(self, amount, percents: list) -> list[float]:
+        # TP 분할처럼 전체 수량을 비율대로 나눈다. 정수 step 단위로 계산해서 합계가 정확히 전체 수량(단위 아래 버림)이 되고,
+        # 나머지와 최소 수량에 못 미치는 leg는 마지막 leg에 더한다. 비율이 None/0인 leg는 0
+        step = self.amount_step or Decimal("1e-8")
+        total = self.steps(amount, step)
+        min_steps = self.steps(self.min_amount, step) if self.min_amount else 0
+        parts = [int(total * Decimal(str(percent)) // 100) if percent else 0 for percent in percents]
+        parts = [part if part >= min_steps else 0 for part in parts]
+        used = [i for i, percent in enumerate(percents) if percent]
+        if used:
+            parts[used[-1]] += total - sum(parts)
+        return [float(part * step) for part in parts]
+
+    def check(self, type: str, amount, price=None, reduce_only=False) -> float:
+        # 거래소가 거절할 주문이면 예외. 통과하면 단위에 맞춘 수량을 돌려준다
+        is_market = type == "market"
+        amount = self.truncate(abs(amount))
+        min_amount = self.market_min_amount if is_market else self.min_amount
+        max_amount = self.market_max_amount if is_market else self.max_amount
+        if amount <= 0 or (min_amount is not None and amount < min_amount):
+            raise error.MinAmountError()
+        if max_amount is not None and amount > max_amount:
+            raise error.MaxAmountError(amount, max_amount)
+        if price is not None:
+            if price <= 0 or (self.min_price and price < self.min_price) or (self.max_price and price > self.max_price):
+                raise error.PriceRangeError(price, self.min_price, self.max_price)
+            # 청산(reduce-only) 주문은 최소 주문 금액 필터를 받지 않는다
+            if not reduce_only and not self.inverse and self.min_cost is not None:
+                cost = amount * self.contract_size * price
+                if cost < self.min_cost:
+                    raise error.MinNotionalError(cost, self.min_cost)
+        return amount
+
+    def check_cost(self, cost) -> float:
+        # 수량 없이 금액만 보내는 시장가 매수 (업비트 ord_type=price)
+        if cost <= 0 or (self.min_cost is not None and cost < self.min_cost):
+            raise error.MinNotionalError(cost, self.min_cost or 0)
+        return cost
+
+
+class FilterIndex:
+    # 심볼 필터는 마켓 정보에서 한 번만 만든다. 검사는 로컬 계산이라 왕복 없이 끝난다
+    def __init__(self):
+        self.filters: dict[tuple[str, str], SymbolFilter] = {}
+        self.stats = {"checked": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    def get(self, client, symbol: str) -> SymbolFilter:
+        key = (client.id.upper(), symbol)
+        symbol_filter = self.filters.get(key)
+        if symbol_filter is None:
+            symbol_filter = SymbolFilter(client.market(symbol), client.precisionMode)
+            with self._lock:
+                self.filters[key] = symbol_filter
+        return symbol_filter
+
+    def validate(
+        self, client, symbol: str, type: str, side: str, amount, price=None, params: dict | None = None, reduce_only=False
+    ) -> float:
+        params = params or {}
+        symbol_filter = self.get(client, symbol)
+        if amount is None and params.get("cost") is not None:
+            self.stats["checked"] += 1
+            try:
+                return symbol_filter.check_cost(float(params["cost"]))
+            except error.AmountError:
+                self.stats["rejected"] += 1
+                raise
+        if price is None:
+            price = next((params[key] for key in STOP_PRICE_PARAMS if params.get(key) is not None), None)
+        if price is None and type == "market":
+            price = cached_price(client, symbol)
+        # 헤지 모드 청산은 reduceOnly 없이 positionSide로 보내서 호출하는 쪽이 알려준다
+        reduce_only = reduce_only or any(params.get(key) for key in REDUCE_ONLY_PARAMS)
+        self.stats["checked"] += 1
+        try:
+            return symbol_filter.check(type, amount, price and float(price), reduce_only)
+        except (error.AmountError, error.PriceError):
+            self.stats["rejected"] += 1
+            raise
+
+    def status(self) -> dict:
+        return dict(self.stats) | {"symbols": len(self.filters)}
+
+
+filter_index = FilterIndex()
+validate_order = filter_index.validate
+get_quantizer = filter_index.get
+register_gauge("filters", filter_index.status)
@@ -0,0 +1,129 @@
+import threading
+import time
+from typing import Callable
+
+from loguru import logger
+
+from exchange.utility import settings
+from exchange.utility.metrics import register_gauge
+
+SIDES = ("long", "short")
+# 거래소마다 다른 마진 모드 이름을 ccxt 표기(isolated/cross)로 맞춘다
+MARGIN_MODES = {"isolated": "isolated", "fixed": "isolated", "cross": "cross", "crossed": "cross"}
+
+
+def normalize_margin_mode(margin_mode):
+    if margin_mode is None:
+        return None
+    return MARGIN_MODES.get(str(margin_mode).lower(), str(margin_mode).lower())
+
+
+class LeverageCache:
+    # (거래소, 계정, 심볼, 방향)별 현재 레버리지와 마진 모드. 값이 같으면 설정 API를 부르지 않는다
+    # 포지션 동기화(REST)와 계정 이벤트로 갱신한다. 방향 없이 설정하는 거래소는 롱/숏 모두 갱신
+    # 거래소 화면에서 바꾼 값은 계정 이벤트로만 알 수 있어서, 스트림이 없으면 LEVERAGE_CACHE_TTL 동안만 믿는다
+    def __init__(self):
+        self.values: dict[tuple, dict] = {}
+        self.updated: dict[tuple, float] = {}
+        self.stats = {"skipped": 0, "set": 0, "failed": 0}
+        self._lock = threading.Lock()
+
+    def key(self, exchange_name: str, account: str | None, symbol: str, side: str) -> tuple:
+        return (exchange_name, account, symbol, side)
+
+    def update(self, exchange_name: str, account: str | None, symbol: str, side: str | None = None, leverage=None, margin_mode=None):
+        margin_mode = normalize_margin_mode(margin_mode)
+        with self._lock:
+            for side in (side,) if side in SIDES else SIDES:
+                key = self.key(exchange_name, account, symbol, side)
+                entry = self.values.setdefault(key, {"leverage": None, "margin_mode": None})
+                if leverage is not None:
+                    entry["leverage"] = float(leverage)
+                    self.updated[key] = time.monotonic()
+                if margin_mode is not None:
+                    entry["margin_mode"] = margin_mode
+
+    def forget(self, exchange_name: str, account: str | None, symbol: str):
+        with self._lock:
+            for side in SIDES:
+                self.values.pop(self.key(exchange_name, account, symbol, side), None)
+                self.updated.pop(self.key(exchange_name, account, symbol, side), None)
+
+    def get(self, client, symbol: str, side: str | None = None) -> dict | None:
+        # 방향이 없으면 롱/숏 값이 같을 때만 돌려준다
+        entries = [self.values.get(self.key(client.id.upper(), client.apiKey, symbol, side)) for side in ((side,) if side in SIDES else SIDES)]
+        if any(entry is None for entry in entries) or any(entry != entries[0] for entry in entries):
+            return None
+        return dict(entries[0])
+
+    def fresh(self, client, symbol: str, side: str | None = None) -> bool:
+        # 유저 스트림이 살아있으면 계정 이벤트로 갱신되므로 믿고, 아니면 마지막 갱신 후 TTL 이내일 때만 믿는다
+        from exchange.utility.account_state import get_account_state
+
+        if get_account_state(client).live:
+            return True
+        now = time.monotonic()
+        return all(
+            now - self.updated.get(self.key(client.id.upper(), client.apiKey, symbol, side), float("-inf")) < settings.LEVERAGE_CACHE_TTL
+            for side in ((side,) if side in SIDES else SIDES)
+        )
+
+    def margin_mode(self, client, symbol: str) -> str | None:
+        # 마진 모드는 심볼 단위라 어느 방향 값이든 같다
+        if not self.fresh(client, symbol):
+            return None
+        for side in SIDES:
+            entry = self.values.get(self.key(client.id.upper(), client.apiKey, symbol, side))
+            if entry is not None and entry["margin_mode"] is not None:
+                return entry["margin_mode"]
+        return None
+
+    def set_margin_mode(self, client, symbol: str, margin_mode):
+        self.update(client.id.upper(), client.apiKey, symbol, None, margin_mode=margin_mode)
+
+    def ensure(self, client, symbol: str, leverage, set_leverage: Callable, side: str | None = None, margin_mode=None) -> bool:
+        # 캐시된 값과 다르거나 캐시를 믿을 수 없을 때만 set_leverage()를 부른다. 호출했으면 True
+        margin_mode = normalize_margin_mode(margin_mode)
+        entry = self.get(client, symbol, side)
+        if (
+            entry is not None
+            and self.fresh(client, symbol, side)
+            and entry["leverage"] == float(leverage)
+            and (margin_mode is None or entry["margin_mode"] == margin_mode)
+        ):
+            self.stats["skipped"] += 1
+            return False
+        try:
+            set_leverage()
+        except Exception:
+            self.stats["failed"] += 1
+            # 거래소 쪽 값을 알 수 없게 됐으므로 다음에는 다시 설정한다
+            self.forget(client.id.upper(), client.apiKey, symbol)
+            raise
+        self.stats["set"] += 1
+        self.update(client.id.upper(), client.apiKey, symbol, side, leverage, margin_mode)
+        return True
+
+    def seed(self, client, positions: list[dict]):
+        # ccxt 포지션(fetch_positions)의 leverage/marginMode로 채운다. 수량이 0인 포지션도 설정값은 유효하다
+        for position in positions:
+            if position.get("symbol") is None:
+                continue
+            try:
+                self.update(
+                    client.id.upper(),
+                    client.apiKey,
+                    position["symbol"],
+                    position.get("side"),
+                    position.get("leverage"),
+                    position.get("marginMode"),
+                )
+            except (TypeError, ValueError) as e:
+                logger.warning(f"{client.id.upper()} 레버리지 캐시 갱신 실패: {e}")
+
+    def status(self) -> dict:
+        return dict(self.stats) | {"entries": len(self.values)}
+
+
+leverage_cache = LeverageCache()
+register_gauge("leverage", leverage_cache.status)
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+import httpx
+from loguru import logger
+
+from exchange.utility.metrics import register_gauge
+
+BINANCE_LISTEN_KEY_URLS = {
+    "spot": "https://api.binance.com/api/v3/userDataStream",
+    "swap": "https://fapi.binance.com/fapi/v1/listenKey",
+    "delivery": "https://dapi.binance.com/dapi/v1/listenKey",
+}
+
+_http: httpx.AsyncClient | None = None
+
+
+def get_http() -> httpx.AsyncClient:
+    # 발급/연장 요청이 같은 커넥션을 재사용하도록 스트림 루프에서 하나만 쓴다
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(timeout=10)
+    return _http
+
+
+async def close_http():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+class ListenKeyManager:
+    # 바이낸스 유저데이터 스트림 listenKey 하나(계정 + 마켓 구분). 60분 동안 유효하고 30분마다 연장한다
+    # 연장에 실패하거나 만료 이벤트가 오면 새로 발급해서 리스너(스트림)에 넘긴다
+    keepalive_interval = 30 * 60
+    retry_interval = 60
+    lifetime = 60 * 60
+
+    def __init__(self, api_key: str, market_type: str):
+        self.api_key = api_key
+        self.market_type = market_type
+        self.url = BINANCE_LISTEN_KEY_URLS[market_type]
+        self.key: str | None = None
+        self.renewed_at: float | None = None
+        self.listeners: list[Callable[[str], Awaitable[None]]] = []
+        self.stats = {"created": 0, "keepalives": 0, "failures": 0, "rotations": 0}
+        self.task: asyncio.Task | None = None
+        self._lock: asyncio.Lock | None = None
+
+    @property
+    def headers(self) -> dict:
+        return {"X-MBX-APIKEY": self.api_key}
+
+    @property
+    def expired(self) -> bool:
+        return self.key is None or time.time() - self.renewed_at > self.lifetime
+
+    async def create(self) -> str:
+        # 유효한 키가 있으면 거래소가 같은 키를 돌려주고 유효 시간만 늘어난다
+        response = await get_http().post(self.url, headers=self.headers)
+        response.raise_for_status()
+        key = response.json()["listenKey"]
+        self.key = key
+        self.renewed_at = time.time()
+        self.stats["created"] += 1
+        return key
+
+    async def get(self) -> str:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.expired:
+                await self.create()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.key
+
+    async def keepalive(self) -> bool | None:
+        # True: 연장됨, False: 키가 없어짐(-1125), None: 네트워크 에러 등으로 알 수 없음
+        params = {"listenKey": self.key} if self.market_type == "spot" else {}
+        try:
+            response = await get_http().put(self.url, headers=self.headers, params=params)
+        except httpx.HTTPError as e:
+            self.stats["failures"] += 1
+            logger.warning(f"BINANCE {self.market_type} listenKey 연장 요청 실패: {e}")
+            return None
+        if response.status_code == 200:
+            self.renewed_at = time.time()
+            self.stats["keepalives"] += 1
+            return True
+        self.stats["failures"] += 1
+        logger.error(f"BINANCE {self.market_type} listenKey 연장 실패: {response.text}")
+        return False if response.status_code == 400 else None
+
+    async def renew(self, expired_key: str | None = None):
+        # 만료된 키를 버리고 새로 발급. 연결마다 만료 이벤트가 올 수 있어서 이미 바뀐 키면 무시
+        if expired_key is not None and expired_key != self.key:
+            return
+        self.key = None
+        try:
+            key = await self.get()
+        except Exception as e:
+            logger.error(f"BINANCE {self.market_type} listenKey 발급 실패: {e}")
+            return
+        self.stats["rotations"] += 1
+        for listener in self.listeners:
+            try:
+                await listener(key)
+            except Exception as e:
+                logger.error(f"BINANCE {self.market_type} listenKey 교체 에러: {e}")
+
+    async def run(self):
+        delay = self.keepalive_interval
+        while True:
+            await asyncio.sleep(delay)
+            if self.key is None:
+                continue
+            result = await self.keepalive()
+            if result is False or (result is None and self.expired):
+                await self.renew()
+            # 알 수 없는 실패는 키가 아직 유효하므로 조금 뒤 다시 연장
+            delay = self.retry_interval if result is None else self.keepalive_interval
+
+    def status(self) -> dict:
+        return dict(self.stats) | {
+            "age": self.renewed_at and round(time.time() - self.renewed_at),
+        }
+
+
+_managers: dict[tuple[str, str], ListenKeyManager] = {}
+
+
+def get_listen_key_manager(api_key: str, market_type: str) -> ListenKeyManager:
+    manager = _managers.get((api_key, market_type))
+    if manager is None:
+        manager = ListenKeyManager(api_key, market_type)
+        _managers[(api_key, market_type)] = manager
+    return manager
+
+
+register_gauge(
+    "listen_keys",
+    lambda: {f"{market_type}:{api_key[:6]}": manager.status() for (api_key, market_type), manager in _managers.items()},
+)
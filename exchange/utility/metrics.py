@@ -0,0 +1,51 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+_lock = threading.Lock()
+_latencies: dict[str, dict] = {}
+_gauges: dict[str, Callable[[], dict]] = {}
+
+
+def record_latency(name: str, seconds: float):
+    ms = seconds * 1000
+    with _lock:
+        stat = _latencies.get(name)
+        if stat is None:
+            stat = {"count": 0, "total_ms": 0.0, "last_ms": 0.0, "max_ms": 0.0}
+            _latencies[name] = stat
+        stat["count"] += 1
+        stat["total_ms"] += ms
+        stat["last_ms"] = ms
+        stat["max_ms"] = max(stat["max_ms"], ms)
+
+
+@contextmanager
+def timer(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_latency(name, time.perf_counter() - start)
+
+
+def register_gauge(name: str, func: Callable[[], dict]):
+    with _lock:
+        _gauges[name] = func
+
+
+def snapshot() -> dict:
+    with _lock:
+        latencies = {
+            name: stat | {"avg_ms": stat["total_ms"] / stat["count"]}
+            for name, stat in _latencies.items()
+        }
+        gauges = dict(_gauges)
+    result = {"latency": latencies}
+    for name, func in gauges.items():
+        try:
+            result[name] = func()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return result
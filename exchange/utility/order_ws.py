@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import time
+
+import ccxt
+from loguru import logger
+
+from exchange.utility import settings
+from exchange.utility.breaker import guarded
+from exchange.utility.metrics import record_latency
+from exchange.utility.ws import WebsocketStream, okx_login, stream_service
+
+
+class OrderSocket(WebsocketStream):
+    # 주문 전용 프라이빗 웹소켓. 요청마다 id를 붙여 보내고 응답을 id로 짝지어 돌려준다
+    # 요청 본문은 ccxt create_order_request로 만들어서 REST 주문과 같은 파라미터를 쓴다
+    client_order_id_key = "clientOrderId"
+
+    def __init__(self, client):
+        super().__init__(f"{client.id.upper()}:orders", stream_service)
+        self.client = client
+        self.pending: dict[str, asyncio.Future] = {}
+        self.ids = itertools.count(1)
+        self.stats = {"sent": 0, "rejected": 0, "lost": 0, "fallback": 0}
+
+    @property
+    def ready(self) -> bool:
+        return self.connected and self.ws is not None and self.service.running
+
+    async def get_url(self) -> str:
+        return self.url
+
+    def parse(self, raw) -> dict | None:
+        if raw == "pong":
+            return None
+        message = json.loads(raw)
+        return message if message.get("id") else None
+
+    def handle(self, message: dict):
+        future = self.pending.get(str(message["id"]))
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    def on_close(self):
+        # 응답을 못 받은 주문은 체결 여부를 알 수 없다. 호출한 쪽에서 REST로 확인한다
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self.name} 연결 끊김"))
+
+    async def _request(self, request_id: str, message: dict, timeout: float) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.ws.send(json.dumps(message))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def request(self, request_id: str, message: dict) -> dict:
+        timeout = settings.ORDER_WS_TIMEOUT
+        future = self.service.run_coroutine(self._request(request_id, message, timeout))
+        if future is None:
+            raise ConnectionError(f"{self.name} 스트림 서비스가 실행 중이 아닙니다")
+        return future.result(timeout + 1)
+
+    def build(self, symbol: str, type: str, side: str, amount, price, params: dict) -> tuple[str, dict] | None:
+        # (요청 id, 메시지). 웹소켓으로 보낼 수 없는 주문이면 None
+        raise NotImplementedError
+
+    def parse_response(self, message: dict, symbol: str, type: str, side: str) -> dict:
+        raise NotImplementedError
+
+    def find_order(self, symbol: str, client_order_id: str) -> dict | None:
+        # 응답을 못 받은 주문이 실제로 들어갔는지 client order id로 확인
+        try:
+            return guarded(
+                self.client,
+                "account",
+                self.client.fetch_order,
+                None,
+                symbol,
+                {"clientOrderId": client_order_id},
+                probe_symbol=symbol,
+            )
+        except ccxt.OrderNotFound:
+            return None
+
+    def create_order(self, symbol: str, type: str, side: str, amount, price=None, params=None) -> dict:
+        params = params or {}
+        built = self.build(symbol, type, side, amount, price, params) if self.ready else None
+        if built is None:
+            self.stats["fallback"] += 1
+            return self.client.create_order(symbol, type, side, amount, price, params)
+        request_id, message = built
+        started = time.perf_counter()
+        try:
+            response = self.request(request_id, message)
+        except Exception as e:
+            response = e
+        else:
+            record_latency(f"order_ws.{self.client.id.upper()}", time.perf_counter() - started)
+        return self.complete(symbol, type, side, amount, price, params, message, response)
+
+    def complete(self, symbol: str, type: str, side: str, amount, price, params: dict, message: dict, response) -> dict:
+        # response: 응답 메시지, 응답을 못 받았으면 예외
+        if isinstance(response, Exception):
+            # 보냈는지, 거래소가 받았는지 알 수 없다. 같은 client order id로 확인한 뒤 없으면 REST로 보낸다
+            client_order_id = self.client_order_id(message)
+            self.stats["lost"] += 1
+            logger.warning(f"{self.name} 주문 응답 없음({response!r}), REST로 확인합니다: {client_order_id}")
+            order = self.find_order(symbol, client_order_id)
+            if order is not None:
+                return order
+            return self.client.create_order(
+                symbol, type, side, amount, price, params | {self.client_order_id_key: client_order_id}
+            )
+        self.stats["sent"] += 1
+        try:
+            return self.parse_response(response, symbol, type, side)
+        except ccxt.ExchangeError:
+            self.stats["rejected"] += 1
+            raise
+
+    async def _request_all(self, requests: list[tuple[str, dict]], timeout: float) -> list:
+        return await asyncio.gather(
+            *(self._request(request_id, message, timeout) for request_id, message in requests),
+            return_exceptions=True,
+        )
+
+    def request_all(self, requests: list[tuple[str, dict]]) -> list:
+        # 스레드를 늘리지 않고 소켓 루프에서 한꺼번에 보낸다. 응답을 못 받은 요청은 예외로 돌려준다
+        timeout = settings.ORDER_WS_TIMEOUT
+        future = self.service.run_coroutine(self._request_all(requests, timeout))
+        if future is None:
+            return [ConnectionError(f"{self.name} 스트림 서비스가 실행 중이 아닙니다")] * len(requests)
+        try:
+            return future.result(timeout + 1)
+        except Exception as e:
+            return [e] * len(requests)
+
+    def create_orders(self, orders: list[dict]) -> list[dict]:
+        # 브래킷 leg들을 동시에 보낸다. 거래소가 거절한 leg는 REST batch 응답처럼 id 없이 돌려준다
+        legs = [
+            (order["symbol"], order["type"], order["side"], order["amount"], order.get("price"), order.get("params") or {})
+            for order in orders
+        ]
+        ready = self.ready
+        built = [self.build(*leg) if ready else None for leg in legs]
+        requests = [item for item in built if item is not None]
+        started = time.perf_counter()
+        responses = iter(self.request_all(requests) if requests else [])
+        if requests:
+            record_latency(f"order_ws.{self.client.id.upper()}", time.perf_counter() - started)
+        results = []
+        for leg, item in zip(legs, built):
+            try:
+                if item is None:
+                    self.stats["fallback"] += 1
+                    results.append(self.client.create_order(*leg))
+                else:
+                    results.append(self.complete(*leg, item[1], next(responses)))
+            except ccxt.ExchangeError as e:
+                results.append({"id": None, "info": {"msg": str(e)}})
+        return results
+
+    def client_order_id(self, message: dict) -> str:
+        raise NotImplementedError
+
+    def status(self) -> dict:
+        return super().status() | dict(self.stats) | {"pending": len(self.pending)}
+
+
+class BinanceOrderSocket(OrderSocket):
+    # USDT-M 선물 WebSocket API. HMAC 키는 요청마다 서명한다
+    url = "wss://ws-fapi.binance.com/ws-fapi/v1"
+    # ccxt는 에러 코드 매핑을 REST 호스트로 고른다
+    rest_url = "https://fapi.binance.com/fapi/v1/order"
+    ping_interval = 3 * 60
+    max_lifetime = 23 * 60 * 60
+
+    async def ping(self, ws):
+        await ws.ping()
+
+    def build(self, symbol, type, side, amount, price, params):
+        market = self.client.market(symbol)
+        if not market["linear"] or market["spot"]:
+            return None
+        request = self.client.create_order_request(symbol, type, side, amount, price, params)
+        request = {
+            key: ("true" if value else "false") if isinstance(value, bool) else value
+            for key, value in request.items()
+        }
+        request |= {"apiKey": self.client.apiKey, "timestamp": self.client.milliseconds()}
+        query = "&".join(f"{key}={request[key]}" for key in sorted(request))
+        request["signature"] = hmac.new(self.client.secret.encode(), query.encode(), hashlib.sha256).hexdigest()
+        request_id = str(next(self.ids))
+        return request_id, {"id": request_id, "method": "order.place", "params": request}
+
+    def client_order_id(self, message):
+        return message["params"]["newClientOrderId"]
+
+    def parse_response(self, message, symbol, type, side):
+        if message.get("status") != 200:
+            error = message.get("error") or {}
+            body = json.dumps(error)
+            self.client.handle_errors(400, "", self.rest_url, "WS", {}, body, error, None, None)
+            raise ccxt.ExchangeError(f"binance {body}")
+        return self.client.parse_order(message["result"], self.client.market(symbol))
+
+
+class OkxOrderSocket(OrderSocket):
+    # 프라이빗 웹소켓 order 요청. 조건부(algo) 주문은 웹소켓으로 보낼 수 없어서 REST로 보낸다
+    url = "wss://ws.okx.com:8443/ws/v5/private"
+    ping_interval = 25
+    algo_order_types = ("trigger", "conditional", "move_order_stop", "oco", "iceberg", "twap")
+
+    async def on_connect(self, ws):
+        await okx_login(self, ws)
+
+    def build(self, symbol, type, side, amount, price, params):
+        request = self.client.create_order_request(symbol, type, side, amount, price, params)
+        if request.get("ordType") in self.algo_order_types:
+            return None
+        request_id = str(next(self.ids))
+        return request_id, {"id": request_id, "op": "order", "args": [request]}
+
+    def client_order_id(self, message):
+        return message["args"][0]["clOrdId"]
+
+    def parse_response(self, message, symbol, type, side):
+        if message.get("code") != "0":
+            self.client.handle_errors(None, None, self.url, "WS", None, json.dumps(message), message, None, None)
+            raise ccxt.ExchangeError(f"okx {json.dumps(message)}")
+        order = self.client.parse_order(message["data"][0], self.client.market(symbol))
+        order["type"] = type
+        order["side"] = side
+        return order
+
+
+ORDER_SOCKETS = {
+    "binance": BinanceOrderSocket,
+    "okx": OkxOrderSocket,
+}
+
+_sockets: dict[tuple[str, str], OrderSocket] = {}
+
+
+def get_order_socket(client) -> OrderSocket | None:
+    # ORDER_WS가 꺼져 있거나 지원하지 않는 거래소면 None. 처음 부를 때 연결을 시작한다
+    if not settings.ORDER_WS:
+        return None
+    socket_class = ORDER_SOCKETS.get(client.id)
+    if socket_class is None:
+        return None
+    key = (client.id, client.apiKey)
+    socket = _sockets.get(key)
+    if socket is None:
+        socket = socket_class(client)
+        _sockets[key] = socket
+        stream_service.add(socket)
+    return socket
+
+
+def create_order(client, symbol: str, type: str, side: str, amount, price=None, params=None) -> dict:
+    # 주문 웹소켓이 연결돼 있으면 웹소켓으로, 아니면 REST로 보낸다
+    socket = get_order_socket(client)
+    if socket is None:
+        return client.create_order(symbol, type, side, amount, price, params or {})
+    return socket.create_order(symbol, type, side, amount, price, params)
+
+
+def create_orders(client, orders: list[dict]) -> list[dict]:
+    socket = get_order_socket(client)
+    if socket is None or not socket.ready:
+        return guarded(client, "order", client.create_orders, orders)
+    return socket.create_orders(orders)
+
+
+def open_order_sockets(get_bots):
+    # 첫 주문 전에 연결해둔다
+    for bot in get_bots():
+        try:
+            get_order_socket(bot.client)
+        except Exception as e:
+            logger.error(f"{bot.client.id.upper()} 주문 웹소켓 시작 실패: {e}")
@@ -0,0 +1,345 @@
+import asyncio
+import bisect
+import json
+import math
+import threading
+import time
+
+from loguru import logger
+
+import exchange.error as error
+from exchange.utility import settings
+from exchange.utility.metrics import record_latency, register_gauge
+from exchange.utility.ws import SymbolStream, stream_service, watch_symbol
+
+
+class OrderBook:
+    # 웹소켓 diff로 유지하는 L2 호가. 가격 목록은 정렬 상태로 유지해서 조회 시 정렬하지 않는다
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.bids: dict[float, float] = {}
+        self.asks: dict[float, float] = {}
+        self.bid_prices: list[float] = []  # 음수로 저장, 오름차순 = 높은 가격부터
+        self.ask_prices: list[float] = []
+        self.update_id: int | None = None
+        self.synced = False
+        self.updated_at: float | None = None
+        self.resyncs = 0
+        self._lock = threading.Lock()
+
+    def reset(self, bids, asks, update_id: int | None):
+        with self._lock:
+            self.bids = {float(price): float(size) for price, size, *_ in bids if float(size)}
+            self.asks = {float(price): float(size) for price, size, *_ in asks if float(size)}
+            self.bid_prices = sorted(-price for price in self.bids)
+            self.ask_prices = sorted(self.asks)
+            self.update_id = update_id
+            self.synced = True
+            self.updated_at = time.time()
+
+    def apply(self, bids, asks, update_id: int | None):
+        with self._lock:
+            for price, size, *_ in bids:
+                self._set(self.bids, self.bid_prices, float(price), float(size), -float(price))
+            for price, size, *_ in asks:
+                self._set(self.asks, self.ask_prices, float(price), float(size), float(price))
+            self.update_id = update_id
+            self.updated_at = time.time()
+
+    def _set(self, levels: dict, prices: list, price: float, size: float, key: float):
+        if size == 0:
+            if levels.pop(price, None) is not None:
+                index = bisect.bisect_left(prices, key)
+                if index < len(prices) and prices[index] == key:
+                    prices.pop(index)
+            return
+        if price not in levels:
+            bisect.insort(prices, key)
+        levels[price] = size
+
+    def invalidate(self):
+        with self._lock:
+            if self.synced:
+                self.resyncs += 1
+            self.synced = False
+
+    def _levels(self, side: str):
+        # buy는 매도호가를, sell은 매수호가를 먹는다
+        if side == "buy":
+            return self.asks, self.ask_prices, 1
+        return self.bids, self.bid_prices, -1
+
+    def estimate_fill(self, side: str, amount: float) -> dict | None:
+        if amount <= 0:
+            return None
+        with self._lock:
+            levels, prices, sign = self._levels(side)
+            if not prices:
+                return None
+            best = prices[0] * sign
+            filled = cost = 0.0
+            worst = best
+            for key in prices:
+                price = key * sign
+                size = min(levels[price], amount - filled)
+                filled += size
+                cost += size * price
+                worst = price
+                if filled >= amount:
+                    break
+        average = cost / filled
+        return {
+            "average": average,
+            "best": best,
+            "worst": worst,
+            "filled": filled,
+            "complete": filled >= amount,
+            "slippage": abs(average - best) / best,
+        }
+
+    def max_amount(self, side: str, max_slippage: float) -> float:
+        # 평균 체결가 기준 슬리피지가 max_slippage 이하인 최대 수량
+        with self._lock:
+            levels, prices, sign = self._levels(side)
+            if not prices:
+                return 0.0
+            best = prices[0] * sign
+            limit = best * (1 + max_slippage * sign)
+            filled = cost = 0.0
+            for key in prices:
+                price = key * sign
+                size = levels[price]
+                if (cost + size * price) * sign > limit * (filled + size) * sign:
+                    # 이 호가는 일부만 먹을 수 있다
+                    filled += max(0.0, (limit * filled - cost) / (price - limit))
+                    break
+                filled += size
+                cost += size * price
+        return filled
+
+    def status(self) -> dict:
+        return {
+            "synced": self.synced,
+            "levels": (len(self.bids), len(self.asks)),
+            "update_id": self.update_id,
+            "age": self.updated_at and round(time.time() - self.updated_at, 3),
+            "resyncs": self.resyncs,
+        }
+
+
+class DepthStream(SymbolStream):
+    kind = "depth"
+
+    def __init__(self, client, category: str):
+        super().__init__(client, category)
+        self.books: dict[str, OrderBook] = {}
+
+    def book(self, market_id: str) -> OrderBook:
+        book = self.books.get(market_id)
+        if book is None:
+            book = self.books[market_id] = OrderBook(self.symbols.get(market_id, market_id))
+        return book
+
+    def on_close(self):
+        # 끊긴 동안의 diff는 복구할 수 없으므로 스냅샷부터 다시 받는다
+        for book in self.books.values():
+            book.invalidate()
+
+
+class BinanceDepthStream(DepthStream):
+    # diff depth 스트림 + REST 스냅샷. 선물은 pu == 직전 u, 현물은 U == 직전 u + 1 이어야 한다
+    urls = {
+        "spot": "wss://stream.binance.com:9443/ws",
+        "linear": "wss://fstream.binance.com/ws",
+        "inverse": "wss://dstream.binance.com/ws",
+    }
+    snapshot_limit = 1000
+
+    def __init__(self, client, category: str):
+        super().__init__(client, category)
+        self.url = self.urls[category]
+        self.buffers: dict[str, list] = {}
+        self.request_id = 0
+
+    async def subscribe(self, ws, ids: list[str]):
+        self.request_id += 1
+        params = [f"{market_id.lower()}@depth@100ms" for market_id in ids]
+        await ws.send(json.dumps({"method": "SUBSCRIBE", "params": params, "id": self.request_id}))
+
+    async def ping(self, ws):
+        await ws.ping()
+
+    def parse(self, raw) -> dict | None:
+        message = json.loads(raw)
+        return message if message.get("e") == "depthUpdate" else None
+
+    def is_next(self, book: OrderBook, event: dict) -> bool:
+        if "pu" in event:
+            return event["pu"] == book.update_id
+        return event["U"] == book.update_id + 1
+
+    def handle(self, message: dict):
+        market_id = message["s"]
+        book = self.book(market_id)
+        if book.synced and self.is_next(book, message):
+            book.apply(message["b"], message["a"], message["u"])
+            return
+        if book.synced:
+            logger.warning(f"{self.name} {market_id} 호가 시퀀스 누락, 스냅샷 재요청")
+            book.invalidate()
+        buffer = self.buffers.get(market_id)
+        if buffer is None:
+            # 스냅샷을 받는 동안 들어오는 diff는 쌓아뒀다가 이어 붙인다
+            self.buffers[market_id] = [message]
+            asyncio.create_task(self.load_snapshot(market_id))
+        else:
+            buffer.append(message)
+
+    async def load_snapshot(self, market_id: str):
+        book = self.book(market_id)
+        try:
+            snapshot = await asyncio.get_running_loop().run_in_executor(
+                None, self.client.fetch_order_book, book.symbol, self.snapshot_limit
+            )
+        except Exception as e:
+            logger.error(f"{self.name} {market_id} 호가 스냅샷 실패: {e}")
+            self.buffers.pop(market_id, None)
+            return
+        buffer = self.buffers.pop(market_id, [])
+        last_update_id = snapshot["nonce"]
+        book.reset(snapshot["bids"], snapshot["asks"], last_update_id)
+        first = True
+        for event in buffer:
+            if event["u"] <= last_update_id:
+                continue
+            if first:
+                # 첫 diff는 스냅샷 시점을 포함해야 한다
+                if event["U"] > last_update_id + 1:
+                    book.invalidate()
+                    return
+                first = False
+            elif not self.is_next(book, event):
+                book.invalidate()
+                return
+            book.apply(event["b"], event["a"], event["u"])
+
+
+class BybitDepthStream(DepthStream):
+    # v5 orderbook 스트림. snapshot 이후 delta의 u는 1씩 증가해야 한다
+    depth = 200
+
+    def __init__(self, client, category: str):
+        super().__init__(client, category)
+        self.url = f"wss://stream.bybit.com/v5/public/{category}"
+
+    def topic(self, market_id: str) -> str:
+        return f"orderbook.{self.depth}.{market_id}"
+
+    async def subscribe(self, ws, ids: list[str]):
+        for i in range(0, len(ids), 10):
+            args = [self.topic(market_id) for market_id in ids[i : i + 10]]
+            await ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+    async def resubscribe(self, market_id: str):
+        # 다시 구독하면 snapshot부터 새로 온다
+        args = [self.topic(market_id)]
+        await self.ws.send(json.dumps({"op": "unsubscribe", "args": args}))
+        await self.ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+    async def ping(self, ws):
+        await ws.send(json.dumps({"op": "ping"}))
+
+    def parse(self, raw) -> dict | None:
+        message = json.loads(raw)
+        return message if str(message.get("topic", "")).startswith("orderbook.") else None
+
+    def handle(self, message: dict):
+        data = message["data"]
+        book = self.book(data["s"])
+        # u == 1 은 서비스 재시작에 따른 snapshot
+        if message["type"] == "snapshot" or data["u"] == 1:
+            book.reset(data["b"], data["a"], data["u"])
+        elif book.synced and data["u"] == book.update_id + 1:
+            book.apply(data["b"], data["a"], data["u"])
+        elif book.synced:
+            logger.warning(f"{self.name} {data['s']} 호가 시퀀스 누락, 재구독")
+            book.invalidate()
+            asyncio.create_task(self.resubscribe(data["s"]))
+
+
+DEPTH_STREAMS = {
+    "binance": BinanceDepthStream,
+    "bybit": BybitDepthStream,
+}
+
+
+def get_book(client, symbol: str) -> OrderBook | None:
+    # 연결이 끊기면 호가를 무효화하므로 synced면 최신 상태다
+    stream = watch_symbol(DEPTH_STREAMS, client, symbol)
+    if stream is None or not stream.connected:
+        return None
+    book = stream.books.get(client.market(symbol)["id"])
+    return book if book is not None and book.synced else None
+
+
+def estimate_fill(client, symbol: str, side: str, amount: float) -> dict | None:
+    # 로컬 호가로 시장가 주문의 평균 체결가/슬리피지 추정. 호가가 준비되지 않았으면 None
+    book = get_book(client, symbol)
+    if book is None:
+        return None
+    return book.estimate_fill(side, amount)
+
+
+def plan_market_order(client, symbol: str, side: str, amount: float) -> list[float]:
+    # MAX_SLIPPAGE(%)를 넘는 시장가 주문은 줄이거나(cap) 나눠서(split) 보낸다
+    if settings.MAX_SLIPPAGE is None:
+        return [amount]
+    started = time.perf_counter()
+    book = get_book(client, symbol)
+    if book is None:
+        logger.warning(f"{client.id.upper()} {symbol} 호가가 준비되지 않아 슬리피지 검사를 건너뜁니다")
+        return [amount]
+    max_slippage = settings.MAX_SLIPPAGE / 100
+    estimate = book.estimate_fill(side, amount)
+    if estimate is None or (estimate["complete"] and estimate["slippage"] <= max_slippage):
+        record_latency("slippage_check", time.perf_counter() - started)
+        return [amount]
+    capped = float(client.amount_to_precision(symbol, min(book.max_amount(side, max_slippage), amount)))
+    record_latency("slippage_check", time.perf_counter() - started)
+    if capped <= 0:
+        raise error.SlippageError(estimate["slippage"] * 100, settings.MAX_SLIPPAGE)
+    reason = (
+        f"예상 슬리피지 {estimate['slippage'] * 100:.3f}% > {settings.MAX_SLIPPAGE}%"
+        if estimate["complete"]
+        else f"호가 잔량 부족({estimate['filled']})"
+    )
+    logger.warning(f"{client.id.upper()} {symbol} {reason}, {settings.SLIPPAGE_ACTION}: {amount} -> {capped}")
+    if settings.SLIPPAGE_ACTION == "cap":
+        return [capped]
+    count = min(math.ceil(amount / capped), settings.SLIPPAGE_MAX_SLICES)
+    slices = [capped] * (count - 1)
+    rest = float(client.amount_to_precision(symbol, min(amount - capped * (count - 1), capped)))
+    if rest > 0:
+        slices.append(rest)
+    return slices
+
+
+def watch_configured_books(get_bot):
+    # DEPTH_SYMBOLS: ["BINANCE:BTC/USDT:USDT", "BYBIT:SOL/USDT:USDT", ...]
+    for item in settings.DEPTH_SYMBOLS:
+        exchange_name, symbol = item.split(":", 1)
+        try:
+            watch_symbol(DEPTH_STREAMS, get_bot(exchange_name.upper()).client, symbol)
+        except Exception as e:
+            logger.error(f"{item} 호가 구독 실패: {e}")
+
+
+def depth_status() -> dict:
+    return {
+        stream.name: {book.symbol: book.status() for book in stream.books.values()}
+        for stream in list(stream_service.streams.values())
+        if isinstance(stream, DepthStream)
+    }
+
+
+register_gauge("order_books", depth_status)
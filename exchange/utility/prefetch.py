@@ -0,0 +1,19 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+# 주문 사이징에 필요한 독립적인 REST 조회(잔고, 시세, 포지션, 레버리지)를 동시에 실행
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="prefetch")
+
+
+def submit(func: Callable, *args, **kwargs) -> Future:
+    return executor.submit(func, *args, **kwargs)
+
+
+def prefetch(**calls: tuple | None) -> dict:
+    # prefetch(balance=(self.get_balance, "USDT"), price=(self.get_price, symbol))
+    futures = {
+        name: executor.submit(call[0], *call[1:])
+        for name, call in calls.items()
+        if call is not None
+    }
+    return {name: future.result() for name, future in futures.items()}
@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+from exchange.utility import settings
+from exchange.utility.breaker import guarded
+from exchange.utility.metrics import register_gauge
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: dict[tuple, Future] = {}
+        self._cache: dict[tuple, tuple[float, object]] = {}
+        self.calls = 0
+        self.shared = 0
+        self.cache_hits = 0
+
+    def do(self, key: tuple, func: Callable, *args, ttl: float = 0, **kwargs):
+        with self._lock:
+            if ttl > 0:
+                cached = self._cache.get(key)
+                if cached is not None and time.monotonic() - cached[0] <= ttl:
+                    self.cache_hits += 1
+                    return cached[1]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            # 같은 요청이 이미 진행 중이면 그 결과를 함께 사용
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            with self._lock:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            # invalidate()로 버려진 요청이면 이미 다른 요청이 자리를 차지했을 수 있고, 결과도 캐시하지 않는다
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+                if ttl > 0:
+                    self._cache[key] = (time.monotonic(), result)
+        future.set_result(result)
+        return result
+
+    def invalidate(self, *prefix):
+        # 진행 중인 조회도 주문 전 상태일 수 있으므로 다음 호출은 새로 요청한다
+        with self._lock:
+            for key in [key for key in self._cache if key[: len(prefix)] == prefix]:
+                del self._cache[key]
+            for key in [key for key in self._inflight if key[: len(prefix)] == prefix]:
+                del self._inflight[key]
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "shared": self.shared,
+                "cache_hits": self.cache_hits,
+                "inflight": len(self._inflight),
+            }
+
+
+flight = SingleFlight()
+
+
+def account_key(client) -> tuple:
+    return (client.id, client.apiKey)
+
+
+def coalesced(client, endpoint: str, func: Callable, *args, **kwargs):
+    # 거래소, 계정, 마켓타입, 메서드, 인자가 같은 조회는 하나의 요청으로 합친다
+    key = account_key(client) + (
+        client.options.get("defaultType"),
+        func.__name__,
+        repr(args),
+        repr(sorted(kwargs.items())),
+    )
+    return flight.do(
+        key,
+        guarded,
+        client,
+        endpoint,
+        func,
+        *args,
+        ttl=settings.READ_CACHE_TTL,
+        **kwargs,
+    )
+
+
+def invalidate_account(client):
+    # 주문 후에는 잔고/포지션 캐시를 버린다
+    flight.invalidate(*account_key(client))
+
+
+register_gauge("single_flight", flight.status)
@@ -0,0 +1,231 @@
+import json
+import threading
+import time
+
+from loguru import logger
+
+from exchange.utility import settings
+from exchange.utility.metrics import register_gauge
+from exchange.utility.ws import SymbolStream, watch_symbol
+
+
+class TickerStore:
+    # 퍼블릭 웹소켓으로 받은 최근 체결가(last)와 마크 가격(mark). 각 가격은 수신 시각을 같이 가진다
+    def __init__(self):
+        self.prices: dict[tuple[str, str], dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def update(self, exchange_name: str, symbol: str, last=None, mark=None):
+        now = time.time()
+        with self._lock:
+            entry = self.prices.setdefault(
+                (exchange_name, symbol),
+                {"last": None, "last_at": None, "mark": None, "mark_at": None},
+            )
+            if last is not None:
+                entry["last"] = float(last)
+                entry["last_at"] = now
+            if mark is not None:
+                entry["mark"] = float(mark)
+                entry["mark_at"] = now
+
+    def get(self, exchange_name: str, symbol: str, field="last", max_age: float | None = None):
+        # 오래된 가격은 None. 호출하는 쪽에서 REST로 다시 조회한다
+        if max_age is None:
+            max_age = settings.TICKER_MAX_AGE
+        with self._lock:
+            entry = self.prices.get((exchange_name, symbol))
+            updated_at = entry and entry[f"{field}_at"]
+            if updated_at is None or time.time() - updated_at > max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[field]
+
+    def age(self, exchange_name: str, symbol: str, field="last") -> float | None:
+        entry = self.prices.get((exchange_name, symbol))
+        if entry is None or entry[f"{field}_at"] is None:
+            return None
+        return time.time() - entry[f"{field}_at"]
+
+    def status(self) -> dict:
+        with self._lock:
+            entries = dict(self.prices)
+            hits, misses = self.hits, self.misses
+        now = time.time()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "prices": {
+                f"{exchange_name}:{symbol}": {
+                    "last": entry["last"],
+                    "mark": entry["mark"],
+                    "age": entry["last_at"] and round(now - entry["last_at"], 3),
+                }
+                for (exchange_name, symbol), entry in entries.items()
+            },
+        }
+
+
+ticker_store = TickerStore()
+
+
+class TickerStream(SymbolStream):
+    # 거래소/마켓 구분별 퍼블릭 티커 스트림 하나. 심볼은 조회되거나 설정될 때 추가 구독한다
+    kind = "ticker"
+
+    def update(self, market_id: str, last=None, mark=None):
+        symbol = self.symbols.get(market_id)
+        if symbol is not None:
+            ticker_store.update(self.exchange_name, symbol, last, mark)
+
+
+class BinanceTickerStream(TickerStream):
+    urls = {
+        "spot": "wss://stream.binance.com:9443/ws",
+        "linear": "wss://fstream.binance.com/ws",
+        "inverse": "wss://dstream.binance.com/ws",
+    }
+
+    def __init__(self, client, category: str):
+        super().__init__(client, category)
+        self.url = self.urls[category]
+        self.request_id = 0
+
+    async def subscribe(self, ws, ids: list[str]):
+        params = []
+        for market_id in ids:
+            params.append(f"{market_id.lower()}@ticker")
+            if self.category != "spot":
+                params.append(f"{market_id.lower()}@markPrice@1s")
+        self.request_id += 1
+        await ws.send(json.dumps({"method": "SUBSCRIBE", "params": params, "id": self.request_id}))
+
+    async def ping(self, ws):
+        await ws.ping()
+
+    def parse(self, raw) -> dict | None:
+        message = json.loads(raw)
+        return message if "e" in message else None
+
+    def handle(self, message: dict):
+        if message["e"] == "24hrTicker":
+            self.update(message["s"], last=message["c"])
+        elif message["e"] == "markPriceUpdate":
+            self.update(message["s"], mark=message["p"])
+
+
+class BybitTickerStream(TickerStream):
+    def __init__(self, client, category: str):
+        super().__init__(client, category)
+        self.url = f"wss://stream.bybit.com/v5/public/{category}"
+
+    async def subscribe(self, ws, ids: list[str]):
+        # 한 번에 최대 10개 토픽
+        for i in range(0, len(ids), 10):
+            args = [f"tickers.{market_id}" for market_id in ids[i : i + 10]]
+            await ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+    async def ping(self, ws):
+        await ws.send(json.dumps({"op": "ping"}))
+
+    def parse(self, raw) -> dict | None:
+        message = json.loads(raw)
+        return message if str(message.get("topic", "")).startswith("tickers.") else None
+
+    def handle(self, message: dict):
+        data = message["data"]
+        # delta 메시지에는 바뀐 필드만 온다
+        self.update(data["symbol"], last=data.get("lastPrice"), mark=data.get("markPrice"))
+
+
+class OkxTickerStream(TickerStream):
+    url = "wss://ws.okx.com:8443/ws/v5/public"
+    ping_interval = 25
+
+    async def subscribe(self, ws, ids: list[str]):
+        args = []
+        for market_id in ids:
+            args.append({"channel": "tickers", "instId": market_id})
+            if ":" in self.symbols[market_id]:
+                args.append({"channel": "mark-price", "instId": market_id})
+        await ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+    def handle(self, message: dict):
+        channel = message.get("arg", {}).get("channel")
+        for data in message["data"]:
+            if channel == "tickers":
+                self.update(data["instId"], last=data.get("last"))
+            elif channel == "mark-price":
+                self.update(data["instId"], mark=data.get("markPx"))
+
+
+class BitgetTickerStream(TickerStream):
+    url = "wss://ws.bitget.com/v2/ws/public"
+    ping_interval = 25
+
+    async def subscribe(self, ws, ids: list[str]):
+        args = [
+            {"instType": self.category, "channel": "ticker", "instId": market_id}
+            for market_id in ids
+        ]
+        await ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+    def handle(self, message: dict):
+        for data in message["data"]:
+            self.update(data["instId"], last=data.get("lastPr"), mark=data.get("markPrice"))
+
+
+class UpbitTickerStream(TickerStream):
+    url = "wss://api.upbit.com/websocket/v1"
+
+    async def subscribe(self, ws, ids: list[str]):
+        # 업비트는 새 구독 요청이 이전 구독을 대체하므로 항상 전체 심볼을 보낸다
+        await ws.send(
+            json.dumps([{"ticket": self.client.uuid()}, {"type": "ticker", "codes": list(self.symbols)}])
+        )
+
+    async def ping(self, ws):
+        await ws.ping()
+
+    def parse(self, raw) -> dict | None:
+        message = json.loads(raw)
+        return message if message.get("type") == "ticker" else None
+
+    def handle(self, message: dict):
+        self.update(message["code"], last=message.get("trade_price"))
+
+
+TICKER_STREAMS = {
+    "binance": BinanceTickerStream,
+    "bybit": BybitTickerStream,
+    "okx": OkxTickerStream,
+    "bitget": BitgetTickerStream,
+    "upbit": UpbitTickerStream,
+}
+
+
+def watch_ticker(client, symbol: str):
+    if settings.TICKER_STREAM:
+        watch_symbol(TICKER_STREAMS, client, symbol)
+
+
+def cached_price(client, symbol: str, field="last") -> float | None:
+    # 스트림 가격이 신선하지 않으면 None. 처음 조회한 심볼은 이때 구독을 시작한다
+    watch_ticker(client, symbol)
+    return ticker_store.get(client.id.upper(), symbol, field)
+
+
+def watch_configured_tickers(get_bot):
+    # TICKER_SYMBOLS: ["BINANCE:BTC/USDT:USDT", "OKX:ETH/USDT:USDT", ...]
+    for item in settings.TICKER_SYMBOLS:
+        exchange_name, symbol = item.split(":", 1)
+        try:
+            watch_ticker(get_bot(exchange_name.upper()).client, symbol)
+        except Exception as e:
+            logger.error(f"{item} 티커 구독 실패: {e}")
+
+
+register_gauge("tickers", ticker_store.status)
@@ -0,0 +1,226 @@
+import socket
+import threading
+import time
+from typing import Callable
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from exchange.utility import settings
+from exchange.utility.batch import gather
+from exchange.utility.metrics import record_latency, register_gauge
+
+
+class DnsCache:
+    # socket.getaddrinfo 결과를 TTL 동안 재사용한다. requests(ccxt), httpx(KIS), 웹소켓 모두 이 함수로 조회한다
+    # 조회가 실패하면 만료된 결과라도 돌려줘서 일시적인 DNS 장애가 주문 실패로 이어지지 않게 한다
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries: dict[tuple, tuple[float, list]] = {}
+        self.stats = {"hits": 0, "misses": 0, "stale": 0}
+        self._lock = threading.Lock()
+        self._getaddrinfo = None
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self.stats["hits"] += 1
+            return list(entry[1])
+        try:
+            result = self._getaddrinfo(host, port, family, type, proto, flags)
+        except socket.gaierror:
+            if entry is None:
+                raise
+            self.stats["stale"] += 1
+            logger.warning(f"{host} DNS 조회 실패, 이전 결과를 사용합니다")
+            return list(entry[1])
+        self.stats["misses"] += 1
+        with self._lock:
+            self.entries[key] = (time.monotonic(), result)
+        return list(result)
+
+    def install(self):
+        if self._getaddrinfo is None:
+            self._getaddrinfo = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        if self._getaddrinfo is not None:
+            socket.getaddrinfo = self._getaddrinfo
+            self._getaddrinfo = None
+
+    def status(self) -> dict:
+        return dict(self.stats) | {"entries": len(self.entries), "ttl": self.ttl}
+
+
+class ConnectionTracker:
+    # 호스트별 마지막 요청 시각. 요청이 들어올 때 직전까지 커넥션이 쉬고 있던 시간을 기록한다
+    def __init__(self):
+        self.hosts: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def touch(self, host: str):
+        now = time.monotonic()
+        with self._lock:
+            stat = self.hosts.get(host)
+            if stat is None:
+                self.hosts[host] = {"last": now, "requests": 1, "last_idle": None, "max_idle": 0.0}
+                return
+            idle = now - stat["last"]
+            stat["last"] = now
+            stat["requests"] += 1
+            stat["last_idle"] = idle
+            stat["max_idle"] = max(stat["max_idle"], idle)
+
+    def idle(self, host: str) -> float | None:
+        # 한 번도 요청하지 않은 호스트는 None
+        stat = self.hosts.get(host)
+        return None if stat is None else time.monotonic() - stat["last"]
+
+    def track_ccxt(self, client):
+        # ccxt(동기)는 requests 세션으로 요청한다. 세션 응답 훅으로 주문 요청까지 모두 센다
+        hooks = client.session.hooks["response"]
+        if self._requests_hook not in hooks:
+            hooks.append(self._requests_hook)
+
+    def track_httpx(self, session):
+        hooks = session.event_hooks["response"]
+        if self._httpx_hook not in hooks:
+            hooks.append(self._httpx_hook)
+
+    def _requests_hook(self, response, *args, **kwargs):
+        self.touch(urlsplit(response.url).hostname)
+
+    def _httpx_hook(self, response):
+        self.touch(response.request.url.host)
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        return {
+            host: {
+                "idle": round(now - stat["last"], 1),
+                "requests": stat["requests"],
+                "last_idle": stat["last_idle"] and round(stat["last_idle"], 1),
+                "max_idle": round(stat["max_idle"], 1),
+            }
+            for host, stat in list(self.hosts.items())
+        }
+
+
+def binance_time(client, type: str):
+    # 서버 시간 조회. 시간 보정을 쓰면 오래 쉬는 동안 벌어진 시계 차이도 같이 맞춘다
+    if client.options.get("adjustForTimeDifference"):
+        return client.load_time_difference({"type": type})
+    return client.fetch_time({"type": type})
+
+
+# 거래소별 (호스트, 가벼운 요청). 주문이 나가는 REST 호스트와 같은 커넥션 풀을 쓴다
+WARM_PINGS: dict[str, list[tuple[str, Callable]]] = {
+    "binance": [
+        ("fapi.binance.com", lambda client: binance_time(client, "future")),
+        ("api.binance.com", lambda client: client.fetch_time({"type": "spot"})),
+    ],
+    "bybit": [("api.bybit.com", lambda client: client.fetch_time())],
+    "okx": [("www.okx.com", lambda client: client.fetch_time())],
+    "bitget": [("api.bitget.com", lambda client: client.fetch_time())],
+    # 업비트는 서버 시간 API가 없다
+    "upbit": [("api.upbit.com", lambda client: client.fetch_ticker("BTC/KRW"))],
+}
+
+
+def kis_ping(kis):
+    # 시세 조회만 보낸다. 토큰 확인/재발급(auth)은 get_bot("KRX")이 주문마다 한다
+    return kis.fetch_ticker("KRX", "005930")
+
+
+class KeepWarm:
+    # 주문이 없는 동안 거래소/KIS 호스트에 주기적으로 가벼운 요청을 보내 TLS 커넥션을 살려둔다
+    # 쉬고 있던 시간이 KEEP_WARM_INTERVAL을 넘은 호스트만 보내서 주문이 많을 때는 추가 요청이 없다
+    def __init__(self, tracker: ConnectionTracker):
+        self.tracker = tracker
+        self.targets: dict[str, dict] = {}
+        self.thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def add(self, name: str, host: str, ping: Callable[[], object]):
+        self.targets[name] = {"host": host, "ping": ping, "pings": 0, "failures": 0}
+
+    def add_bot(self, bot):
+        client = getattr(bot, "client", None)
+        if client is not None:
+            self.tracker.track_ccxt(client)
+            for host, ping in WARM_PINGS.get(client.id, []):
+                self.add(f"{client.id.upper()}:{host}", host, lambda client=client, ping=ping: ping(client))
+        elif hasattr(bot, "kis_number"):
+            self.tracker.track_httpx(bot.session)
+            self.add(f"KIS{bot.kis_number}", urlsplit(bot.base_url).hostname, lambda: kis_ping(bot))
+
+    def start(self, get_bots: Callable[[], list]):
+        if self.running:
+            return
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run, args=(get_bots,), name="keep-warm", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def ping(self, name: str):
+        target = self.targets[name]
+        started = time.perf_counter()
+        try:
+            target["ping"]()
+        except Exception as e:
+            target["failures"] += 1
+            logger.warning(f"{name} 커넥션 유지 요청 실패: {e}")
+            return
+        target["pings"] += 1
+        record_latency(f"warm.{name}", time.perf_counter() - started)
+
+    def due(self) -> list[str]:
+        interval = settings.KEEP_WARM_INTERVAL
+        return [
+            name
+            for name, target in self.targets.items()
+            if (idle := self.tracker.idle(target["host"])) is None or idle >= interval
+        ]
+
+    def _run(self, get_bots: Callable[[], list]):
+        try:
+            for bot in get_bots():
+                self.add_bot(bot)
+        except Exception as e:
+            logger.error(f"커넥션 유지 대상 생성 실패: {e}")
+        while not self._stop.is_set():
+            names = self.due()
+            if names:
+                gather(self.ping, names, limit=len(names))
+            self._stop.wait(settings.KEEP_WARM_INTERVAL / 2)
+
+    def status(self) -> dict:
+        return {
+            name: {"pings": target["pings"], "failures": target["failures"]}
+            for name, target in list(self.targets.items())
+        }
+
+
+dns_cache = DnsCache(settings.DNS_CACHE_TTL or 0)
+connection_tracker = ConnectionTracker()
+keep_warm = KeepWarm(connection_tracker)
+
+
+def start_keep_warm(get_bots: Callable[[], list]):
+    if settings.DNS_CACHE_TTL:
+        dns_cache.install()
+    if settings.KEEP_WARM_INTERVAL:
+        keep_warm.start(get_bots)
+
+
+register_gauge("dns", dns_cache.status)
+register_gauge("connections", connection_tracker.status)
+register_gauge("keep_warm", keep_warm.status)
@@ -1,70 +1,586 @@
-# from toolbox import Client
-
-from client import Client
-import websocket
-import _thread
-import time
-import rel
+import asyncio
+import base64
+import hashlib
+import hmac
 import json
-from pprint import pprint
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable
+
+from loguru import logger
+from websockets.asyncio.client import connect
+from websockets.protocol import State
+
+from exchange.utility import settings
+from exchange.utility.account_state import get_account_state
+from exchange.utility.listen_key import close_http, get_listen_key_manager
+from exchange.utility.metrics import register_gauge
+
+
+class WebsocketStream:
+    # 연결 -> 인증/구독 -> on_open -> 메시지 수신. 연결이 끊기면 백오프 후 재연결한다
+    # rotate()나 max_lifetime이 지나면 새 연결을 먼저 연 뒤 옛 연결을 닫는다 (겹치는 동안 둘 다 수신)
+    ping_interval = 20
+    max_backoff = 60
+    max_lifetime: float | None = None
+
+    def __init__(self, name: str, service: "StreamService"):
+        self.name = name
+        self.service = service
+        self.connected = False
+        self.reconnects = 0
+        self.rotations = 0
+        self.last_message_at: float | None = None
+        self.ws = None
+        self._rotate: asyncio.Event | None = None
+        self._resync = False
+
+    async def get_url(self) -> str:
+        raise NotImplementedError
+
+    async def get_headers(self) -> dict | None:
+        # 연결 요청 헤더로 인증하는 스트림(업비트)만 쓴다
+        return None
+
+    async def on_connect(self, ws):
+        pass
+
+    async def on_open(self):
+        pass
+
+    def on_close(self):
+        pass
+
+    def handle(self, message: dict):
+        pass
+
+    async def ping(self, ws):
+        await ws.send("ping")
+
+    def parse(self, raw) -> dict | None:
+        if raw == "pong":
+            return None
+        message = json.loads(raw)
+        if message.get("event") == "error":
+            logger.error(f"{self.name} 스트림 에러: {message}")
+        if "data" not in message:
+            return None
+        return message
+
+    async def heartbeat(self, ws):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await self.ping(ws)
+
+    async def wait_for(self, ws, predicate: Callable[[dict], bool], timeout=10):
+        async def receive():
+            while True:
+                raw = await ws.recv()
+                if raw == "pong":
+                    continue
+                message = json.loads(raw)
+                if predicate(message):
+                    return message
+
+        return await asyncio.wait_for(receive(), timeout)
+
+    async def open(self):
+        # websockets 13+ asyncio 클라이언트 (레거시 클라이언트는 additional_headers를 받지 않는다)
+        ws = await connect(
+            await self.get_url(), additional_headers=await self.get_headers(), ping_interval=None
+        )
+        try:
+            await self.on_connect(ws)
+        except BaseException:
+            await ws.close()
+            raise
+        return ws
+
+    async def receive(self, ws):
+        async for raw in ws:
+            self.last_message_at = time.time()
+            message = self.parse(raw)
+            if message is not None:
+                self.service.dispatch(self, message)
+
+    def rotate(self, resync=False):
+        # 스트림 루프에서 호출. 연결 중이 아니면 다음 연결이 어차피 새 URL을 쓴다
+        self._resync = self._resync or resync
+        if self._rotate is not None:
+            self._rotate.set()
+
+    async def serve(self, ws):
+        self._rotate = asyncio.Event()
+        receiving = asyncio.create_task(self.receive(ws))
+        heartbeat = asyncio.create_task(self.heartbeat(ws))
+        try:
+            while True:
+                rotating = asyncio.create_task(self._rotate.wait())
+                done, _ = await asyncio.wait(
+                    {receiving, rotating}, timeout=self.max_lifetime, return_when=asyncio.FIRST_COMPLETED
+                )
+                rotating.cancel()
+                if receiving in done:
+                    receiving.result()
+                    return
+                self._rotate.clear()
+                try:
+                    new_ws = await self.open()
+                except Exception as e:
+                    logger.error(f"{self.name} 새 연결 실패, 기존 연결을 유지하고 다시 시도합니다: {e}")
+                    asyncio.get_running_loop().call_later(5, self._rotate.set)
+                    continue
+                old_ws, old_receiving = ws, receiving
+                heartbeat.cancel()
+                ws = self.ws = new_ws
+                receiving = asyncio.create_task(self.receive(ws))
+                heartbeat = asyncio.create_task(self.heartbeat(ws))
+                # 새 연결이 수신을 시작한 뒤에 옛 연결을 닫아서 교체 중에 빠지는 이벤트가 없다
+                await old_ws.close()
+                await asyncio.gather(old_receiving, return_exceptions=True)
+                self.rotations += 1
+                logger.info(f"{self.name} 스트림 연결 교체")
+                if self._resync:
+                    self._resync = False
+                    await self.on_open()
+        finally:
+            self._rotate = None
+            heartbeat.cancel()
+            receiving.cancel()
+            await ws.close()
+
+    async def run(self):
+        backoff = 1
+        while True:
+            try:
+                ws = await self.open()
+                try:
+                    self.ws = ws
+                    self.connected = True
+                    backoff = 1
+                    self._resync = False
+                    await self.on_open()
+                    logger.info(f"{self.name} 스트림 연결")
+                    await self.serve(ws)
+                finally:
+                    await ws.close()
+            except asyncio.CancelledError:
+                self.on_close()
+                raise
+            except Exception as e:
+                logger.error(f"{self.name} 스트림 에러: {e}")
+            self.ws = None
+            self.connected = False
+            self.on_close()
+            self.reconnects += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def status(self) -> dict:
+        return {
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "rotations": self.rotations,
+            "last_message_at": self.last_message_at,
+        }
+
+
+class SymbolStream(WebsocketStream):
+    # 심볼 단위로 구독하는 퍼블릭 스트림. 연결 중에도 심볼을 추가할 수 있다
+    kind = "public"
+    url: str | None = None
+
+    def __init__(self, client, category: str):
+        self.exchange_name = client.id.upper()
+        super().__init__(f"{self.exchange_name}:{self.kind}:{category}", stream_service)
+        self.client = client
+        self.category = category
+        self.symbols: dict[str, str] = {}  # market id -> unified symbol
+        # 연결별로 구독한 market id. 연결 교체 중에는 옛 연결과 새 연결이 같이 들어있다
+        self.subscribed: dict[object, set[str]] = {}
+
+    async def get_url(self) -> str:
+        return self.url
+
+    def watch(self, market: dict):
+        if market["id"] in self.symbols:
+            return
+        self.symbols[market["id"]] = market["symbol"]
+        for ws in list(self.subscribed):
+            self.service.run_coroutine(self.sync(ws))
+
+    async def sync(self, ws):
+        # 이 연결에 아직 구독하지 않은 심볼을 구독한다
+        subscribed = self.subscribed.get(ws)
+        if subscribed is None:
+            return
+        if ws.state in (State.CLOSING, State.CLOSED):
+            self.subscribed.pop(ws, None)
+            return
+        ids = [market_id for market_id in list(self.symbols) if market_id not in subscribed]
+        if not ids:
+            return
+        subscribed.update(ids)
+        try:
+            await self.subscribe(ws, ids)
+        except Exception as e:
+            subscribed.difference_update(ids)
+            logger.error(f"{self.name} 구독 실패: {e}")
+
+    async def on_connect(self, ws):
+        # open()은 self.ws를 바꾸기 전에 부르므로 새 연결(ws)에 직접 구독한다. 교체 중인 옛 연결(self.ws)만 남긴다
+        self.subscribed = {
+            current: ids for current, ids in self.subscribed.items() if current is self.ws
+        }
+        self.subscribed[ws] = set()
+        await self.sync(ws)
+
+    async def subscribe(self, ws, ids: list[str]):
+        raise NotImplementedError
+
+    def status(self) -> dict:
+        return super().status() | {"symbols": len(self.symbols)}
+
+
+class UserDataStream(WebsocketStream):
+    # 거래소 프라이빗 유저데이터 스트림. 연결될 때마다 REST로 계정 상태를 다시 맞춘다
+    market_type = "swap"
+
+    def __init__(self, bot, service: "StreamService"):
+        super().__init__(bot.client.id.upper(), service)
+        self.bot = bot
+        self.client = bot.client
+        self.state = get_account_state(self.client, self.market_type)
+
+    async def on_open(self):
+        # 끊겨있던 동안의 변경분은 REST로 다시 맞춘다
+        await asyncio.get_running_loop().run_in_executor(None, self.state.resync)
+        self.state.set_live(True)
+
+    def on_close(self):
+        self.state.set_live(False)
+
+    def handle(self, message: dict):
+        self.state.apply(message)
+
+    def sign(self, payload: str) -> str:
+        digest = hmac.new(self.client.secret.encode(), payload.encode(), hashlib.sha256).digest()
+        return base64.b64encode(digest).decode()
+
+
+class BinanceUserStream(UserDataStream):
+    # 마켓 구분(spot, swap=USDT-M, delivery=COIN-M)별 유저데이터 스트림. listenKey 연장/재발급은 ListenKeyManager가 한다
+    # 바이낸스는 연결을 24시간 뒤에 끊으므로 그 전에 새 연결로 겹쳐서 교체한다
+    ping_interval = 3 * 60
+    max_lifetime = 23 * 60 * 60
+    urls = {
+        "spot": "wss://stream.binance.com:9443/ws/",
+        "swap": "wss://fstream.binance.com/ws/",
+        "delivery": "wss://dstream.binance.com/ws/",
+    }
+
+    def __init__(self, bot, service: "StreamService", market_type="swap"):
+        self.market_type = market_type
+        super().__init__(bot, service)
+        self.name = f"BINANCE:{market_type}"
+        self.listen_key = get_listen_key_manager(self.client.apiKey, market_type)
+        self.listen_key.listeners.append(self.on_listen_key)
+        # 연결이 겹치는 동안 같은 이벤트가 두 번 온다
+        self.recent: OrderedDict[str, None] = OrderedDict()
+
+    async def get_url(self) -> str:
+        return self.urls[self.market_type] + await self.listen_key.get()
+
+    async def on_listen_key(self, key: str):
+        # 새 키로 연결을 교체하고, 만료된 동안의 변경분은 REST로 다시 맞춘다
+        self.rotate(resync=True)
 
+    async def ping(self, ws):
+        await ws.ping()
 
-class Websocket:
+    def parse(self, raw) -> dict | None:
+        if raw in self.recent:
+            return None
+        self.recent[raw] = None
+        if len(self.recent) > 1000:
+            self.recent.popitem(last=False)
+        message = json.loads(raw)
+        if message.get("e") == "listenKeyExpired":
+            logger.error(f"{self.name} listenKey 만료, 새로 발급합니다")
+            asyncio.create_task(self.listen_key.renew(message.get("listenKey")))
+            return None
+        return message
 
+
+class BybitUserStream(UserDataStream):
+    url = "wss://stream.bybit.com/v5/private"
+
+    async def get_url(self) -> str:
+        return self.url
+
+    async def on_connect(self, ws):
+        expires = int((time.time() + 10) * 1000)
+        signature = hmac.new(
+            self.client.secret.encode(), f"GET/realtime{expires}".encode(), hashlib.sha256
+        ).hexdigest()
+        await ws.send(json.dumps({"op": "auth", "args": [self.client.apiKey, expires, signature]}))
+        response = await self.wait_for(ws, lambda message: message.get("op") == "auth")
+        if not response.get("success"):
+            raise Exception(f"BYBIT 스트림 인증 실패: {response}")
+        await ws.send(json.dumps({"op": "subscribe", "args": ["position", "order", "wallet"]}))
+
+    async def ping(self, ws):
+        await ws.send(json.dumps({"op": "ping"}))
+
+    def parse(self, raw) -> dict | None:
+        message = json.loads(raw)
+        if "topic" not in message:
+            return None
+        return message
+
+
+async def okx_login(stream: WebsocketStream, ws):
+    # OKX 프라이빗 웹소켓(유저 스트림, 주문) 로그인
+    client = stream.client
+    timestamp = str(int(time.time()))
+    digest = hmac.new(client.secret.encode(), f"{timestamp}GET/users/self/verify".encode(), hashlib.sha256).digest()
+    await ws.send(
+        json.dumps(
+            {
+                "op": "login",
+                "args": [
+                    {
+                        "apiKey": client.apiKey,
+                        "passphrase": client.password,
+                        "timestamp": timestamp,
+                        "sign": base64.b64encode(digest).decode(),
+                    }
+                ],
+            }
+        )
+    )
+    response = await stream.wait_for(ws, lambda message: message.get("event") in ("login", "error"))
+    if response.get("event") != "login" or response.get("code") != "0":
+        raise Exception(f"OKX 스트림 로그인 실패: {response}")
+
+
+class OkxUserStream(UserDataStream):
+    url = "wss://ws.okx.com:8443/ws/v5/private"
+    ping_interval = 25
+
+    async def get_url(self) -> str:
+        return self.url
+
+    async def on_connect(self, ws):
+        await okx_login(self, ws)
+        args = [{"channel": "account"}] + [
+            {"channel": channel, "instType": "ANY"}
+            for channel in ("positions", "orders", "orders-algo")
+        ]
+        await ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+
+class BitgetUserStream(UserDataStream):
+    url = "wss://ws.bitget.com/v2/ws/private"
+    ping_interval = 25
+
+    async def get_url(self) -> str:
+        return self.url
+
+    async def on_connect(self, ws):
+        timestamp = str(int(time.time()))
+        await ws.send(
+            json.dumps(
+                {
+                    "op": "login",
+                    "args": [
+                        {
+                            "apiKey": self.client.apiKey,
+                            "passphrase": self.client.password,
+                            "timestamp": timestamp,
+                            "sign": self.sign(f"{timestamp}GET/user/verify"),
+                        }
+                    ],
+                }
+            )
+        )
+        response = await self.wait_for(ws, lambda message: message.get("event") in ("login", "error"))
+        if response.get("event") != "login" or response.get("code") not in (0, "0"):
+            raise Exception(f"BITGET 스트림 로그인 실패: {response}")
+        args = [{"instType": "USDT-FUTURES", "channel": "account", "coin": "default"}] + [
+            {"instType": "USDT-FUTURES", "channel": channel, "instId": "default"}
+            for channel in ("positions", "orders", "orders-algo")
+        ]
+        await ws.send(json.dumps({"op": "subscribe", "args": args}))
+
+
+class UpbitUserStream(UserDataStream):
+    # 내 주문(myOrder)과 내 자산(myAsset). 연결 요청의 Authorization 헤더(JWT)로 인증한다
+    url = "wss://api.upbit.com/websocket/v1/private"
+    market_type = "spot"
+
+    async def get_url(self) -> str:
+        return self.url
+
+    async def get_headers(self) -> dict:
+        token = self.client.jwt(
+            {"access_key": self.client.apiKey, "nonce": self.client.uuid()},
+            self.client.encode(self.client.secret),
+            "sha256",
+        )
+        return {"Authorization": f"Bearer {token}"}
+
+    async def on_connect(self, ws):
+        await ws.send(json.dumps([{"ticket": self.client.uuid()}, {"type": "myOrder"}, {"type": "myAsset"}]))
+
+    async def ping(self, ws):
+        await ws.ping()
+
+    def parse(self, raw) -> dict | None:
+        # 바이너리 프레임으로 온다
+        message = json.loads(raw)
+        if message.get("error"):
+            logger.error(f"{self.name} 스트림 에러: {message}")
+        return message if message.get("type") in ("myOrder", "myAsset") else None
+
+
+STREAMS = {
+    "binance": BinanceUserStream,
+    "bybit": BybitUserStream,
+    "okx": OkxUserStream,
+    "bitget": BitgetUserStream,
+    "upbit": UpbitUserStream,
+}
+
+
+def user_streams(bot, service: "StreamService") -> list[UserDataStream]:
+    if bot.client.id == "binance":
+        return [BinanceUserStream(bot, service, market_type) for market_type in settings.BINANCE_STREAM_MARKETS]
+    stream_class = STREAMS.get(bot.client.id)
+    return [] if stream_class is None else [stream_class(bot, service)]
+
+
+class StreamService:
+    # FastAPI startup에서 시작. 동기 주문 코드가 이벤트 루프를 막지 않도록 별도 스레드의 루프에서 실행
     def __init__(self):
-        self.client = Client()
-        self.binance = self.client.get_binance()
-        self.listen_key = self.binance.get_listen_key()
-        self.ws_url = f"wss://fstream.binance.com/ws/{self.listen_key}"
-
-    def on_message(self, ws, message):
-
-        datas: dict = json.loads(message)
-        event = datas.get("e")
-        event_time = datas.get("E")
-        transaction_time = datas.get("T")
-        cross_wallt_balance = datas.get("cw")
-        order = datas.get("o")
-
-        if event == "listenKeyExpired":
-            print("Listen key expired")
-            self.listen_key = self.binance.get_listen_key()
-        elif event == "ORDER_TRADE_UPDATE":
-            order_type = order.get("ot")  # TAKE_PROFIT_MARKET, STOP_MARKET
-            order_status = order.get("X")  # 새로운 주문은 NEW
-            if order_type in ("TAKE_PROFIT_MARKET", "STOP_MARKET"):
-                order_id = order.get("i")  # 주문 ID
-                client_order_id = order.get("c")  # 주문 고유 ID
-                order_symbol = order.get("s")  # 주문 심볼
-                order_price = order.get("sp")  # 스탑 가격
-                order_side = order.get("S")  # 주문 종류
-                order_qty = order.get("q")  # 주문 수량
-
-                print(f"{order_symbol=}, {order_price=}, {order_type=}, {order_status=}, {order_id=}, {client_order_id=}")
-
-            print("=====끝=====")
-
-    def on_error(self, ws, error):
-        print(error)
-
-    def on_close(self, ws, close_status_code, close_msg):
-        print("### closed ###")
-
-    def on_open(self, ws):
-        print("Opened connection")
-
-    def start(self):
-        ws = websocket.WebSocketApp(self.ws_url,
-                                    on_open=self.on_open,
-                                    on_message=self.on_message,
-                                    on_error=self.on_error,
-                                    on_close=self.on_close)
-
-        ws.run_forever(dispatcher=rel, reconnect=5)  # Set dispatcher to automatic reconnection, 5 second reconnect delay if connection closed unexpectedly
-        rel.signal(2, rel.abort)  # Keyboard Interrupt
-        rel.dispatch()
-
-
-if __name__ == "__main__":
-    ws = Websocket()
-    ws.start()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.streams: dict[str, WebsocketStream] = {}
+        self.subscribers: list[Callable[[str, dict], None]] = []
+        self.tasks: list[asyncio.Task] = []
+        self._stop: asyncio.Event | None = None
+        self._ready = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, get_bots: Callable[[], list] | None = None):
+        if self.running:
+            return
+        self.thread = threading.Thread(
+            target=lambda: asyncio.run(self._main(get_bots)), name="user-stream", daemon=True
+        )
+        self.thread.start()
+        self._ready.wait(timeout=5)
+
+    def stop(self):
+        if self.running and self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stop.set)
+            self.thread.join(timeout=5)
+
+    async def _main(self, get_bots: Callable[[], list] | None):
+        self.loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        # 시작 전에 등록된 스트림
+        for stream in list(self.streams.values()):
+            self.tasks.append(asyncio.create_task(stream.run()))
+        self._ready.set()
+        if get_bots is not None:
+            try:
+                bots = await self.loop.run_in_executor(None, get_bots)
+                for bot in bots:
+                    for stream in user_streams(bot, self):
+                        self._add(stream)
+            except Exception as e:
+                logger.error(f"유저 스트림 시작 에러: {e}")
+        await self._stop.wait()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await close_http()
+
+    def _add(self, stream: WebsocketStream):
+        self.streams[stream.name] = stream
+        self.tasks.append(asyncio.create_task(stream.run()))
+
+    def add(self, stream: WebsocketStream):
+        # 서비스가 아직 시작되지 않았으면 시작할 때 같이 연결한다
+        if self.running and self.loop is not None:
+            self.loop.call_soon_threadsafe(self._add, stream)
+        else:
+            self.streams[stream.name] = stream
+
+    def subscribe(self, callback: Callable[[str, dict], None]):
+        self.subscribers.append(callback)
+
+    def dispatch(self, stream: WebsocketStream, message: dict):
+        stream.handle(message)
+        for callback in self.subscribers:
+            try:
+                callback(stream.name, message)
+            except Exception as e:
+                logger.error(f"{stream.name} 스트림 구독자 에러: {e}")
+
+    def run_coroutine(self, coro) -> Future | None:
+        if not self.running or self.loop is None:
+            coro.close()
+            return None
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def status(self) -> dict:
+        return {name: stream.status() for name, stream in self.streams.items()}
+
+
+stream_service = StreamService()
+register_gauge("user_streams", stream_service.status)
+
+
+def market_category(client, market: dict) -> str:
+    # 거래소마다 퍼블릭 스트림이 나뉘는 단위
+    if client.id == "okx":
+        return "all"
+    if market["spot"]:
+        return "SPOT" if client.id == "bitget" else "spot"
+    if client.id == "bitget":
+        return "USDT-FUTURES" if market["linear"] else "COIN-FUTURES"
+    return "linear" if market["linear"] else "inverse"
+
+
+_symbol_streams: dict[tuple, SymbolStream] = {}
+_symbol_streams_lock = threading.Lock()
+
+
+def watch_symbol(stream_classes: dict[str, type], client, symbol: str) -> SymbolStream | None:
+    # 거래소/마켓 구분마다 스트림 하나를 만들고 심볼을 추가 구독한다
+    stream_class = stream_classes.get(client.id)
+    if stream_class is None:
+        return None
+    try:
+        market = client.market(symbol)
+    except Exception:
+        return None
+    category = market_category(client, market)
+    key = (stream_class, client.id.upper(), category)
+    with _symbol_streams_lock:
+        stream = _symbol_streams.get(key)
+        if stream is None:
+            stream = stream_class(client, category)
+            _symbol_streams[key] = stream
+            stream.symbols[market["id"]] = market["symbol"]
+            stream_service.add(stream)
+            return stream
+    stream.watch(market)
+    return stream
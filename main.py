@@ -10,6 +10,7 @@ import httpx
 from exchange.stock.kis import KoreaInvestment
 from typing import Literal, Union
 from exchange.model import MarketOrder, PriceRequest, HedgeData, OrderRequest, ChangeSLOrder
+import asyncio
 from exchange.utility import (
     settings,
     log_order_message,
@@ -22,8 +23,19 @@ from exchange.utility import (
     log_error_message,
     log_message,
 )
+from exchange.utility import metrics
+from exchange.utility.ws import stream_service
+from exchange.utility.ticker import watch_configured_tickers
+from exchange.utility.orderbook import watch_configured_books
+from exchange.utility.order_ws import open_order_sockets
+from exchange.utility.warm import start_keep_warm, keep_warm
+from exchange.utility.fees import load_configured_fees
+from exchange.utility.fills import fill_waiter, filled_amount
 import traceback
-from exchange import get_exchange, log_message, db, settings, get_bot, pocket
+import time
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from exchange import get_exchange, log_message, db, settings, get_bot, get_stream_bots, get_warm_bots, pocket
 import ipaddress
 import os
 import sys
@@ -52,10 +64,23 @@ def get_error(e):
 @app.on_event("startup")
 async def startup():
     log_message(f"POABOT CUSTOM 실행 완료! - 버전:{VERSION}")
+    start_keep_warm(get_warm_bots)
+    if settings.USER_STREAM or settings.TICKER_STREAM or settings.MAX_SLIPPAGE is not None or settings.ORDER_WS:
+        stream_service.start(get_stream_bots if settings.USER_STREAM else None)
+    if settings.ORDER_WS:
+        asyncio.get_running_loop().run_in_executor(None, open_order_sockets, get_stream_bots)
+    if settings.TICKER_STREAM and settings.TICKER_SYMBOLS:
+        asyncio.get_running_loop().run_in_executor(None, watch_configured_tickers, get_bot)
+    if settings.DEPTH_SYMBOLS:
+        asyncio.get_running_loop().run_in_executor(None, watch_configured_books, get_bot)
+    if settings.FEE_SYMBOLS:
+        asyncio.get_running_loop().run_in_executor(None, load_configured_fees, get_bot)
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    keep_warm.stop()
+    stream_service.stop()
     db.close()
 
 
@@ -150,13 +175,20 @@ async def welcome():
     return "hi!!"
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
 @app.post("/price")
 async def price(price_req: PriceRequest, background_tasks: BackgroundTasks):
-    exchange = get_exchange(price_req.exchange)
-    price = exchange.dict()[price_req.exchange].fetch_price(
-        price_req.base, price_req.quote
-    )
-    return price
+    if price_req.is_stock:
+        kis = get_bot(price_req.exchange, 1)
+        return kis.fetch_current_price(price_req.exchange, price_req.base)
+    symbol = OrderRequest(
+        exchange=price_req.exchange, base=price_req.base, quote=price_req.quote
+    ).unified_symbol
+    return get_bot(price_req.exchange).get_price(symbol)
 
 
 def log(exchange_name, result, order_info):
@@ -255,6 +287,154 @@ def get_hedge_records(base):
     }
 
 
+# 헷지 leg 전용 풀. leg 안에서 쓰는 prefetch/gather 풀과 따로 둬서 동시 헷지가 서로의 풀을 막지 않는다
+hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+
+def leg_bot(bot, order_info: OrderRequest):
+    # /order 웹훅과 같이 쓰는 봇의 order_info와 client.options["defaultType"]를 건드리지 않도록
+    # 주문 정보와 옵션만 따로 가진 사본으로 주문한다. 세션, 마켓 정보, 캐시 키(거래소, API 키)는 원본과 같다
+    leg = copy.copy(bot)
+    leg.client = copy.copy(bot.client)
+    leg.client.options = dict(bot.client.options)
+    leg.entry_orders = None
+    leg.entry_filled = None
+    leg.init_info(order_info)
+    return leg
+
+
+def open_leg(leg, order, order_info: OrderRequest):
+    # 주문을 보내고 나눠 보낸 조각까지 모두 체결을 확인한다. (주문 결과, 체결 수량 합계, 체결을 확인한 시각)
+    result = order(order_info)
+    # market_entry가 이미 확인한 체결은 다시 기다리지 않는다 (스트림이 없으면 REST 조회가 두 번 된다)
+    if leg.entry_filled is not None:
+        return result, leg.entry_filled, time.perf_counter()
+    orders = leg.entry_orders or [(result, result.get("amount"))]
+    filled = sum(
+        filled_amount(
+            fill_waiter.wait(leg.client, entry_order, order_info.unified_symbol),
+            amount if amount is not None else order_info.amount,
+        )
+        for entry_order, amount in orders
+    )
+    return result, filled, time.perf_counter()
+
+
+def leg_result(future):
+    # 실패한 leg는 (예외, 0, None)
+    try:
+        return future.result()
+    except Exception as e:
+        return e, 0, None
+
+
+def keep_unhedged_leg(base, quote, foreign_amount, korea_amount, message):
+    # 되돌리지 못한 leg는 헷지 기록에 남겨서 헷지 종료(OFF)로 정리할 수 있게 한다
+    log_message(f"[헷지 실패] 되돌리지 못한 수량을 헷지 기록에 남깁니다\n{message}")
+    try:
+        write_hedge_records(base, quote, foreign_amount, korea_amount)
+    except Exception as e:
+        log_message(f"[헷지 실패] 헷지 기록 실패: {e}")
+
+
+def open_hedge(bot, upbit, foreign_order_info: OrderRequest, korea_order_info: OrderRequest) -> dict:
+    # 해외 숏과 업비트 매수를 동시에 보내고 체결 이벤트로 수량을 확인한다
+    # 한쪽만 실패하면 성공한 쪽을 바로 되돌린다 (해외: reduce-only 청산, 업비트: 체결 수량 시장가 매도)
+    started = time.perf_counter()
+    foreign = leg_bot(bot, foreign_order_info)
+    korea = leg_bot(upbit, korea_order_info)
+    foreign_future = hedge_executor.submit(open_leg, foreign, foreign.market_entry, foreign_order_info)
+    korea_future = hedge_executor.submit(open_leg, korea, korea.market_buy, korea_order_info)
+    foreign_result, foreign_amount, foreign_at = leg_result(foreign_future)
+    korea_result, korea_amount, korea_at = leg_result(korea_future)
+    if hasattr(bot, "position_mode"):
+        # retry가 바꾼 포지션 모드는 원본 봇에도 반영한다
+        bot.position_mode = foreign.position_mode
+
+    # 주문은 들어갔지만 체결이 없는 leg도 실패로 본다
+    if not isinstance(foreign_result, Exception) and not foreign_amount:
+        foreign_result = Exception(f"{foreign_order_info.exchange} 체결 수량이 없습니다")
+    if not isinstance(korea_result, Exception) and not korea_amount:
+        korea_result = Exception("UPBIT 체결 수량이 없습니다")
+
+    if isinstance(foreign_result, Exception) and isinstance(korea_result, Exception):
+        raise Exception(f"양쪽 주문 실패\n{foreign_result}\n{korea_result}")
+    if isinstance(korea_result, Exception):
+        if foreign_amount:
+            close_order_info = OrderRequest(
+                exchange=foreign_order_info.exchange,
+                base=foreign_order_info.base,
+                quote=foreign_order_info.quote,
+                side="close/buy",
+                type="market",
+                amount=foreign_amount,
+            )
+            try:
+                leg_bot(bot, close_order_info).market_close(close_order_info)
+            except Exception as e:
+                keep_unhedged_leg(
+                    foreign_order_info.base,
+                    foreign_order_info.quote,
+                    foreign_amount,
+                    0,
+                    f"업비트 에러: {korea_result}\n{foreign_order_info.exchange} 포지션 {foreign_amount} 종료 실패: {e}",
+                )
+                raise korea_result
+        log_message(
+            f"[헷지 실패] 업비트에서 에러가 발생하여 {foreign_order_info.exchange} 포지션 {foreign_amount}을 종료합니다"
+        )
+        raise korea_result
+    if isinstance(foreign_result, Exception):
+        if korea_amount:
+            sell_order_info = OrderRequest(
+                exchange="UPBIT",
+                base=korea_order_info.base,
+                quote="KRW",
+                side="sell",
+                type="market",
+                amount=korea_amount,
+            )
+            try:
+                leg_bot(upbit, sell_order_info).market_sell(sell_order_info)
+            except Exception as e:
+                keep_unhedged_leg(
+                    korea_order_info.base,
+                    foreign_order_info.quote,
+                    0,
+                    korea_amount,
+                    f"{foreign_order_info.exchange} 에러: {foreign_result}\n업비트 매수 {korea_amount} 매도 실패: {e}",
+                )
+                raise foreign_result
+        log_message(
+            f"[헷지 실패] {foreign_order_info.exchange}에서 에러가 발생하여 업비트 매수 {korea_amount}을 되돌립니다"
+        )
+        raise foreign_result
+
+    # 두 leg가 전부 체결된 시각 차이. 이 시간 동안 한쪽만 노출된다
+    skew = abs(foreign_at - korea_at)
+    metrics.record_latency("hedge.skew", skew)
+    metrics.record_latency("hedge.open", time.perf_counter() - started)
+    return {
+        "foreign_amount": foreign_amount,
+        "korea_amount": korea_amount,
+        "skew_ms": round(skew * 1000, 1),
+    }
+
+
+def write_hedge_records(base, quote, foreign_amount, korea_amount):
+    # 헷지 종료(OFF)는 exchange가 BINANCE인 기록을 해외 수량으로 읽는다. 수량이 없는 쪽은 남기지 않는다
+    for exchange, record_quote, amount in (
+        ("BINANCE", quote, foreign_amount),
+        ("UPBIT", "KRW", korea_amount),
+    ):
+        if not amount:
+            continue
+        pocket.create(
+            "kimp",
+            {"exchange": exchange, "base": base, "quote": record_quote, "amount": amount},
+        )
+
+
 @app.post("/hedge")
 async def hedge(hedge_data: HedgeData, background_tasks: BackgroundTasks):
     exchange_name = hedge_data.exchange.upper()
@@ -276,73 +456,40 @@ async def hedge(hedge_data: HedgeData, background_tasks: BackgroundTasks):
         amount=amount,
         leverage=leverage,
     )
-    bot.init_info(foreign_order_info)
     if hedge == "ON":
         try:
             if amount is None:
                 raise Exception("헷지할 수량을 요청하세요")
-            binance_order_result = await bot.market_entry(foreign_order_info)
-            binance_order_amount = binance_order_result["amount"]
-            pocket.create(
-                "kimp",
-                {
-                    "exchange": "BINANCE",
-                    "base": base,
-                    "quote": quote,
-                    "amount": binance_order_amount,
-                },
+            korea_order_info = OrderRequest(
+                exchange="UPBIT",
+                base=base,
+                quote="KRW",
+                side="buy",
+                type="market",
+                amount=amount,
+            )
+            # 주문 코드는 동기라서 이벤트 루프를 막지 않도록 스레드에서 실행
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, open_hedge, bot, upbit, foreign_order_info, korea_order_info
+            )
+            # 기록은 응답 후에 남긴다
+            background_tasks.add_task(
+                write_hedge_records,
+                base,
+                quote,
+                result["foreign_amount"],
+                result["korea_amount"],
+            )
+            background_tasks.add_task(
+                log_hedge_message,
+                exchange_name,
+                base,
+                quote,
+                result["foreign_amount"],
+                result["korea_amount"],
+                hedge,
+                result["skew_ms"],
             )
-            if leverage is None:
-                leverage = 1
-            try:
-                korea_order_info = OrderRequest(
-                    exchange="UPBIT",
-                    base=base,
-                    quote="KRW",
-                    side="buy",
-                    type="market",
-                    amount=binance_order_amount,
-                )
-                upbit.init_info(korea_order_info)
-                upbit_order_result = upbit.market_buy(korea_order_info)
-            except Exception as e:
-                hedge_records = get_hedge_records(base)
-                binance_records_id = hedge_records["BINANCE"]["records_id"]
-                binance_amount = hedge_records["BINANCE"]["amount"]
-                binance_order_result = bot.market_close(
-                    OrderRequest(
-                        exchange=exchange_name,
-                        base=base,
-                        quote=quote,
-                        side="close/buy",
-                        amount=binance_amount,
-                    )
-                )
-                for binance_record_id in binance_records_id:
-                    pocket.delete("kimp", binance_record_id)
-                log_message(
-                    "[헷지 실패] 업비트에서 에러가 발생하여 바이낸스 포지션을 종료합니다"
-                )
-            else:
-                upbit_order_info = upbit.get_order(upbit_order_result["id"])
-                upbit_order_amount = upbit_order_info["filled"]
-                pocket.create(
-                    "kimp",
-                    {
-                        "exchange": "UPBIT",
-                        "base": base,
-                        "quote": "KRW",
-                        "amount": upbit_order_amount,
-                    },
-                )
-                log_hedge_message(
-                    exchange_name,
-                    base,
-                    quote,
-                    binance_order_amount,
-                    upbit_order_amount,
-                    hedge,
-                )
 
         except Exception as e:
             # log_message(f"{e}")
@@ -351,9 +498,10 @@ async def hedge(hedge_data: HedgeData, background_tasks: BackgroundTasks):
             )
             return {"result": "error"}
         else:
-            return {"result": "success"}
+            return {"result": "success", "skew_ms": result["skew_ms"]}
 
     elif hedge == "OFF":
+        bot.init_info(foreign_order_info)
         try:
             records = pocket.get_full_list(
                 "kimp", query_params={"filter": f'base = "{base}"'}
@@ -370,39 +518,42 @@ async def hedge(hedge_data: HedgeData, background_tasks: BackgroundTasks):
                     upbit_amount += record.amount
                     upbit_records_id.append(record.id)
 
-            if binance_amount > 0 and upbit_amount > 0:
-                # 바이낸스
-                order_info = OrderRequest(
-                    exchange="BINANCE",
-                    base=base,
-                    quote=quote,
-                    side="close/buy",
-                    amount=binance_amount,
-                )
-                binance_order_result = bot.market_close(order_info)
-                for binance_record_id in binance_records_id:
-                    pocket.delete("kimp", binance_record_id)
-                # 업비트
-                order_info = OrderRequest(
-                    exchange="UPBIT",
-                    base=base,
-                    quote="KRW",
-                    side="sell",
-                    amount=upbit_amount,
-                )
-                upbit_order_result = upbit.market_sell(order_info)
-                for upbit_record_id in upbit_records_id:
-                    pocket.delete("kimp", upbit_record_id)
+            if binance_amount == 0 and upbit_amount == 0:
+                log_message(f"{exchange_name}, UPBIT에 종료할 수량이 없습니다")
+            else:
+                # 헷지 진입 때 되돌리지 못해서 한쪽만 기록된 수량도 있는 쪽은 종료한다
+                if binance_amount > 0:
+                    # 바이낸스
+                    order_info = OrderRequest(
+                        exchange="BINANCE",
+                        base=base,
+                        quote=quote,
+                        side="close/buy",
+                        amount=binance_amount,
+                    )
+                    binance_order_result = bot.market_close(order_info)
+                    for binance_record_id in binance_records_id:
+                        pocket.delete("kimp", binance_record_id)
+                else:
+                    log_message(f"{exchange_name}에 종료할 수량이 없습니다")
+                if upbit_amount > 0:
+                    # 업비트
+                    order_info = OrderRequest(
+                        exchange="UPBIT",
+                        base=base,
+                        quote="KRW",
+                        side="sell",
+                        amount=upbit_amount,
+                    )
+                    upbit_order_result = upbit.market_sell(order_info)
+                    for upbit_record_id in upbit_records_id:
+                        pocket.delete("kimp", upbit_record_id)
+                else:
+                    log_message("UPBIT에 종료할 수량이 없습니다")
 
                 log_hedge_message(
                     exchange_name, base, quote, binance_amount, upbit_amount, hedge
                 )
-            elif binance_amount == 0 and upbit_amount == 0:
-                log_message(f"{exchange_name}, UPBIT에 종료할 수량이 없습니다")
-            elif binance_amount == 0:
-                log_message(f"{exchange_name}에 종료할 수량이 없습니다")
-            elif upbit_amount == 0:
-                log_message("UPBIT에 종료할 수량이 없습니다")
         except Exception as e:
             background_tasks.add_task(
                 log_error_message, traceback.format_exc(), "헷지종료 에러"